@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from torch.nn.functional import affine_grid, grid_sample
 
 """
@@ -21,12 +22,14 @@ grid_sample https://pytorch.org/docs/1.3.0/nn.functional.html?highlight=affine_g
 ==========
 """
 class Affine_Transformer():
-    def __init__(self, frame_pixels, digit_pixels, CUDA, DEVICE):
+    def __init__(self, frame_pixels, digit_pixels, CUDA, DEVICE, use_grid_sample=False):
         """
         scale_dtof, translation_dtof: scaling and translation factors in transformation from digit to frame
         scale_ftod, translation_ftod: scaling and translation factors in transformation from frame to digit
+        use_grid_sample: if True, transform with affine_grid and grid_sample instead of the separable gathers
         """
         super().__init__()
+        self.use_grid_sample = use_grid_sample
         self.digit_pixels =  digit_pixels
         self.frame_pixels = frame_pixels
         self.translation_dtof = (self.frame_pixels - self.digit_pixels) / self.digit_pixels
@@ -38,7 +41,7 @@ class Affine_Transformer():
                 self.scale_dtof = self.scale_dtof.cuda()
                 self.scale_ftod = self.scale_ftod.cuda()
 
-    def digit_to_frame(self, digit, z_where):
+    def grid_digit_to_frame(self, digit, z_where):
         """
         transfer the digits to the frame
         [digit: S * B * K * DP * DP, z_where: S * B * T * K * 2 ===> frame: S * B * T * K * FP * FP]
@@ -51,7 +54,7 @@ class Affine_Transformer():
         frames = grid_sample(digit.unsqueeze(2).repeat(1,1,T,1,1,1).view(S*B*T*K, self.digit_pixels, self.digit_pixels).unsqueeze(1), grid, mode='nearest', align_corners=True)
         return frames.squeeze(1).view(S, B, T, K, self.frame_pixels, self.frame_pixels)
 
-    def frame_to_digit(self, frames, z_where):
+    def grid_frame_to_digit(self, frames, z_where):
         """
         transfer the frames to the digits
         [frame: S * B * T * FP * FP, z_where: S * B * T * K * 2 ===> digit: S * B * T * K * DP * DP]
@@ -63,3 +66,98 @@ class Affine_Transformer():
         grid = affine_grid(torch.cat((affine_p1, affine_p2), -1).view(S*B*T*K, 2, 3), torch.Size((S*B*T*K, 1, self.digit_pixels, self.digit_pixels)), align_corners=True)
         digit = grid_sample(frames.unsqueeze(-3).repeat(1, 1, 1, K, 1, 1).view(S*B*T*K, self.frame_pixels, self.frame_pixels).unsqueeze(1), grid, mode='nearest', align_corners=True)
         return digit.squeeze(1).view(S, B, T, K, self.digit_pixels, self.digit_pixels)
+
+    def nearest_indices(self, translation, scale, out_pixels, in_pixels):
+        """
+        the input pixels that grid_sample(mode='nearest', align_corners=True) reads along one axis
+        of an axis-aligned affine map, with in_pixels for the ones outside the input (zero padding)
+        [translation: S * B * T * K ===> indices: S * B * T * K * out_pixels]
+        """
+        base = torch.linspace(-1, 1, out_pixels, dtype=translation.dtype, device=translation.device)
+        coords = ((base * scale + translation.unsqueeze(-1) + 1) / 2) * (in_pixels - 1)
+        indices = torch.round(coords)
+        return torch.where((indices >= 0) & (indices <= in_pixels - 1), indices, torch.full_like(indices, in_pixels)).long()
+
+    def separable_gather(self, images, rows, cols):
+        """
+        images[..., rows, cols] on the outer product of rows and cols, with 0 at the index in_pixels
+        [images: S * B * 1 * K * IP * IP or S * B * T * 1 * IP * IP, rows, cols: S * B * T * K * OP ===> S * B * T * K * OP * OP]
+        the images are padded before they are expanded over T or K, so only the gathers allocate S * B * T * K tensors
+        """
+        images = F.pad(images, (0, 1, 0, 1))
+        in_size, out_size = images.shape[-1], rows.shape[-1]
+        images = images.expand(*rows.shape[:-1], in_size, in_size)
+        images = torch.gather(images, -2, rows.unsqueeze(-1).expand(*rows.shape, in_size))
+        return torch.gather(images, -1, cols.unsqueeze(-2).expand(*cols.shape[:-1], out_size, out_size))
+
+    def digit_to_frame(self, digit, z_where):
+        """
+        transfer the digits to the frame
+        [digit: S * B * K * DP * DP, z_where: S * B * T * K * 2 ===> frame: S * B * T * K * FP * FP]
+        the affine map has no rotation, so its nearest sampling is separable: the pixel (i, j) of a frame
+        reads the row v(i) and the column u(j) of the digit, where v only depends on z_where[..., 1]
+        and u on z_where[..., 0]. with align_corners=True the scale in pixels is (DP-1)*FP / (DP*(FP-1)),
+        not 1, so this is not an integer shift, but the indices are those of grid_sample, computed per axis.
+        """
+        if self.use_grid_sample:
+            return self.grid_digit_to_frame(digit, z_where)
+        scale = self.frame_pixels / self.digit_pixels
+        ## x-axis flipped as in grid_digit_to_frame
+        cols = self.nearest_indices(- z_where[..., 0] * self.translation_dtof, scale, self.frame_pixels, self.digit_pixels)
+        rows = self.nearest_indices(z_where[..., 1] * self.translation_dtof, scale, self.frame_pixels, self.digit_pixels)
+        return self.separable_gather(digit.unsqueeze(2), rows, cols)
+
+    def frame_to_digit(self, frames, z_where):
+        """
+        transfer the frames to the digits
+        [frame: S * B * T * FP * FP, z_where: S * B * T * K * 2 ===> digit: S * B * T * K * DP * DP]
+        the crop of digit_to_frame, by the same separable gathers
+        """
+        if self.use_grid_sample:
+            return self.grid_frame_to_digit(frames, z_where)
+        scale = self.digit_pixels / self.frame_pixels
+        ## y-axis flipped as in grid_frame_to_digit
+        cols = self.nearest_indices(z_where[..., 0] * self.translation_ftod, scale, self.digit_pixels, self.frame_pixels)
+        rows = self.nearest_indices(- z_where[..., 1] * self.translation_ftod, scale, self.digit_pixels, self.frame_pixels)
+        return self.separable_gather(frames.unsqueeze(3), rows, cols)
+
+def parity(AT, S, B, T, K, CUDA, device, edge_prob=0.25, tolerance=1e-3):
+    """
+    check the separable gathers against grid_sample on random digits and positions z_where in [-1, 1],
+    with a fraction edge_prob of the coordinates at the edges -1, 0 or 1, where the zero padding matters.
+    the indices use the formulas of affine_grid and grid_sample, but their float roundings may differ
+    (e.g. a fused multiply-add in the matmul of affine_grid), which changes a pixel when its coordinate
+    is within rounding error of a .5 boundary: the fraction of such pixels must stay below tolerance.
+    return the fractions of pixels that differ in digit_to_frame and frame_to_digit
+    """
+    digit = torch.rand(S, B, K, AT.digit_pixels, AT.digit_pixels)
+    frames = torch.rand(S, B, T, AT.frame_pixels, AT.frame_pixels)
+    z_where = torch.rand(S, B, T, K, 2) * 2 - 1
+    edges = torch.randint(-1, 2, z_where.shape).float()
+    z_where = torch.where(torch.rand(z_where.shape) < edge_prob, edges, z_where)
+    if CUDA:
+        with torch.cuda.device(device):
+            digit, frames, z_where = digit.cuda(), frames.cuda(), z_where.cuda()
+    dtof = (AT.digit_to_frame(digit, z_where) != AT.grid_digit_to_frame(digit, z_where)).float().mean().item()
+    ftod = (AT.frame_to_digit(frames, z_where) != AT.grid_frame_to_digit(frames, z_where)).float().mean().item()
+    assert dtof <= tolerance, "ERROR! digit_to_frame disagrees with grid_sample on %.5f of the pixels." % dtof
+    assert ftod <= tolerance, "ERROR! frame_to_digit disagrees with grid_sample on %.5f of the pixels." % ftod
+    return dtof, ftod
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('Parity of the affine transformer with grid_sample')
+    parser.add_argument('--frame_pixels', default=96, type=int)
+    parser.add_argument('--digit_pixels', default=28, type=int)
+    parser.add_argument('--num_samples', default=10, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--timesteps', default=10, type=int)
+    parser.add_argument('--num_digits', default=3, type=int)
+    parser.add_argument('--tolerance', default=1e-3, type=float, help='largest fraction of pixels allowed to differ by rounding at a .5 boundary')
+    parser.add_argument('--device', default=0, type=int)
+    args = parser.parse_args()
+    CUDA = torch.cuda.is_available()
+    device = torch.device('cuda:%d' % args.device) if CUDA else None
+    AT = Affine_Transformer(args.frame_pixels, args.digit_pixels, CUDA, device)
+    dtof, ftod = parity(AT, args.num_samples, args.batch_size, args.timesteps, args.num_digits, CUDA, device, tolerance=args.tolerance)
+    print('mismatched pixels: digit_to_frame=%.2e, frame_to_digit=%.2e' % (dtof, ftod))
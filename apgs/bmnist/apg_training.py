@@ -6,9 +6,10 @@ from random import shuffle
 from apgs.bmnist.models import Enc_coor, Dec_coor, Enc_digit, Dec_digit
 from apgs.bmnist.objectives import apg_objective
 
-def train(optimizer, models, AT, resampler, num_sweeps, data_paths, mnist_mean, K, num_epochs, sample_size, batch_size, CUDA, device, model_version):
+def train(optimizer, models, AT, resampler, num_sweeps, data_paths, mnist_mean, K, num_epochs, sample_size, batch_size, CUDA, device, model_version, matcher=None):
     """
     training function of apg samplers
+    matcher : a Template_Matcher for propose_one_movement, None for the grouped conv2d
     """
     result_flags = {'loss_required' : True, 'ess_required' : True, 'mode_required' : False, 'density_required': True}
     mnist_mean = mnist_mean.repeat(sample_size, batch_size, K, 1, 1)
@@ -27,7 +28,7 @@ def train(optimizer, models, AT, resampler, num_sweeps, data_paths, mnist_mean,
                     with torch.cuda.device(device):
                         frames = frames.cuda()
                         mnist_mean = mnist_mean.cuda()
-                trace = apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mnist_mean)
+                trace = apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mnist_mean, matcher)
                 loss_phi = trace['loss_phi'].sum()
                 loss_theta = trace['loss_theta'].sum()
                 loss_phi.backward(retain_graph=True)
@@ -110,6 +111,7 @@ if __name__ == '__main__':
     import argparse
     from apgs.resampler import Resampler
     from apgs.bmnist.affine_transformer import Affine_Transformer
+    from apgs.bmnist.template_matcher import Template_Matcher
     parser = argparse.ArgumentParser('Bouncing MNIST')
     parser.add_argument('--data_dir', default='../../data/bmnist/')
     parser.add_argument('--device', default=1, type=int)
@@ -118,7 +120,9 @@ if __name__ == '__main__':
     parser.add_argument('--budget', default=100, type=int)
     parser.add_argument('--num_sweeps', default=5, type=int)
     parser.add_argument('--lr', default=1e-4, type=float)
-    parser.add_argument('--resample_strategy', default='systematic', choices=['systematic', 'multinomial'])
+    parser.add_argument('--resample_strategy', default='systematic', choices=Resampler.strategies)
+    parser.add_argument('--ess_threshold', default=None, type=float, help='only resample instances whose ESS / sample size is below this threshold')
+    parser.add_argument('--fused_resampling', action='store_true', help='run the inverse cdf and the gathers of the resampler as TorchScript kernels')
     parser.add_argument('--num_digits', default=3, type=int)
     parser.add_argument('--timesteps', default=10, type=int)
     parser.add_argument('--frame_pixels', default=96, type=int)
@@ -127,6 +131,7 @@ if __name__ == '__main__':
     parser.add_argument('--num_hidden_coor', default=400, type=int)
     parser.add_argument('--z_where_dim', default=2, type=int)
     parser.add_argument('--z_what_dim', default=10, type=int)
+    parser.add_argument('--template_matching', default='conv', choices=Template_Matcher.backends + ('auto',), help='backend of the template matching in propose_one_movement, conv is the grouped conv2d of the baseline, auto picks the fastest by a benchmark')
     args = parser.parse_args()
     sample_size = int(args.budget / args.num_sweeps)
     CUDA = torch.cuda.is_available()
@@ -143,8 +148,9 @@ if __name__ == '__main__':
         data_paths.append(os.path.join(args.data_dir, 'train', file))
     mnist_mean = torch.from_numpy(np.load('mnist_mean.npy')).float()
     AT = Affine_Transformer(args.frame_pixels, args.mnist_pixels, CUDA, device)
-    resampler = Resampler(args.resample_strategy, sample_size, CUDA, device)
+    matcher = None if args.template_matching == 'conv' else Template_Matcher(args.template_matching)
+    resampler = Resampler(args.resample_strategy, sample_size, CUDA, device, ess_threshold=args.ess_threshold, fused=args.fused_resampling)
     models, optimizer = init_models(args.frame_pixels, args.mnist_pixels, args.num_hidden_digit, args.num_hidden_coor, args.z_where_dim, args.z_what_dim, CUDA, device, load_version=None, lr=args.lr)
     print('Start training for bmnist tracking task..')
     print('version=' + model_version)  
-    train(optimizer, models, AT, resampler, args.num_sweeps, data_paths, mnist_mean, args.num_digits, args.num_epochs, sample_size, args.batch_size, CUDA, device, model_version)        
+    train(optimizer, models, AT, resampler, args.num_sweeps, data_paths, mnist_mean, args.num_digits, args.num_epochs, sample_size, args.batch_size, CUDA, device, model_version, matcher)        
@@ -10,7 +10,10 @@ from apgs.resampler import Resampler
 from apgs.bmnist.objectives import apg_objective, bpg_objective, hmc_objective
 from apgs.bmnist.hmc_sampler import HMC
 
-def density_all_instances(models, AT, data_paths, sample_size, K, z_where_dim, z_what_dim, num_sweeps, lf_step_size, lf_num_steps, bpg_factor, CUDA, device, batch_size=10):
+def density_all_instances(models, AT, data_paths, sample_size, K, z_where_dim, z_what_dim, num_sweeps, lf_step_size, lf_num_steps, bpg_factor, CUDA, device, batch_size=10, matcher=None):
+    """
+    matcher : a Template_Matcher used by all the methods, None for the grouped conv2d
+    """
     densities = dict()
     shuffle(data_paths)
     data = torch.from_numpy(np.load(data_paths[0])).float()
@@ -29,19 +32,19 @@ def density_all_instances(models, AT, data_paths, sample_size, K, z_where_dim, z
         result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : True}
         for lf in lf_num_steps:
             hmc_sampler = HMC(models, AT, S, B, T, K, z_where_dim, z_what_dim, num_sweeps, lf_step_size, lf_step_size, lf, CUDA, device)
-            trace_hmc = hmc_objective(models, AT, x, result_flags, hmc_sampler, mnist_mean) 
+            trace_hmc = hmc_objective(models, AT, x, result_flags, hmc_sampler, mnist_mean, matcher) 
             if 'HMC-RWS(L=%d, LF=%d)' % (S, lf) in densities:
                 densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)].append(trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1])
             else:
                 densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)] = [trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
         x_bpg = x.repeat(bpg_factor, 1, 1, 1, 1)
         mnist_mean_bpg = mnist_mean.repeat(bpg_factor, 1, 1, 1, 1)
-        trace_bpg = bpg_objective(models, AT, x_bpg, result_flags, num_sweeps, resampler_bpg, mnist_mean_bpg)
+        trace_bpg = bpg_objective(models, AT, x_bpg, result_flags, num_sweeps, resampler_bpg, mnist_mean_bpg, matcher)
         if 'BPG(L=%d)' % (S*bpg_factor) in densities:
             densities['BPG(L=%d)' % (S*bpg_factor)].append(trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
         else:
             densities['BPG(L=%d)' % (S*bpg_factor)] = [trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
-        trace_apg = apg_objective(models, AT, x, K, result_flags, num_sweeps, resampler, mnist_mean)
+        trace_apg = apg_objective(models, AT, x, K, result_flags, num_sweeps, resampler, mnist_mean, matcher)
         if 'APG(L=%d)' % S in densities:
             densities['APG(L=%d)' % S].append(trace_apg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
         else:
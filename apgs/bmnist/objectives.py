@@ -1,14 +1,18 @@
 import torch
 import torch.nn.functional as F
 from torch.distributions.normal import Normal
+from apgs.resampler import ParticleState
 
-def resample_variables(resampler, z_where, z_what, log_weights):
-    ancestral_index = resampler.sample_ancestral_index(log_weights)
-    z_where = resampler.resample_5dims(var=z_where, ancestral_index=ancestral_index)
-    z_what = resampler.resample_4dims(var=z_what, ancestral_index=ancestral_index)
-    return z_where, z_what
+def resample_variables(resampler, particles, log_weights):
+    """
+    select ancestors and record them in the particle state, the variables are gathered when they are next read
+    """
+    ancestral_index, log_w_carry = resampler.select_ancestors(log_weights)
+    if ancestral_index is not None:
+        particles.resample(ancestral_index)
+    return log_w_carry
 
-def apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mnist_mean):
+def apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mnist_mean, matcher=None):
     """
     Amortized Population Gibbs objective in Bouncing MNIST problem
     ==========
@@ -33,17 +37,23 @@ def apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mn
     conv2d usage https://pytorch.org/docs/1.3.0/nn.functional.html?highlight=conv2d#torch.nn.functional.conv2d
         images: 1 * (SB) * FP * FP, kernels: (SB) * 1 * DP * DP, groups=(SB)
         ===> convoved: 1 * (SB) * (FP-DP+1) * (FP-DP+1)
+    matcher : a Template_Matcher that replaces the grouped conv2d, None for conv2d
     ===========
     """
     trace = {'loss_phi' : [], 'loss_theta' : [], 'ess' : [], 'E_where' : [], 'E_what' : [], 'E_recon' : [], 'density' : []}
     S, B, T, FP, _ = frames.shape
     (enc_coor, dec_coor, enc_digit, dec_digit) = models
-    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags)
-    z_where, z_what = resample_variables(resampler, z_where, z_what, log_weights=log_w)
+    if matcher is not None:
+        matcher.bind(frames)
+    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags, matcher)
+    particles = ParticleState(resampler, z_where=z_where, z_what=z_what)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
-        z_where, trace = apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where, trace, result_flags)
-        log_w, z_what, trace = apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what, trace, result_flags)
-        z_where, z_what = resample_variables(resampler, z_where, z_what, log_weights=log_w)
+        z_where, z_what = particles.get('z_where', 'z_what')
+        particles['z_where'], particles['z_what'], log_w, trace = apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where, log_w, trace, result_flags, matcher)
+        z_where, z_what = particles.get('z_where', 'z_what')
+        log_w, particles['z_what'], trace = apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what, log_w, trace, result_flags)
+        log_w = resample_variables(resampler, particles, log_weights=log_w)
     if result_flags['loss_required']:
         trace['loss_phi'] = torch.cat(trace['loss_phi'], 0) 
         trace['loss_theta'] = torch.cat(trace['loss_theta'], 0) 
@@ -57,7 +67,10 @@ def apg_objective(models, AT, frames, K, result_flags, num_sweeps, resampler, mn
         trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def propose_one_movement(enc_coor, dec_coor, AT, frame, template, z_where_t_1, z_where_old_t, z_where_old_t_1):
+def propose_one_movement(enc_coor, dec_coor, AT, frame, template, z_where_t_1, z_where_old_t, z_where_old_t_1, matcher=None, t=None):
+    """
+    matcher : a Template_Matcher that replaces the grouped conv2d, t : the timestep of frame in the frames bound to it
+    """
     FP = frame.shape[-1]
     S, B, K, DP, _ = template.shape
     z_where = []
@@ -69,7 +82,11 @@ def propose_one_movement(enc_coor, dec_coor, AT, frame, template, z_where_t_1, z
     log_p_b = []
     for k in range(K):
         template_k = template[:,:,k,:,:]
-        conved_k = F.conv2d(frame_left.view(S*B, FP, FP).unsqueeze(0), template_k.view(S*B, DP, DP).unsqueeze(1), groups=int(S*B))
+        if matcher is None:
+            conved_k = F.conv2d(frame_left.view(S*B, FP, FP).unsqueeze(0), template_k.view(S*B, DP, DP).unsqueeze(1), groups=int(S*B))
+        else:
+            ## only the first digit is matched with the frame itself, the others with the residuals
+            conved_k = matcher.correlate(frame_left, template_k, t=t if k == 0 else None)
         CP = conved_k.shape[-1] # convolved output pixels ##  S * B * CP * CP
         conved_k = F.softmax(conved_k.squeeze(0).view(S, B, CP, CP).view(S, B, CP*CP), -1) ## S * B * 1639
         q_k_f = enc_coor.forward(conved=conved_k, sampled=True)
@@ -106,7 +123,7 @@ def propose_one_movement(enc_coor, dec_coor, AT, frame, template, z_where_t_1, z
     else:
         return log_p_f, log_q_f, z_where, E_where
 
-def oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, digit, trace, result_flags):
+def oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, digit, trace, result_flags, matcher=None):
     T = frames.shape[2]
     S, B, K, DP, DP = digit.shape
     z_where = []
@@ -120,7 +137,9 @@ def oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, digit, trace,
                                                                                       template=digit,
                                                                                       z_where_t_1=None,
                                                                                       z_where_old_t=None,
-                                                                                      z_where_old_t_1=None)
+                                                                                      z_where_old_t_1=None,
+                                                                                      matcher=matcher,
+                                                                                      t=t)
             log_p_where = log_p_where_t
             log_q_where = log_q_where_t
         else:
@@ -131,7 +150,9 @@ def oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, digit, trace,
                                                                                       template=digit,
                                                                                       z_where_t_1=z_where_t,
                                                                                       z_where_old_t=None,
-                                                                                      z_where_old_t_1=None)
+                                                                                      z_where_old_t_1=None,
+                                                                                      matcher=matcher,
+                                                                                      t=t)
         log_q_where = log_q_where + log_q_where_t
         log_p_where = log_p_where + log_p_where_t
         z_where.append(z_where_t.unsqueeze(2)) ## S * B * 1 * K * 2
@@ -164,36 +185,57 @@ def oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, digit, trace,
         trace['density'].append(log_p.unsqueeze(0).detach())
     return log_w, z_where, z_what, trace
 
-def apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where_old, trace, result_flags):
+def apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where_old, log_w_carry, trace, result_flags, matcher=None):
+    """
+    update z_where one timestep at a time, resampling after each timestep
+    log_w_carry : S * B log weights carried over from instances that were not resampled
+    ==========
+    the z_where prefix is not resampled at every timestep, instead z_where_t and the ancestral index
+    of each timestep are kept as back-pointers and the trajectories are reconstructed with one gather at the end.
+    lineage tracks which old trajectory each current particle descends from, for the backward kernels.
+    ==========
+    return the resampled z_where, z_what and the carried log weights
+    """
     T = frames.shape[2]
     template = dec_digit(frames=None, z_what=z_what, z_where=None, AT=None)
     S, B, K, DP, DP = template.shape
     E_where = []
     LOSS_phi = []
     LOSS_theta = []
-    ESS = []
     log_prior = 0.0
+    particles = ParticleState(resampler, z_what=z_what, template=template)
+    path = [] ## z_where_t as proposed at each timestep, S * B * K * 2
+    ancestral_indices = [] ## S * B ancestral index used after each timestep, None if not resampled
+    lineage = None
     for t in range(T):
         frame_t = frames[:,:,t, :,:]
+        z_where_old_t = z_where_old[:,:,max(t-1, 0):t+1,:,:] ## S * B * 1 * K * 2 at t=0, S * B * 2 * K * 2 otherwise
+        if lineage is not None:
+            z_where_old_t = resampler.resample((z_where_old_t,), lineage)[0]
         if t == 0:
+            z_what, template = particles.get('z_what', 'template')
             log_p_f, log_q_f, log_p_b, log_q_b, z_where_t, E_where_t = propose_one_movement(enc_coor=enc_coor,
                                                                                             dec_coor=dec_coor,
                                                                                             AT=AT,
                                                                                             frame=frame_t,
                                                                                             template=template,
                                                                                             z_where_t_1=None,
-                                                                                            z_where_old_t=z_where_old[:,:,t,:,:],
-                                                                                            z_where_old_t_1=None)
+                                                                                            z_where_old_t=z_where_old_t[:,:,-1,:,:],
+                                                                                            z_where_old_t_1=None,
+                                                                                            matcher=matcher,
+                                                                                            t=t)
         else:
-
+            z_what, template, z_where_t_1 = particles.get('z_what', 'template', 'z_where_t')
             log_p_f, log_q_f, log_p_b, log_q_b, z_where_t, E_where_t = propose_one_movement(enc_coor=enc_coor,
                                                                                             dec_coor=dec_coor,
                                                                                             AT=AT,
                                                                                             frame=frame_t,
                                                                                             template=template,
-                                                                                            z_where_t_1=z_where_t,
-                                                                                            z_where_old_t=z_where_old[:,:,t,:,:],
-                                                                                            z_where_old_t_1=z_where_old[:,:,t-1,:,:])
+                                                                                            z_where_t_1=z_where_t_1,
+                                                                                            z_where_old_t=z_where_old_t[:,:,-1,:,:],
+                                                                                            z_where_old_t_1=z_where_old_t[:,:,0,:,:],
+                                                                                            matcher=matcher,
+                                                                                            t=t)
 
         log_w_f = log_p_f - log_q_f
         log_w_b = log_p_b - log_q_b
@@ -202,14 +244,16 @@ def apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_wh
         if result_flags['mode_required']:
             E_where.append(E_where_t.unsqueeze(2)) ## S * B * 1 * K * 2
         _, ll_f, _ = dec_digit(frames=frame_t.unsqueeze(2), z_what=z_what, z_where=z_where_t.unsqueeze(2), AT=AT)
-        _, ll_b, _ = dec_digit(frames=frame_t.unsqueeze(2), z_what=z_what, z_where=z_where_old[:,:,t,:,:].unsqueeze(2), AT=AT)
-        log_w = (log_w_f - log_w_b  + ll_f.squeeze(-1) - ll_b.squeeze(-1)).detach()
+        _, ll_b, _ = dec_digit(frames=frame_t.unsqueeze(2), z_what=z_what, z_where=z_where_old_t[:,:,-1:,:,:], AT=AT)
+        log_w = (log_w_carry + log_w_f - log_w_b  + ll_f.squeeze(-1) - ll_b.squeeze(-1)).detach()
         w = F.softmax(log_w, 0).detach()
-        if t == 0:
-            z_where = z_where_t.unsqueeze(2) ## S * B * 1 * K * 2
-        else:
-            z_where = torch.cat((z_where, z_where_t.unsqueeze(2)), 2) ## S * B * t * K * 2
-        z_where, z_what = resample_variables(resampler, z_where, z_what, log_weights=log_w)
+        path.append(z_where_t)
+        particles['z_where_t'] = z_where_t
+        ancestral_index, log_w_carry = resampler.select_ancestors(log_w)
+        ancestral_indices.append(ancestral_index)
+        if ancestral_index is not None:
+            particles.resample(ancestral_index)
+            lineage = ancestral_index if lineage is None else torch.gather(lineage, 0, ancestral_index)
         if result_flags['loss_required']:
             LOSS_phi.append((w * (- log_q_f)).sum(0).mean().unsqueeze(-1))
             LOSS_theta.append((w * (- ll_f.squeeze(-1))).sum(0).mean().unsqueeze(-1))            
@@ -222,10 +266,15 @@ def apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_wh
         trace['E_where'].append(E_where.mean(0).unsqueeze(0).detach())
     if result_flags['density_required']:
         trace['density'].append(log_prior.unsqueeze(0).detach())
-    return z_where, trace
+    z_where = resampler.resample_path(path, ancestral_indices) ## S * B * T * K * 2
+    return z_where, particles['z_what'], log_w_carry, trace
 
 
-def apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what_old, trace, result_flags):
+def apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what_old, log_w_carry, trace, result_flags):
+    """
+    update z_what given z_where
+    log_w_carry : S * B log weights carried over from instances that were not resampled
+    """
     S, B, T, K, _ = z_where.shape
     cropped = AT.frame_to_digit(frames=frames, z_where=z_where)
     DP = cropped.shape[-1]
@@ -238,7 +287,7 @@ def apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what_old, trace, resul
     q_b = enc_digit(cropped, sampled=False, z_what_old=z_what_old)
     log_q_b  = q_b['z_what'].log_prob.sum(-1).sum(-1) # S * B
     log_p_b, ll_b, _ = dec_digit(frames=frames, z_what=z_what_old, z_where=z_where, AT=AT)
-    log_w = (ll_f.sum(-1) + log_p_f.sum(-1) - log_q_f - (ll_b.sum(-1) + log_p_b.sum(-1) - log_q_b)).detach()
+    log_w = (log_w_carry + ll_f.sum(-1) + log_p_f.sum(-1) - log_q_f - (ll_b.sum(-1) + log_p_b.sum(-1) - log_q_b)).detach()
     w = F.softmax(log_w, 0).detach()
     if result_flags['loss_required']:
         loss_phi = (w * (-log_q_f)).sum(0).mean()
@@ -257,35 +306,42 @@ def apg_what(enc_digit, dec_digit, AT, frames, z_where, z_what_old, trace, resul
     return log_w, z_what, trace
 
 
-def hmc_objective(models, AT, frames, result_flags, hmc_sampler, mnist_mean):
+def hmc_objective(models, AT, frames, result_flags, hmc_sampler, mnist_mean, matcher=None):
     """
     HMC objective
     """
     trace = {'density' : []} 
     S, B, T, FP, _ = frames.shape
     (enc_coor, dec_coor, enc_digit, dec_digit) = models
-    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags)
+    if matcher is not None:
+        matcher.bind(frames)
+    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags, matcher)
     trace = hmc_sampler.hmc_sampling(frames, z_where, z_what, trace)
     trace['density'] = torch.cat(trace['density'], 0)
     return trace
 
-def bpg_objective(models, AT, frames, result_flags, num_sweeps, resampler, mnist_mean):
+def bpg_objective(models, AT, frames, result_flags, num_sweeps, resampler, mnist_mean, matcher=None):
     """
     bpg objective
     """
     trace = {'density' : []} ## a dictionary that tracks things needed during the sweeping
     S, B, T, FP, _ = frames.shape
     (enc_coor, dec_coor, enc_digit, dec_digit) = models
-    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags)
-    z_where, z_what = resample_variables(resampler, z_where, z_what, log_weights=log_w)
+    if matcher is not None:
+        matcher.bind(frames)
+    log_w, z_where, z_what, trace = oneshot(enc_coor, dec_coor, enc_digit, dec_digit, AT, frames, mnist_mean, trace, result_flags, matcher)
+    particles = ParticleState(resampler, z_where=z_where, z_what=z_what)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
-        z_where, trace = apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where, trace, result_flags)
-        log_w, z_what, trace = bpg_what(dec_digit, AT, frames, z_where, z_what, trace)
-        z_where, z_what = resample_variables(resampler, z_where, z_what, log_weights=log_w)
+        z_where, z_what = particles.get('z_where', 'z_what')
+        particles['z_where'], particles['z_what'], log_w, trace = apg_where(enc_coor, dec_coor, dec_digit, AT, resampler, frames, z_what, z_where, log_w, trace, result_flags, matcher)
+        z_where, z_what = particles.get('z_where', 'z_what')
+        log_w, particles['z_what'], trace = bpg_what(dec_digit, AT, frames, z_where, z_what, log_w, trace)
+        log_w = resample_variables(resampler, particles, log_weights=log_w)
     trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def bpg_what(dec_digit, AT, frames, z_where, z_what_old, trace):
+def bpg_what(dec_digit, AT, frames, z_where, z_what_old, log_w_carry, trace):
     S, B, T, K, _ = z_where.shape
     z_what_dim = z_what_old.shape[-1]
     cropped = AT.frame_to_digit(frames=frames, z_where=z_where)
@@ -297,6 +353,6 @@ def bpg_what(dec_digit, AT, frames, z_where, z_what_old, trace):
     log_prior = log_p_f.sum(-1)
     ## backward
     _, ll_b, _ = dec_digit(frames=frames, z_what=z_what_old, z_where=z_where, AT=AT)
-    log_w = (ll_f.sum(-1) - ll_b.sum(-1)).detach()
+    log_w = (log_w_carry + ll_f.sum(-1) - ll_b.sum(-1)).detach()
     trace['density'][-1] = trace['density'][-1] + (ll_f.sum(-1) + log_prior).unsqueeze(0).detach()
     return log_w, z_what, trace
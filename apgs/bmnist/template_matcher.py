@@ -0,0 +1,144 @@
+import time
+import torch
+import torch.nn.functional as F
+try:
+    import torch.fft
+    HAS_FFT = hasattr(torch.fft, 'rfft2')
+except ImportError: ## torch.fft is a module since torch 1.8
+    HAS_FFT = False
+
+"""
+Template matching of the frames with the digit templates in propose_one_movement
+==========
+abbreviations:
+N -- number of frame-template pairs (S * B in propose_one_movement)
+FP -- square root of frame pixels
+DP -- square root of digit pixels
+CP -- square root of the matched pixels, FP - DP + 1
+==========
+all the backends compute the valid cross-correlation of F.conv2d
+    frames: N * FP * FP, templates: N * DP * DP ===> matched: N * CP * CP
+backends:
+    conv -- grouped F.conv2d with groups=N, the original implementation
+    fft -- (torch >= 1.8) products of rfft2 spectra, the spectra of the frames are cached by bind(frames),
+           so the frames of every timestep are transformed once per batch and reused by all the sweeps.
+           the FFT size is FP, correlations at the valid offsets do not wrap around
+    unfold -- F.unfold of the frames into N * (DP*DP) * (CP*CP) patches and one bmm with the templates,
+              fast for small N, its memory is DP*DP times the one of the frames
+    auto -- the fastest of the above for the shape of the first call, measured by benchmark
+==========
+"""
+class Template_Matcher():
+    backends = ('conv', 'fft', 'unfold') if HAS_FFT else ('conv', 'unfold')
+
+    def __init__(self, backend='conv', num_trials=3):
+        assert backend in self.backends + ('auto',), 'ERROR! unknown backend %s' % backend
+        self.backend = backend
+        self.num_trials = num_trials
+        self.choices = dict() ## (N, FP, DP, device) ===> fastest backend
+        self.frames = None
+        self.spectra = None
+
+    def bind(self, frames):
+        """
+        frames : S * B * T * FP * FP, the frames whose spectra are cached for the fft backend
+        """
+        if frames is not self.frames:
+            self.frames = frames
+            self.spectra = None
+
+    def frame_spectrum(self, t):
+        """
+        rfft2 of the bound frames at timestep t, S * B * FP * (FP/2+1)
+        """
+        if self.spectra is None:
+            self.spectra = torch.fft.rfft2(self.frames)
+        return self.spectra[:, :, t]
+
+    def conv(self, frames, templates):
+        N, FP, _ = frames.shape
+        return F.conv2d(frames.unsqueeze(0), templates.unsqueeze(1), groups=N).squeeze(0)
+
+    def fft(self, frames, templates, spectrum=None):
+        """
+        spectrum : the rfft2 of frames if cached, N * FP * (FP/2+1)
+        """
+        N, FP, _ = frames.shape
+        CP = FP - templates.shape[-1] + 1
+        if spectrum is None:
+            spectrum = torch.fft.rfft2(frames)
+        matched = torch.fft.irfft2(spectrum * torch.fft.rfft2(templates, s=(FP, FP)).conj(), s=(FP, FP))
+        return matched[:, :CP, :CP]
+
+    def unfold(self, frames, templates):
+        N, FP, _ = frames.shape
+        DP = templates.shape[-1]
+        CP = FP - DP + 1
+        patches = F.unfold(frames.unsqueeze(1), DP) ## N * (DP*DP) * (CP*CP)
+        return torch.bmm(templates.reshape(N, 1, DP*DP), patches).view(N, CP, CP)
+
+    def benchmark(self, N, FP, DP, device=None):
+        """
+        mean time in seconds of each backend on random frames and templates, with grads as in training
+        """
+        frames = torch.rand(N, FP, FP, device=device)
+        templates = torch.rand(N, DP, DP, device=device, requires_grad=True)
+        times = dict()
+        with torch.enable_grad():
+            for backend in self.backends:
+                try:
+                    for i in range(self.num_trials + 1):
+                        if i == 1: ## the first trial is a warm-up
+                            if frames.is_cuda:
+                                torch.cuda.synchronize(device)
+                            time_start = time.time()
+                        getattr(self, backend)(frames, templates).sum().backward()
+                    if frames.is_cuda:
+                        torch.cuda.synchronize(device)
+                    times[backend] = (time.time() - time_start) / self.num_trials
+                except RuntimeError: ## e.g. out of memory in unfold
+                    times[backend] = float('inf')
+        return times
+
+    def choose(self, frames, templates):
+        if self.backend != 'auto':
+            return self.backend
+        key = (frames.shape[0], frames.shape[-1], templates.shape[-1], frames.device)
+        if key not in self.choices:
+            times = self.benchmark(*key)
+            self.choices[key] = min(times, key=times.get)
+        return self.choices[key]
+
+    def correlate(self, frame, template, t=None):
+        """
+        frame : S * B * FP * FP, template : S * B * DP * DP
+        t : the timestep of frame in the bound frames if frame is one of them (not a residual), to reuse its spectrum
+        return the matched S * B * CP * CP
+        """
+        S, B, FP, _ = frame.shape
+        DP = template.shape[-1]
+        frames = frame.reshape(S*B, FP, FP)
+        templates = template.reshape(S*B, DP, DP)
+        backend = self.choose(frames, templates)
+        if backend == 'fft':
+            spectrum = None
+            if t is not None and self.frames is not None:
+                spectrum = self.frame_spectrum(t).reshape(S*B, FP, -1)
+            matched = self.fft(frames, templates, spectrum)
+        else:
+            matched = getattr(self, backend)(frames, templates)
+        return matched.view(S, B, FP-DP+1, FP-DP+1)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('Benchmark of the template matching backends')
+    parser.add_argument('--num_pairs', default=200, type=int, help='S * B')
+    parser.add_argument('--frame_pixels', default=96, type=int)
+    parser.add_argument('--digit_pixels', default=28, type=int)
+    parser.add_argument('--num_trials', default=3, type=int)
+    parser.add_argument('--device', default=0, type=int)
+    args = parser.parse_args()
+    device = torch.device('cuda:%d' % args.device) if torch.cuda.is_available() else None
+    times = Template_Matcher(num_trials=args.num_trials).benchmark(args.num_pairs, args.frame_pixels, args.digit_pixels, device)
+    for backend in Template_Matcher.backends:
+        print('backend=%s, time=%.2ems' % (backend, times[backend] * 1e3))
@@ -0,0 +1,68 @@
+import torch
+
+"""
+Batching of ragged datasets, i.e. instances with different numbers of points N_b
+==========
+BucketBatchSampler groups the instances of similar sizes, pad_batch pads a group to its largest size
+and returns the mask of the real points, which the objectives take as mask=...
+within a batch the padded size is at most (1 + max_padding) times the size of the smallest instance,
+so the padded points are a bounded fraction of the compute
+==========
+"""
+class BucketBatchSampler():
+    def __init__(self, sizes, batch_size, max_padding=0.1, shuffle=True, drop_last=False):
+        """
+        sizes : the number of points of every instance
+        max_padding : a batch is closed early when the next instance would exceed the smallest one by this ratio
+        """
+        self.sizes = torch.as_tensor(sizes)
+        self.batch_size = batch_size
+        self.max_padding = max_padding
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def batches(self):
+        """
+        the instances sorted by size (ties in random order if shuffle) and split into batches
+        """
+        if self.shuffle:
+            order = torch.randperm(len(self.sizes))
+        else:
+            order = torch.arange(len(self.sizes))
+        sizes = self.sizes.tolist()
+        ## the sort of python is stable, torch.sort(stable=True) needs torch >= 1.9
+        order = sorted(order.tolist(), key=lambda i: sizes[i])
+        batches = []
+        batch = []
+        for i in order:
+            if len(batch) == self.batch_size or (len(batch) > 0 and sizes[i] > (1 + self.max_padding) * sizes[batch[0]]):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if len(batch) > 0:
+            batches.append(batch)
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches())
+
+def pad_batch(instances):
+    """
+    instances : a list of N_b * ... tensors
+    return the batch B * N_max * ..., zero padded, and the mask B * N_max with 1 for the real points
+    """
+    N_max = max(instance.shape[0] for instance in instances)
+    batch = instances[0].new_zeros((len(instances), N_max) + tuple(instances[0].shape[1:]))
+    mask = instances[0].new_zeros((len(instances), N_max), dtype=torch.float)
+    for b, instance in enumerate(instances):
+        batch[b, :instance.shape[0]] = instance
+        mask[b, :instance.shape[0]] = 1.0
+    return batch, mask
@@ -0,0 +1,26 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+## checkpoint(..., use_reentrant=False) needs torch >= 1.11. the reentrant checkpoint of older versions
+## returns no grads for the parameters when no input requires grad (as for the observations),
+## so there the chunks run without checkpoint: the same grads, without the memory saving
+NON_REENTRANT_CHECKPOINT = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (1, 11)
+
+def chunked_sum(fn, tensors, chunk_size, dim=2):
+    """
+    sum of fn over chunks of chunk_size along dim (the N dim of S * B * N * ... variables)
+    fn : maps the chunks of tensors to a tuple of statistics that are additive over N
+    while grads are enabled every chunk runs under checkpoint, so its activations are recomputed in backward
+    instead of kept, and the memory of the statistics is O(chunk_size) rather than O(N).
+    the chunks are views, so tensors may be expanded (e.g. x.expand(S, ...)) instead of repeated
+    """
+    N = tensors[0].shape[dim]
+    totals = None
+    for start in range(0, N, chunk_size):
+        chunks = [var.narrow(dim, start, min(chunk_size, N - start)) for var in tensors]
+        if torch.is_grad_enabled() and NON_REENTRANT_CHECKPOINT:
+            stats = checkpoint(fn, *chunks, use_reentrant=False)
+        else:
+            stats = fn(*chunks)
+        totals = stats if totals is None else tuple(total + stat for total, stat in zip(totals, stats))
+    return totals
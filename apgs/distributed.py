@@ -0,0 +1,204 @@
+import os
+import torch
+import torch.distributed as dist
+from apgs.resampler import Resampler
+
+"""
+Particle-sharded population Gibbs with torch.distributed (gloo backend)
+==========
+the S particles of every instance are split into world_size shards of S / world_size particles,
+each process holds one shard of every variable, i.e. shard_S * B * ...
+resampling:
+    1. the log weights of all shards are all-gathered into S * B
+    2. rank 0 samples the global ancestral indices and broadcasts them
+    3. a particle whose ancestor lives on another shard is received point-to-point,
+       every distinct ancestor is sent once per pair of processes
+meant for evaluation with large S, the exchanged particles are detached from the autograd graph.
+run the objectives as usual with x of shape shard_S * B * ... and a DistributedResampler,
+then average the per-particle results over the shards with global_mean.
+==========
+"""
+def init_process(rank, world_size, master_addr='127.0.0.1', master_port='29500'):
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = master_port
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+def shard_size(sample_size, world_size):
+    assert sample_size % world_size == 0, "ERROR! sample size %d is not divisible by %d processes." % (sample_size, world_size)
+    return sample_size // world_size
+
+def all_gather_samples(var):
+    """
+    var : shard_S * B * ... ===> S * B * ..., the shards concatenated in rank order
+    """
+    shards = [torch.empty_like(var) for _ in range(dist.get_world_size())]
+    dist.all_gather(shards, var.contiguous())
+    return torch.cat(shards, 0)
+
+def global_mean(var, dim):
+    """
+    mean along the sample dim over the particles of all shards
+    """
+    total = var.sum(dim)
+    dist.all_reduce(total)
+    return total / (var.shape[dim] * dist.get_world_size())
+
+
+class DistributedResampler(Resampler):
+    composable = False ## the global indices refer to particles of other shards, so resample eagerly
+
+    def __init__(self, strategy, sample_size, CUDA, device, ess_threshold=None):
+        """
+        sample_size : the global number of particles S, each process holds S / world_size of them
+        """
+        assert not CUDA, "ERROR! the gloo backend exchanges particles between processes on cpu."
+        super(DistributedResampler, self).__init__(strategy, sample_size, CUDA, device, ess_threshold=ess_threshold)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.shard_S = shard_size(sample_size, self.world_size)
+
+    def select_ancestors(self, log_weights):
+        """
+        log_weights : shard_S * B
+        return the global S * B ancestral indices (None if no instance is resampled)
+        and the shard_S * B log weights carried into the next block
+        """
+        global_log_weights = all_gather_samples(log_weights)
+        flag = torch.zeros(1, dtype=torch.long)
+        ancestral_index = torch.empty(global_log_weights.shape, dtype=torch.long)
+        log_w_carry = torch.empty_like(global_log_weights)
+        if self.rank == 0:
+            index, carry = super(DistributedResampler, self).select_ancestors(global_log_weights)
+            if index is not None:
+                flag[0] = 1
+                ancestral_index = index.contiguous()
+            log_w_carry = carry.contiguous()
+        dist.broadcast(flag, 0)
+        dist.broadcast(log_w_carry, 0)
+        log_w_carry = log_w_carry[self.rank*self.shard_S : (self.rank+1)*self.shard_S]
+        if flag.item() == 0:
+            return None, log_w_carry
+        dist.broadcast(ancestral_index, 0)
+        return ancestral_index, log_w_carry
+
+    def source_rows(self, ancestral_index, rank):
+        """
+        for the shard of rank, the owner of each ancestor and its row in the owner's (shard_S*B) * -1 view,
+        both flattened over shard_S * B
+        """
+        shard_index = ancestral_index[rank*self.shard_S : (rank+1)*self.shard_S]
+        offsets = torch.arange(shard_index.shape[1])
+        return (shard_index // self.shard_S).reshape(-1), ((shard_index % self.shard_S) * shard_index.shape[1] + offsets).reshape(-1)
+
+    def resample(self, state, ancestral_index):
+        """
+        state : a dict or a tuple of shard_S * B * ... tensors, ancestral_index : global S * B
+        return the resampled shard in the same container type
+        """
+        values = list(state.values()) if isinstance(state, dict) else list(state)
+        flat_vars = [var.detach().reshape(self.shard_S * ancestral_index.shape[1], -1) for var in values]
+        owners, rows = self.source_rows(ancestral_index, self.rank)
+        own = (owners == self.rank).nonzero().squeeze(-1)
+        resampled = []
+        for flat_var in flat_vars:
+            out = torch.empty_like(flat_var)
+            out[own] = flat_var[rows[own]]
+            resampled.append(out)
+        requests = []
+        sent = [] ## keep the outgoing tensors alive until the sends complete
+        received = []
+        for peer in range(self.world_size):
+            if peer == self.rank:
+                continue
+            ## particles of this shard that descend from the peer's shard
+            incoming = (owners == peer).nonzero().squeeze(-1)
+            if incoming.shape[0] > 0:
+                unique_rows, inverse = torch.unique(rows[incoming], return_inverse=True)
+                for k, flat_var in enumerate(flat_vars):
+                    buffer = torch.empty((unique_rows.shape[0], flat_var.shape[1]), dtype=flat_var.dtype)
+                    requests.append(dist.irecv(buffer, src=peer, tag=k))
+                    received.append((k, incoming, inverse, buffer))
+            ## particles of the peer's shard that descend from this shard
+            peer_owners, peer_rows = self.source_rows(ancestral_index, peer)
+            outgoing = peer_rows[peer_owners == self.rank]
+            if outgoing.shape[0] > 0:
+                unique_rows = torch.unique(outgoing)
+                for k, flat_var in enumerate(flat_vars):
+                    message = flat_var[unique_rows].contiguous()
+                    requests.append(dist.isend(message, dst=peer, tag=k))
+                    sent.append(message)
+        for request in requests:
+            request.wait()
+        for k, incoming, inverse, buffer in received:
+            resampled[k][incoming] = buffer[inverse]
+        resampled = [out.view(var.shape) for out, var in zip(resampled, values)]
+        if isinstance(state, dict):
+            return dict(zip(state.keys(), resampled))
+        return tuple(resampled)
+
+    def resample_path(self, path, ancestral_indices):
+        """
+        path : list of T shard_S * B * ... tensors, ancestral_indices : list of T global S * B indices (or None)
+        return shard_S * B * T * ..., the trajectory that each particle of this shard descends from.
+        the back-pointers are global, so the lineages of the shard are traced back in global slots
+        and the trajectories of all the shards are all-gathered before one gather of the shard's rows
+        """
+        shard_S, batch_dim = path[0].shape[:2]
+        T = len(path)
+        lineage = (torch.arange(shard_S) + self.rank * shard_S).unsqueeze(-1).repeat(1, batch_dim)
+        lineages = [None] * T
+        for t in reversed(range(T)):
+            if ancestral_indices[t] is not None:
+                lineage = torch.gather(ancestral_indices[t], 0, lineage)
+            lineages[t] = lineage
+        lineages = torch.stack(lineages, 2) ## shard_S * B * T, global slots
+        offsets = torch.arange(batch_dim * T).view(batch_dim, T)
+        flat_index = (lineages * (batch_dim * T) + offsets).view(-1)
+        trajectories = all_gather_samples(torch.stack([step.detach() for step in path], 2)) ## S * B * T * ...
+        return trajectories.reshape(-1, trajectories[0, 0, 0].numel()).index_select(0, flat_index).view((shard_S,) + tuple(trajectories.shape[1:]))
+
+
+def density_gmm(rank, world_size, args):
+    """
+    log joint of the gmm APG sampler with args.sample_size particles sharded over world_size processes
+    """
+    import numpy as np
+    from apgs.gmm.apg_training import init_apg_models
+    from apgs.gmm.objectives import apg_objective
+    init_process(rank, world_size, master_port=args.master_port)
+    torch.manual_seed(args.seed + rank) ## every shard proposes different particles
+    models = init_apg_models(args.num_clusters, args.data_dim, args.num_hidden, False, None, load_version=args.load_version)
+    resampler = DistributedResampler(args.resample_strategy, args.sample_size, False, None, ess_threshold=args.ess_threshold)
+    data = torch.from_numpy(np.load(args.data_dir + 'ob.npy')).float()
+    result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : True}
+    num_batches = int(data.shape[0] / args.batch_size)
+    densities = []
+    for b in range(num_batches):
+        x = data[b*args.batch_size : (b+1)*args.batch_size].repeat(resampler.shard_S, 1, 1, 1)
+        with torch.no_grad():
+            trace = apg_objective(models, x, result_flags, args.num_sweeps, 'decomposed', resampler)
+        densities.append(global_mean(trace['density'], 1).mean(-1)) ## num_sweeps
+    if rank == 0:
+        densities = torch.stack(densities, 0).mean(0)
+        print('APG(L=%d) over %d processes, log joint per sweep: %s' % (args.sample_size, world_size, ', '.join(['%.2f' % d for d in densities.tolist()])))
+    dist.destroy_process_group()
+
+if __name__ == '__main__':
+    import argparse
+    import torch.multiprocessing as mp
+    parser = argparse.ArgumentParser('Particle-sharded APG evaluation in GMM')
+    parser.add_argument('--data_dir', default='../data/gmm/')
+    parser.add_argument('--load_version', required=True)
+    parser.add_argument('--world_size', default=4, type=int)
+    parser.add_argument('--master_port', default='29500')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--sample_size', default=1000, type=int, help='global number of particles, split over the processes')
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--num_sweeps', default=10, type=int)
+    parser.add_argument('--resample_strategy', default='systematic', choices=Resampler.strategies)
+    parser.add_argument('--ess_threshold', default=None, type=float)
+    parser.add_argument('--num_clusters', default=3, type=int)
+    parser.add_argument('--data_dim', default=2, type=int)
+    parser.add_argument('--num_hidden', default=32, type=int)
+    args = parser.parse_args()
+    mp.spawn(density_gmm, args=(args.world_size, args), nprocs=args.world_size)
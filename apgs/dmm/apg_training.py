@@ -3,6 +3,7 @@ import torch
 import time
 from apgs.dmm.models import Enc_rws_mu, Enc_apg_local, Enc_apg_mu, Decoder
 from apgs.dmm.objectives import apg_objective
+from apgs.bucketing import BucketBatchSampler, pad_batch
 
 def train(objective, optimizer, models, data, K, num_epochs, sample_size, batch_size, CUDA, device, **kwargs):
     """
@@ -53,6 +54,47 @@ def train(objective, optimizer, models, data, K, num_epochs, sample_size, batch_
         log_file.close()
         print("Epoch=%d / %d (%ds),  " % (epoch+1, num_epochs, time_end - time_start))
         
+def train_ragged(objective, optimizer, models, data, K, num_epochs, sample_size, batch_size, CUDA, device, max_padding=0.1, **kwargs):
+    """
+    training function of apg samplers on instances of different sizes
+    data : a list of N_b * D tensors, batched by BucketBatchSampler and padded with masks
+    """
+    result_flags = {'loss_required' : True, 'ess_required' : True, 'mode_required' : False, 'density_required': True}
+    sampler = BucketBatchSampler([instance.shape[0] for instance in data], batch_size, max_padding=max_padding)
+    for epoch in range(num_epochs):
+        time_start = time.time()
+        metrics = {'loss_phi' : 0.0, 'loss_theta' : 0.0, 'ess' : 0.0, 'density' : 0.0}
+        num_points, num_padded = 0, 0
+        for indices in sampler:
+            optimizer.zero_grad()
+            x, mask = pad_batch([data[i][torch.randperm(data[i].shape[0])] for i in indices])
+            x = x.repeat(sample_size, 1, 1, 1)
+            mask = mask.repeat(sample_size, 1, 1)
+            num_points += mask[0].sum().item()
+            num_padded += mask[0].numel()
+            if CUDA:
+                x = x.cuda().to(device)
+                mask = mask.cuda().to(device)
+            trace = objective(models, x, K, result_flags, mask=mask, **kwargs)
+            loss_phi = trace['loss_phi'].sum()
+            loss_theta = trace['loss_theta'][-1] * kwargs['num_sweeps']
+            loss_phi.backward(retain_graph=True)
+            loss_theta.backward()
+            optimizer.step()
+            metrics['loss_phi'] += trace['loss_phi'][-1].item()
+            metrics['loss_theta'] += trace['loss_theta'][-1].item()
+            metrics['ess'] += trace['ess'][-1].mean().item()
+            metrics['density'] += trace['density'][-1].mean().item()
+        save_apg_models(models, model_version)
+        metrics_print = ",  ".join(['%s: %.4f' % (k, v/len(sampler)) for k, v in metrics.items()])
+        if not os.path.exists('results/'):
+            os.makedirs('results/')
+        log_file = open('results/log-' + model_version + '.txt', 'a+')
+        time_end = time.time()
+        print(metrics_print, file=log_file)
+        log_file.close()
+        print("Epoch=%d / %d (%ds), padding=%.1f%%" % (epoch+1, num_epochs, time_end - time_start, 100 * (1 - num_points / num_padded)))
+
 def shuffler(data):
     """
     shuffle the DMM datasets by both permuting the order of GMM instances (w.r.t. DIM1) and permuting the order of data points in each instance (w.r.t. DIM2)
@@ -64,13 +106,15 @@ def shuffler(data):
     data = torch.gather(data, 1, indices_DIM2.unsqueeze(-1).repeat(1, 1, DIM3))
     return data
 
-def init_apg_models(K, D, num_hidden_mu, num_nss, num_hidden_local, num_hidden_dec, recon_sigma, CUDA, device, load_version=None, lr=None):
+def init_apg_models(K, D, num_hidden_mu, num_nss, num_hidden_local, num_hidden_dec, recon_sigma, CUDA, device, load_version=None, lr=None, integer_labels=False, chunk_size=None):
     """
     initialization function for APG samplers
+    integer_labels : keep the cluster assignments z as integer labels instead of one-hot vectors
+    chunk_size : accumulate the pooled statistics of the mu encoders over chunks of chunk_size points
     """
-    enc_rws_mu = Enc_rws_mu(K, D, num_hidden_mu, num_nss)
-    enc_apg_local = Enc_apg_local(K, D, num_hidden_local)
-    enc_apg_mu = Enc_apg_mu(K, D, num_hidden_mu, num_nss)
+    enc_rws_mu = Enc_rws_mu(K, D, num_hidden_mu, num_nss, chunk_size=chunk_size)
+    enc_apg_local = Enc_apg_local(K, D, num_hidden_local, integer_labels=integer_labels)
+    enc_apg_mu = Enc_apg_mu(K, D, num_hidden_mu, num_nss, chunk_size=chunk_size)
     dec = Decoder(K, D, num_hidden_dec, recon_sigma, CUDA, device)
     if CUDA:
         with torch.cuda.device(device):
@@ -171,7 +215,14 @@ if __name__ == '__main__':
     parser.add_argument('--budget', default=70, type=int)
     parser.add_argument('--num_sweeps', default=7, type=int)
     parser.add_argument('--lr', default=5e-4, type=float)
-    parser.add_argument('--resample_strategy', default='systematic', choices=['systematic', 'multinomial'])
+    parser.add_argument('--resample_strategy', default='systematic', choices=Resampler.strategies)
+    parser.add_argument('--ess_threshold', default=None, type=float, help='only resample instances whose ESS / sample size is below this threshold')
+    parser.add_argument('--integer_labels', action='store_true', help='keep the cluster assignments as integer labels instead of one-hot vectors')
+    parser.add_argument('--fused_resampling', action='store_true', help='run the inverse cdf and the gathers of the resampler as TorchScript kernels')
+    parser.add_argument('--chunk_size', default=None, type=int, help='accumulate the pooled statistics of the mu encoders over chunks of this many points')
+    parser.add_argument('--sharded', action='store_true', help='load the float32 shards written by sim_dmm.py --shard_size')
+    parser.add_argument('--ragged', action='store_true', help='ob.npy holds an array of instances with different numbers of points')
+    parser.add_argument('--max_padding', default=0.1, type=float, help='bound on the padding of a batch of ragged instances, relative to its smallest instance')
     parser.add_argument('--num_clusters', default=4, type=int)
     parser.add_argument('--data_dim', default=2, type=int)
     parser.add_argument('--num_hidden_mu', default=32, type=int)
@@ -184,9 +235,16 @@ if __name__ == '__main__':
     CUDA = torch.cuda.is_available()
     device = torch.device('cuda:%d' % args.device)
 
-    data = torch.from_numpy(np.load(args.data_dir + 'ob.npy')).float() 
+    if args.sharded:
+        from apgs.dmm.sim_dmm import load_shards
+        data = torch.from_numpy(load_shards(args.data_dir))
+    elif args.ragged:
+        data = [torch.from_numpy(instance).float() for instance in np.load(args.data_dir + 'ob.npy', allow_pickle=True)]
+    else:
+        data = torch.from_numpy(np.load(args.data_dir + 'ob.npy')).float() 
     print('Start training for dmm clustering task..')
     if args.num_sweeps == 1: ## rws method
+        assert not args.ragged, 'ERROR! --ragged is only supported by the apg samplers, set num_sweeps > 1.'
         model_version = 'rws-dmm-num_samples=%s' % (sample_size)
         print('version='+ model_version)
         models, optimizer = init_rws_models(args.num_clusters, args.data_dim, args.num_hidden_mu, args.num_nss, args.num_hidden_local, args.num_hidden_dec, args.recon_sigma, CUDA, device, load_version=None, lr=args.lr)
@@ -195,9 +253,12 @@ if __name__ == '__main__':
     elif args.num_sweeps > 1: ## apg sampler
         model_version = 'apg-dmm-num_sweeps=%s-num_samples=%s' % (args.num_sweeps, sample_size)
         print('version=' + model_version)
-        models, optimizer = init_apg_models(args.num_clusters, args.data_dim, args.num_hidden_mu, args.num_nss, args.num_hidden_local, args.num_hidden_dec, args.recon_sigma, CUDA, device, load_version=None, lr=args.lr)
-        resampler = Resampler(args.resample_strategy, sample_size, CUDA, device)
-        train(apg_objective, optimizer, models, data, args.num_clusters, args.num_epochs, sample_size, args.batch_size, CUDA, device, num_sweeps=args.num_sweeps, resampler=resampler)
+        models, optimizer = init_apg_models(args.num_clusters, args.data_dim, args.num_hidden_mu, args.num_nss, args.num_hidden_local, args.num_hidden_dec, args.recon_sigma, CUDA, device, load_version=None, lr=args.lr, integer_labels=args.integer_labels, chunk_size=args.chunk_size)
+        resampler = Resampler(args.resample_strategy, sample_size, CUDA, device, ess_threshold=args.ess_threshold, fused=args.fused_resampling)
+        if args.ragged:
+            train_ragged(apg_objective, optimizer, models, data, args.num_clusters, args.num_epochs, sample_size, args.batch_size, CUDA, device, max_padding=args.max_padding, num_sweeps=args.num_sweeps, resampler=resampler)
+        else:
+            train(apg_objective, optimizer, models, data, args.num_clusters, args.num_epochs, sample_size, args.batch_size, CUDA, device, num_sweeps=args.num_sweeps, resampler=resampler)
         
     else:
         raise ValueError
@@ -8,39 +8,48 @@ from apgs.dmm.hmc_sampler import HMC
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
     
-def density_all_instances(models, data, sample_size, K, num_sweeps, lf_step_size, lf_num_steps, bpg_factor, CUDA, device, batch_size=100):
+def density_all_instances(models, data, sample_size, K, num_sweeps, lf_step_size, lf_num_steps, bpg_factor, CUDA, device, batch_size=100, offset_grid_size=4096):
+    """
+    offset_grid_size : the decoder evaluates the offsets by interpolation on a grid of this size (None for the MLP)
+    """
     densities = dict()
     num_batches = int(data.shape[0] / batch_size)
     (_, enc_local, _, dec) = models
-    for b in range(num_batches):
-        time_start = time.time()
-        x = data[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
-        if CUDA:
-            x = x.cuda().to(device)            
-        S, B, N, D = x.shape
-        resampler = Resampler('systematic', S, CUDA, device)
-        resampler_bpg = Resampler('systematic', S*bpg_factor, CUDA, device)
-        result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : True}
-        for lf in lf_num_steps:
-            hmc_sampler = HMC(enc_local, dec, S, B, N, K, D, num_sweeps, lf_step_size, lf, CUDA, device)
-            trace_hmc = hmc_objective(models, x, K, result_flags, hmc_sampler) 
-            if 'HMC-RWS(L=%d, LF=%d)' % (S, lf) in densities:
-                densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)].append(trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1])
+    grid_size = dec.grid_size
+    dec.use_offset_grid(offset_grid_size)
+    try:
+        for b in range(num_batches):
+            time_start = time.time()
+            x = data[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
+            if CUDA:
+                x = x.cuda().to(device)            
+            S, B, N, D = x.shape
+            resampler = Resampler('systematic', S, CUDA, device)
+            resampler_bpg = Resampler('systematic', S*bpg_factor, CUDA, device)
+            result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : True}
+            for lf in lf_num_steps:
+                hmc_sampler = HMC(enc_local, dec, S, B, N, K, D, num_sweeps, lf_step_size, lf, CUDA, device)
+                trace_hmc = hmc_objective(models, x, K, result_flags, hmc_sampler) 
+                if 'HMC-RWS(L=%d, LF=%d)' % (S, lf) in densities:
+                    densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)].append(trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1])
+                else:
+                    densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)] = [trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
+            x_bpg = x.repeat(bpg_factor, 1, 1, 1)
+            trace_bpg = bpg_objective(models, x_bpg, K, result_flags, num_sweeps, resampler_bpg)
+            if 'BPG(L=%d)' % (S*bpg_factor) in densities:
+                densities['BPG(L=%d)' % (S*bpg_factor)].append(trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
+            else:
+                densities['BPG(L=%d)' % (S*bpg_factor)] = [trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
+            trace_apg = apg_objective(models, x, K, result_flags, num_sweeps, resampler)
+            if 'APG(L=%d)' % S in densities:
+                densities['APG(L=%d)' % S].append(trace_apg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
             else:
-                densities['HMC-RWS(L=%d, LF=%d)' % (S, lf)] = [trace_hmc['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
-        x_bpg = x.repeat(bpg_factor, 1, 1, 1)
-        trace_bpg = bpg_objective(models, x_bpg, K, result_flags, num_sweeps, resampler_bpg)
-        if 'BPG(L=%d)' % (S*bpg_factor) in densities:
-            densities['BPG(L=%d)' % (S*bpg_factor)].append(trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
-        else:
-            densities['BPG(L=%d)' % (S*bpg_factor)] = [trace_bpg['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
-        trace_apg = apg_objective(models, x, K, result_flags, num_sweeps, resampler)
-        if 'APG(L=%d)' % S in densities:
-            densities['APG(L=%d)' % S].append(trace_apg['density'].mean(-1).mean(-1).cpu().numpy()[-1])
-        else:
-            densities['APG(L=%d)' % S] = [trace_apg['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
-        time_end = time.time()
-        print('%d / %d completed in (%ds)' % (b+1, num_batches, time_end - time_start))
+                densities['APG(L=%d)' % S] = [trace_apg['density'].mean(-1).mean(-1).cpu().numpy()[-1]]
+            time_end = time.time()
+            print('%d / %d completed in (%ds)' % (b+1, num_batches, time_end - time_start))
+    finally:
+        ## restore the decoder even if an objective raises, the grid mode sends no grads to recon_mu
+        dec.use_offset_grid(grid_size)
     for key in densities.keys():
         densities[key] = np.array(densities[key]).mean()
         print('method=%s, log joint=%.2f' % (key, densities[key]))
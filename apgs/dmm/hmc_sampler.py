@@ -5,6 +5,7 @@ from torch.distributions.uniform import Uniform
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
 from torch.distributions.beta import Beta
 import math
+from apgs.dmm.models import assignment_dist
 
 
 class HMC():
@@ -67,7 +68,7 @@ class HMC():
         p = self.dec.forward(x, mu=mu, z=z, beta=beta)
         ll = p['likelihood'].log_prob.sum(-1).sum(-1)
         log_prior_mu = Normal(self.dec.prior_mu_mu, self.dec.prior_mu_sigma).log_prob(mu).sum(-1).sum(-1)
-        log_prior_z = cat(probs=self.dec.prior_pi).log_prob(z).sum(-1)
+        log_prior_z = assignment_dist(z)(probs=self.dec.prior_pi).log_prob(z).sum(-1)
         log_prior_beta = Beta(self.dec.prior_con1, self.dec.prior_con0).log_prob(beta).sum(-1).sum(-1)
         return ll + log_prior_mu + log_prior_z + log_prior_beta
 
@@ -5,11 +5,74 @@ import torch.nn.functional as F
 from torch.distributions.normal import Normal
 from torch.distributions.beta import Beta
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
+from torch.distributions.categorical import Categorical
+from apgs.chunking import chunked_sum
 import probtorch
 
+def sample_labels(probs):
+    """
+    Gumbel-max sampling of integer labels S * B * N from probabilities S * B * N * K,
+    stored as uint8 (int16 if K > 256) instead of one-hot float vectors
+    """
+    gumbels = - torch.log(- torch.log(torch.rand_like(probs).clamp(min=1e-20)))
+    labels = (probs.log() + gumbels).argmax(-1)
+    return labels.to(torch.uint8 if probs.shape[-1] <= 256 else torch.int16)
+
+def assignment_dist(z):
+    """
+    distribution class of the cluster assignments z: OneHotCategorical for one-hot vectors, Categorical for integer labels
+    """
+    return cat if z.dtype.is_floating_point else Categorical
+
+def labels_of(z):
+    """
+    integer labels of the cluster assignments z, S * B * N
+    """
+    return z.argmax(-1) if z.dtype.is_floating_point else z.long()
+
+def masked(log_prob, mask):
+    """
+    log_prob : S * B * N pointwise log densities, with those of the padded points (mask = 0) set to 0
+    """
+    if mask is None:
+        return log_prob
+    return torch.where(mask > 0, log_prob, torch.zeros_like(log_prob))
+
+def ob_z_linear(linear, ob, z):
+    """
+    linear applied to torch.cat((ob, z), -1) without building the concatenation:
+    W_ob * ob + b, plus the z part as a lookup of the columns of W_z if z holds integer labels (S * B * N),
+    or as a dense product if z is one-hot / soft (S * B * N * K)
+    """
+    D = ob.shape[-1]
+    out = F.linear(ob, linear.weight[:, :D], linear.bias)
+    if z.dtype.is_floating_point:
+        return out + F.linear(z, linear.weight[:, D:])
+    return out + F.embedding(z.long(), linear.weight[:, D:].t())
+
+def nss_prior_linear(linear, nss, prior_mu, prior_sigma):
+    """
+    linear applied to torch.cat((nss, prior_mu.repeat(S, B, K, 1), prior_sigma.repeat(S, B, K, 1)), -1)
+    without the repeats: the prior part W_prior * (prior_mu, prior_sigma) + b is one vector, broadcast over S * B * K
+    """
+    num_nss = nss.shape[-1]
+    return F.linear(nss, linear.weight[:, :num_nss]) + F.linear(torch.cat((prior_mu, prior_sigma), -1), linear.weight[:, num_nss:], linear.bias)
+
+def pool_nss(nss1, nss2):
+    """
+    nss1 : S * B * N * num_nss, nss2 : S * B * N * K soft assignments
+    return the sums over N of nss2^T nss1, S * B * K * num_nss, by a batched matmul,
+    and of nss2, S * B * K * 1
+    """
+    return torch.einsum('sbnk,sbnh->sbkh', nss2, nss1), nss2.sum(2).unsqueeze(-1)
+
 class Enc_rws_mu(nn.Module):
-    def __init__(self, K, D, num_hidden, num_nss):
+    def __init__(self, K, D, num_hidden, num_nss, chunk_size=None):
+        """
+        chunk_size : if given, the pooled statistics are accumulated over chunks of chunk_size points along N
+        """
         super(self.__class__, self).__init__()
+        self.chunk_size = chunk_size
         self.nss1 = nn.Sequential(
             nn.Linear(D, num_hidden),
             nn.Tanh(),
@@ -31,16 +94,30 @@ class Enc_rws_mu(nn.Module):
             nn.Tanh(),
             nn.Linear(num_hidden, D))
 
-    def forward(self, ob, K, priors, sampled=True, mu_old=None, EPS=1e-8):
+    def pooled_stats(self, ob, mask=None):
+        """
+        sums over N of the nss1 weighted by the soft assignments nss2 (S * B * K * num_nss), and of nss2 (S * B * K * 1)
+        mask : S * B * N, the padded points get weight 0
+        """
+        nss2 = self.nss2(ob)
+        if mask is not None:
+            nss2 = nss2 * mask.unsqueeze(-1)
+        return pool_nss(self.nss1(ob), nss2)
+
+    def forward(self, ob, K, priors, sampled=True, mu_old=None, EPS=1e-8, mask=None):
+        """
+        mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances
+        """
         q = probtorch.Trace()
-        S, B, N, D = ob.shape
         (prior_mu, prior_sigma) = priors
-        nss1 = self.nss1(ob).unsqueeze(-1).repeat(1, 1, 1, 1, K).transpose(-1, -2)
-        nss2 = self.nss2(ob).unsqueeze(-1).repeat(1, 1, 1, 1, nss1.shape[-1])
-        nss = (nss1 * nss2).sum(2) / (nss2.sum(2) + EPS)
-        nss_prior = torch.cat((nss, prior_mu.repeat(S, B, K, 1), prior_sigma.repeat(S, B, K, 1)), -1)
-        q_mu_mu= self.mean_mu(nss_prior)
-        q_mu_sigma = self.mean_log_sigma(nss_prior).exp()
+        if self.chunk_size is None:
+            weighted_nss, weights = self.pooled_stats(ob, mask)
+        else:
+            weighted_nss, weights = chunked_sum(self.pooled_stats, (ob,) if mask is None else (ob, mask), self.chunk_size)
+        nss = weighted_nss / (weights + EPS)
+        ## the first layers act on the concatenation of the nss and the priors
+        q_mu_mu= self.mean_mu[1:](nss_prior_linear(self.mean_mu[0], nss, prior_mu, prior_sigma))
+        q_mu_sigma = self.mean_log_sigma[1:](nss_prior_linear(self.mean_log_sigma[0], nss, prior_mu, prior_sigma)).exp()
         if sampled:
             mu = Normal(q_mu_mu, q_mu_sigma).sample()
             q.normal(q_mu_mu,
@@ -55,8 +132,12 @@ class Enc_rws_mu(nn.Module):
         return q
     
 class Enc_apg_local(nn.Module):
-    def __init__(self, K, D, num_hidden):
+    def __init__(self, K, D, num_hidden, integer_labels=False):
+        """
+        integer_labels : if True, sample z as integer labels S * B * N instead of one-hot vectors S * B * N * K
+        """
         super(self.__class__, self).__init__()
+        self.integer_labels = integer_labels
 
         self.pi_log_prob = nn.Sequential(
             nn.Linear(D, num_hidden),
@@ -73,33 +154,44 @@ class Enc_apg_local(nn.Module):
             nn.Tanh(),
             nn.Linear(num_hidden, 1))
 
+    def assignment_logits(self, ob, mu):
+        """
+        pi_log_prob of every difference ob_n - mu_k, S * B * N * K
+        the first layer is linear, W(x - mu) + b = (Wx + b) - W mu, so the projections of the points and of the clusters
+        are broadcast against each other and the S * B * N * K * D differences are never built
+        """
+        linear = self.pi_log_prob[0]
+        hidden = F.linear(ob, linear.weight, linear.bias).unsqueeze(-2) - F.linear(mu, linear.weight).unsqueeze(-3)
+        return self.pi_log_prob[1:](hidden).squeeze(-1)
+
+    def angle_concentrations(self, ob, mu, z):
+        """
+        the two concentrations of the Beta proposal of the angles, given the cluster z_n of every point
+        """
+        ob_mu = ob - torch.gather(mu, -2, labels_of(z).unsqueeze(-1).expand(-1, -1, -1, ob.shape[-1]))
+        return self.angle_log_con1(ob_mu).exp(), self.angle_log_con0(ob_mu).exp()
+
     def forward(self, ob, mu, K, sampled=True, z_old=None, beta_old=None):
         q = probtorch.Trace()
-        S, B, N, D = ob.shape
-        ob_mu = ob.unsqueeze(2).repeat(1, 1, K, 1, 1) - mu.unsqueeze(-2).repeat(1, 1, 1, N, 1)
-        q_probs = F.softmax(self.pi_log_prob(ob_mu).squeeze(-1).transpose(-1, -2), -1)
+        q_probs = F.softmax(self.assignment_logits(ob, mu), -1)
         if sampled:
-            z = cat(q_probs).sample()
-            _ = q.variable(cat,
+            z = sample_labels(q_probs) if self.integer_labels else cat(q_probs).sample()
+            _ = q.variable(assignment_dist(z),
                            probs=q_probs,
                            value=z,
                            name='states')
-            mu_expand = torch.gather(mu, -2, z.argmax(-1).unsqueeze(-1).repeat(1, 1, 1, D))
-            q_angle_con1 = self.angle_log_con1(ob - mu_expand).exp()
-            q_angle_con0 = self.angle_log_con0(ob - mu_expand).exp()
+            q_angle_con1, q_angle_con0 = self.angle_concentrations(ob, mu, z)
             beta = Beta(q_angle_con1, q_angle_con0).sample()
             q.beta(q_angle_con1,
                    q_angle_con0,
                    value=beta,
                    name='angles')
         else:
-            _ = q.variable(cat,
+            _ = q.variable(assignment_dist(z_old),
                            probs=q_probs,
                            value=z_old,
                            name='states')
-            mu_expand = torch.gather(mu, -2, z_old.argmax(-1).unsqueeze(-1).repeat(1, 1, 1, D))
-            q_angle_con1 = self.angle_log_con1(ob - mu_expand).exp()
-            q_angle_con0 = self.angle_log_con0(ob - mu_expand).exp()
+            q_angle_con1, q_angle_con0 = self.angle_concentrations(ob, mu, z_old)
             q.beta(q_angle_con1,
                    q_angle_con0,
                    value=beta_old,
@@ -107,8 +199,12 @@ class Enc_apg_local(nn.Module):
         return q
 
 class Enc_apg_mu(nn.Module):
-    def __init__(self, K, D, num_hidden, num_nss):
+    def __init__(self, K, D, num_hidden, num_nss, chunk_size=None):
+        """
+        chunk_size : if given, the pooled statistics are accumulated over chunks of chunk_size points along N
+        """
         super(self.__class__, self).__init__()
+        self.chunk_size = chunk_size
         self.nss1 = nn.Sequential(
             nn.Linear(D+K, num_hidden),
             nn.Tanh(),
@@ -127,16 +223,36 @@ class Enc_apg_mu(nn.Module):
             nn.Tanh(),
             nn.Linear(num_hidden, D))
 
-    def forward(self, ob, z, beta, K, priors, sampled=True, mu_old=None, EPS=1e-8):
+    def pooled_stats(self, ob, z, mask=None):
+        """
+        sums over N of the nss1 weighted by the soft assignments nss2 (S * B * K * num_nss), and of nss2 (S * B * K * 1)
+        mask : S * B * N, the padded points get weight 0
+        """
+        ## the first layers act on the concatenation of observations and cluster assignments
+        nss1 = self.nss1[1:](ob_z_linear(self.nss1[0], ob, z))
+        nss2 = self.nss2[1:](ob_z_linear(self.nss2[0], ob, z))
+        if mask is not None:
+            nss2 = nss2 * mask.unsqueeze(-1)
+        return pool_nss(nss1, nss2)
+
+    def forward(self, ob, z, beta, K, priors, sampled=True, mu_old=None, EPS=1e-8, stats=None, mask=None):
+        """
+        z : one-hot cluster assignments S * B * N * K, or integer labels S * B * N
+        stats : if given, the (weighted_nss, weights) of self.pooled_stats summed over the points, then ob and z are not used
+        mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances
+        """
         q = probtorch.Trace()
-        S, B, N, D = ob.shape
         (prior_mu, prior_sigma) = priors
-        nss1 = self.nss1(torch.cat((ob, z), -1)).unsqueeze(-1).repeat(1, 1, 1, 1, K).transpose(-1, -2)
-        nss2 = self.nss2(torch.cat((ob, z), -1)).unsqueeze(-1).repeat(1, 1, 1, 1, nss1.shape[-1])
-        nss = (nss1 * nss2).sum(2) / (nss2.sum(2) + EPS)
-        nss_prior = torch.cat((nss, prior_mu.repeat(S, B, K, 1), prior_sigma.repeat(S, B, K, 1)), -1)
-        q_mu_mu= self.mean_mu(nss_prior)
-        q_mu_sigma = self.mean_log_sigma(nss_prior).exp()
+        if stats is not None:
+            weighted_nss, weights = stats
+        elif self.chunk_size is None:
+            weighted_nss, weights = self.pooled_stats(ob, z, mask)
+        else:
+            weighted_nss, weights = chunked_sum(self.pooled_stats, (ob, z) if mask is None else (ob, z, mask), self.chunk_size)
+        nss = weighted_nss / (weights + EPS)
+        ## the first layers act on the concatenation of the nss and the priors
+        q_mu_mu= self.mean_mu[1:](nss_prior_linear(self.mean_mu[0], nss, prior_mu, prior_sigma))
+        q_mu_sigma = self.mean_log_sigma[1:](nss_prior_linear(self.mean_log_sigma[0], nss, prior_mu, prior_sigma)).exp()
         if sampled:
             mu = Normal(q_mu_mu, q_mu_sigma).sample()
             q.normal(q_mu_mu,
@@ -182,6 +298,54 @@ class Decoder(nn.Module):
 
 
         self.radi = nn.Parameter(self.radi)
+        ## lookup grid of the offset directions, see use_offset_grid
+        self.grid_size = None
+        self.grid = None
+        self.grid_key = None
+
+    def use_offset_grid(self, grid_size=4096):
+        """
+        inference mode for a frozen decoder: the map beta -> unit offset direction is a fixed curve on [0, 1],
+        which is tabulated on grid_size + 1 angles and evaluated by linear interpolation instead of the recon_mu MLP.
+        the grid is rebuilt whenever the weights of recon_mu change (in-place updates, load_state_dict, moving devices),
+        no grads flow to recon_mu through it. grid_size=None turns the mode off
+        """
+        self.grid_size = grid_size
+        self.grid = None
+        self.grid_key = None
+
+    def direction(self, beta):
+        """
+        unit direction of the offset at the angles beta, S * B * N * D
+        """
+        hidden = self.recon_mu(beta * 2 * math.pi)
+        return hidden / (hidden**2).sum(-1).unsqueeze(-1).sqrt()
+
+    def offset_grid(self):
+        """
+        the directions on the angles 0, 1 / grid_size, ..., 1, (grid_size + 1) * D
+        """
+        key = tuple((param.data_ptr(), param._version) for param in self.recon_mu.parameters())
+        if self.grid is None or self.grid_key != key:
+            weight = self.recon_mu[0].weight
+            with torch.no_grad():
+                angles = torch.linspace(0, 1, self.grid_size + 1, dtype=weight.dtype, device=weight.device)
+                self.grid = self.direction(angles.unsqueeze(-1))
+            self.grid_key = key
+        return self.grid
+
+    def offset(self, beta):
+        """
+        displacement of the points from their cluster mean, on the circle of radius radi, S * B * N * D
+        """
+        if self.grid_size is None:
+            return self.direction(beta) * self.radi
+        grid = self.offset_grid()
+        position = beta.squeeze(-1).clamp(0, 1) * self.grid_size
+        index = position.detach().floor().clamp(max=self.grid_size - 1).long()
+        frac = (position - index).unsqueeze(-1)
+        hidden = grid[index] * (1 - frac) + grid[index + 1] * frac
+        return hidden / (hidden**2).sum(-1).unsqueeze(-1).sqrt() * self.radi
 
     def forward(self, ob, mu, z, beta):
         p = probtorch.Trace()
@@ -191,7 +355,7 @@ class Decoder(nn.Module):
                  self.prior_mu_sigma,
                  value=mu,
                  name='means')
-        _ = p.variable(cat,
+        _ = p.variable(assignment_dist(z),
                        probs=self.prior_pi,
                        value=z,
                        name='states')
@@ -199,12 +363,10 @@ class Decoder(nn.Module):
                self.prior_con0,
                value=beta,
                name='angles')
-        hidden = self.recon_mu(beta * 2 * math.pi)
-        hidden2 = hidden / (hidden**2).sum(-1).unsqueeze(-1).sqrt()
-        mu_expand = torch.gather(mu, -2, z.argmax(-1).unsqueeze(-1).repeat(1, 1, 1, D))
-        recon_mu = hidden2 * self.radi + mu_expand
+        mu_expand = torch.gather(mu, -2, labels_of(z).unsqueeze(-1).repeat(1, 1, 1, D))
+        recon_mu = self.offset(beta) + mu_expand
         p.normal(recon_mu,
-                 self.recon_sigma.repeat(S, B, N, D),
+                 self.recon_sigma.expand(S, B, N, D),
                  value=ob,
                  name='likelihood')
         return p
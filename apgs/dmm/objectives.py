@@ -5,8 +5,10 @@ from torch.distributions.uniform import Uniform
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
 from torch.distributions.beta import Beta
 import math
+from apgs.resampler import ParticleState
+from apgs.dmm.models import masked
 
-def apg_objective(models, x, K, result_flags, num_sweeps, resampler):
+def apg_objective(models, x, K, result_flags, num_sweeps, resampler, mask=None):
     """
     Amortized Population Gibbs objective in DGMM problem
     ==========
@@ -23,6 +25,7 @@ def apg_objective(models, x, K, result_flags, num_sweeps, resampler):
     z : S * B * N * K, cluster assignments, as local variables
     beta : S * B * N * 1 angle, as local variables
     local : {z, beta} is block of local variables
+    mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances (None if all instances have N points)
     ==========
     sampling scheme:
     1. start with 'one-shot' predicting mu, z and beta
@@ -35,13 +38,16 @@ def apg_objective(models, x, K, result_flags, num_sweeps, resampler):
     """
     trace = {'loss_phi' : [], 'loss_theta' : [], 'ess' : [], 'E_mu' : [], 'E_z' : [], 'E_recon' : [], 'density' : []}
     (enc_rws_mu, enc_apg_local, enc_apg_mu, dec) = models
-    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_apg_local, dec, x, K, trace, result_flags)
-    mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w)
+    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_apg_local, dec, x, K, trace, result_flags, mask=mask)
+    particles = ParticleState(resampler, mu=mu, z=z, beta=beta)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
-        log_w_mu, mu, trace = apg_update_mu(enc_apg_mu, dec, x, z, beta, mu, K, trace, result_flags)
-        mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w_mu)
-        log_w_z, z, beta, trace = apg_update_local(enc_apg_local, dec, x, mu, z, beta, K, trace, result_flags)
-        mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w_z)
+        mu, z, beta = particles.get('mu', 'z', 'beta')
+        log_w_mu, particles['mu'], trace = apg_update_mu(enc_apg_mu, dec, x, z, beta, mu, K, log_w, trace, result_flags, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_mu)
+        mu, z, beta = particles.get('mu', 'z', 'beta')
+        log_w_z, particles['z'], particles['beta'], trace = apg_update_local(enc_apg_local, dec, x, mu, z, beta, K, log_w, trace, result_flags, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_z)
     if result_flags['loss_required']:
         trace['loss_phi'] = torch.cat(trace['loss_phi'], 0) 
         trace['loss_theta'] = torch.cat(trace['loss_theta'], 0) 
@@ -55,14 +61,13 @@ def apg_objective(models, x, K, result_flags, num_sweeps, resampler):
         trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def rws_objective(models, x, K, result_flags):
+def rws_objective(models, x, K, result_flags, mask=None):
     """
     RWS objective 
     """
     trace = {'loss_phi' : [], 'loss_theta' : [], 'ess' : [], 'E_mu' : [], 'E_z' : [], 'E_recon' : [], 'density' : []}
     (enc_rws_mu, enc_rws_local, dec) = models
-    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_apg_local, dec, x, K, trace, result_flags)
-    mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w)
+    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_rws_local, dec, x, K, trace, result_flags, mask=mask)
     if result_flags['loss_required']:
         trace['loss_phi'] = torch.cat(trace['loss_phi'], 0) 
         trace['loss_theta'] = torch.cat(trace['loss_theta'], 0) 
@@ -77,19 +82,19 @@ def rws_objective(models, x, K, result_flags):
         trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def oneshot(enc_rws_mu, enc_rws_local, dec, x, K, trace, result_flags):
+def oneshot(enc_rws_mu, enc_rws_local, dec, x, K, trace, result_flags, mask=None):
     """
     One-shot predicts mu, like a normal RWS
     """
-    q_mu = enc_rws_mu(x, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=True)
+    q_mu = enc_rws_mu(x, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=True, mask=mask)
     mu = q_mu['means'].value
     q_local = enc_rws_local(x, mu=mu, K=K, sampled=True)
     beta = q_local['angles'].value
     z = q_local['states'].value
     p = dec(x, mu=mu, z=z, beta=beta)
-    log_q = q_mu['means'].log_prob.sum(-1).sum(-1) + q_local['states'].log_prob.sum(-1) + q_local['angles'].log_prob.sum(-1).sum(-1)
-    ll = p['likelihood'].log_prob.sum(-1).sum(-1)
-    log_p = ll + p['means'].log_prob.sum(-1).sum(-1) + p['states'].log_prob.sum(-1) + p['angles'].log_prob.sum(-1).sum(-1)
+    log_q = q_mu['means'].log_prob.sum(-1).sum(-1) + masked(q_local['states'].log_prob + q_local['angles'].log_prob.sum(-1), mask).sum(-1)
+    ll = masked(p['likelihood'].log_prob.sum(-1), mask).sum(-1)
+    log_p = ll + p['means'].log_prob.sum(-1).sum(-1) + masked(p['states'].log_prob + p['angles'].log_prob.sum(-1), mask).sum(-1)
     log_w = (log_p - log_q).detach()
     w = F.softmax(log_w, 0).detach()
     if result_flags['loss_required']:
@@ -113,27 +118,28 @@ def oneshot(enc_rws_mu, enc_rws_local, dec, x, K, trace, result_flags):
         trace['density'].append(log_joint.unsqueeze(0))
     return log_w, mu, z, beta, trace
 
-def apg_update_mu(enc_apg_mu, dec, x, z, beta, mu_old, K, trace, result_flags):
+def apg_update_mu(enc_apg_mu, dec, x, z, beta, mu_old, K, log_w_carry, trace, result_flags, mask=None):
     """
     Given local variable {z, beta}, update global variables mu
+    log_w_carry : S * B log weights carried over from instances that were not resampled
     """
-    q_f = enc_apg_mu(x, z=z, beta=beta, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=True) ## forward kernel
+    q_f = enc_apg_mu(x, z=z, beta=beta, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=True, mask=mask) ## forward kernel
     mu = q_f['means'].value
     log_q_f = q_f['means'].log_prob.sum(-1).sum(-1) # S * B
     p_f = dec(x, mu=mu, z=z, beta=beta)
-    ll_f = p_f['likelihood'].log_prob.sum(-1).sum(-1)
+    ll_f = masked(p_f['likelihood'].log_prob.sum(-1), mask).sum(-1)
     log_priors_f = p_f['means'].log_prob.sum(-1).sum(-1)
     log_p_f = log_priors_f + ll_f
     log_w_f =  log_p_f - log_q_f
     ## backward
-    q_b = enc_apg_mu(x, z=z, beta=beta, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=False, mu_old=mu_old)
+    q_b = enc_apg_mu(x, z=z, beta=beta, K=K, priors=(dec.prior_mu_mu, dec.prior_mu_sigma), sampled=False, mu_old=mu_old, mask=mask)
     log_q_b = q_b['means'].log_prob.sum(-1).sum(-1).detach()
     p_b = dec(x, mu=mu_old, z=z, beta=beta)
-    ll_b = p_b['likelihood'].log_prob.sum(-1).sum(-1).detach()
+    ll_b = masked(p_b['likelihood'].log_prob.sum(-1), mask).sum(-1).detach()
     log_prior_b = p_b['means'].log_prob.sum(-1).sum(-1)
     log_p_b = log_prior_b + ll_b
     log_w_b = log_p_b - log_q_b
-    log_w = (log_w_f - log_w_b).detach()
+    log_w = (log_w_carry + log_w_f - log_w_b).detach()
     w = F.softmax(log_w, 0).detach()
     if result_flags['loss_required']:
         loss_phi = (w * (- log_q_f)).sum(0).mean()
@@ -150,29 +156,30 @@ def apg_update_mu(enc_apg_mu, dec, x, z, beta, mu_old, K, trace, result_flags):
         trace['density'].append(log_priors_f.unsqueeze(0))
     return log_w, mu, trace
 
-def apg_update_local(enc_apg_local, dec, x, mu, z_old, beta_old, K, trace, result_flags):
+def apg_update_local(enc_apg_local, dec, x, mu, z_old, beta_old, K, log_w_carry, trace, result_flags, mask=None):
     """
     Given the current samples of global variable mu
     update local variables {z, beta}
+    log_w_carry : S * B log weights carried over from instances that were not resampled
     """
     q_f = enc_apg_local(x, mu=mu, K=K, sampled=True)
     beta = q_f['angles'].value
     z = q_f['states'].value
     p_f = dec(x, mu=mu, z=z, beta=beta)
-    log_q_f = q_f['states'].log_prob + q_f['angles'].log_prob.sum(-1)
-    ll_f = p_f['likelihood'].log_prob.sum(-1)
-    log_p_f = ll_f + p_f['states'].log_prob + p_f['angles'].log_prob.sum(-1)
+    log_q_f = masked(q_f['states'].log_prob + q_f['angles'].log_prob.sum(-1), mask)
+    ll_f = masked(p_f['likelihood'].log_prob.sum(-1), mask)
+    log_p_f = ll_f + masked(p_f['states'].log_prob + p_f['angles'].log_prob.sum(-1), mask)
     log_w_f = log_p_f - log_q_f
     ## backward
     q_b = enc_apg_local(x, mu=mu, K=K, sampled=False, z_old=z_old, beta_old=beta_old)
     p_b = dec(x, mu=mu, z=z_old, beta=beta_old)
-    log_q_b = q_b['states'].log_prob.detach() + q_b['angles'].log_prob.sum(-1).detach()
-    ll_b = p_b['likelihood'].log_prob.sum(-1).detach()
-    log_p_b = ll_b + p_b['states'].log_prob + p_b['angles'].log_prob.sum(-1)
+    log_q_b = masked(q_b['states'].log_prob.detach() + q_b['angles'].log_prob.sum(-1).detach(), mask)
+    ll_b = masked(p_b['likelihood'].log_prob.sum(-1).detach(), mask)
+    log_p_b = ll_b + masked(p_b['states'].log_prob + p_b['angles'].log_prob.sum(-1), mask)
     log_w_b = log_p_b - log_q_b
     log_w_local = (log_w_f - log_w_b).detach()
-    log_w = log_w_local.sum(-1)
-    w_local = F.softmax(log_w_local, 0).detach()
+    log_w = log_w_carry + log_w_local.sum(-1)
+    w_local = F.softmax(log_w_local + log_w_carry.unsqueeze(-1), 0).detach()
     if result_flags['loss_required']:
         loss_phi = (w_local * (- log_q_f)).sum(0).sum(-1).mean()
         loss_theta = (w_local * (- ll_f)).sum(0).sum(-1).mean()
@@ -187,12 +194,14 @@ def apg_update_local(enc_apg_local, dec, x, mu, z_old, beta_old, K, trace, resul
         trace['density'][-1] = trace['density'][-1] + log_p_f.sum(-1).unsqueeze(0)
     return log_w, z, beta, trace
 
-def resample_variables(resampler, mu, z, beta, log_weights):
-    ancestral_index = resampler.sample_ancestral_index(log_weights)
-    mu = resampler.resample_4dims(var=mu, ancestral_index=ancestral_index)
-    z = resampler.resample_4dims(var=z, ancestral_index=ancestral_index)
-    beta = resampler.resample_4dims(var=beta, ancestral_index=ancestral_index)
-    return mu, z, beta
+def resample_variables(resampler, particles, log_weights):
+    """
+    select ancestors and record them in the particle state, the variables are gathered when they are next read
+    """
+    ancestral_index, log_w_carry = resampler.select_ancestors(log_weights)
+    if ancestral_index is not None:
+        particles.resample(ancestral_index)
+    return log_w_carry
 
 
 def hmc_objective(models, x, K, result_flags, hmc_sampler):
@@ -206,31 +215,34 @@ def hmc_objective(models, x, K, result_flags, hmc_sampler):
     trace['density'] = torch.cat(trace['density'], 0)
     return trace
 
-def bpg_objective(models, x, K, result_flags, num_sweeps, resampler):
+def bpg_objective(models, x, K, result_flags, num_sweeps, resampler, mask=None):
     """
     bpg objective
     """
     trace = {'density' : []} ## a dictionary that tracks things needed during the sweeping
     (enc_rws_mu, enc_apg_local, enc_apg_mu, dec) = models
-    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_apg_local, dec, x, K, trace, result_flags)
-    mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w)
+    log_w, mu, z, beta, trace = oneshot(enc_rws_mu, enc_apg_local, dec, x, K, trace, result_flags, mask=mask)
+    particles = ParticleState(resampler, mu=mu, z=z, beta=beta)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
-        log_w_mu, mu, trace = bpg_update_mu(enc_apg_mu, dec, x, z, beta, mu, K, trace)
-        mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w_mu)
-        log_w_z, z, beta, trace = apg_update_local(enc_apg_local, dec, x, mu, z, beta, K, trace, result_flags)
-        mu, z, beta = resample_variables(resampler, mu, z, beta, log_weights=log_w_z)
+        mu, z, beta = particles.get('mu', 'z', 'beta')
+        log_w_mu, particles['mu'], trace = bpg_update_mu(enc_apg_mu, dec, x, z, beta, mu, K, log_w, trace, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_mu)
+        mu, z, beta = particles.get('mu', 'z', 'beta')
+        log_w_z, particles['z'], particles['beta'], trace = apg_update_local(enc_apg_local, dec, x, mu, z, beta, K, log_w, trace, result_flags, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_z)
     trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def bpg_update_mu(enc_apg_mu, dec, x, z, beta, mu_old, K, trace):
+def bpg_update_mu(enc_apg_mu, dec, x, z, beta, mu_old, K, log_w_carry, trace, mask=None):
     q = Normal(dec.prior_mu_mu, dec.prior_mu_sigma)
     S, B, K, D = mu_old.shape
     mu = q.sample((S, B, K, ))
     log_p = q.log_prob(mu).sum(-1).sum(-1)
     p_f = dec(x, mu=mu, z=z, beta=beta)
-    ll_f = p_f['likelihood'].log_prob.sum(-1).sum(-1)
+    ll_f = masked(p_f['likelihood'].log_prob.sum(-1), mask).sum(-1)
     p_b = dec(x, mu=mu_old, z=z, beta=beta)
-    ll_b = p_b['likelihood'].log_prob.sum(-1).sum(-1).detach()
-    log_w = (ll_f - ll_b).detach()
+    ll_b = masked(p_b['likelihood'].log_prob.sum(-1), mask).sum(-1).detach()
+    log_w = (log_w_carry + ll_f - ll_b).detach()
     trace['density'].append(log_p.unsqueeze(0)) # 1-by-B-length vector
     return log_w, mu, trace
@@ -0,0 +1,159 @@
+import math
+import torch
+import torch.nn.functional as F
+from torch.distributions.normal import Normal
+from apgs.dmm.models import labels_of
+from apgs.dmm.objectives import oneshot, apg_update_local, resample_variables
+from apgs.resampler import ParticleState
+
+"""
+Online APG inference in DMM, for instances whose points arrive over time
+==========
+given its angle beta_n, a point is x_n = mu_{z_n} + offset(beta_n) + noise, so the likelihood of the points
+whose local variables are fixed only depends on the sums over each cluster of the residuals r_n = x_n - offset(beta_n):
+    count, sum of r_n, sum of r_n^2
+the particles keep, besides mu, these sums and the nss pooled by Enc_apg_mu over the points seen so far.
+both are additive over the points, so when M new points arrive:
+    1. their {z, beta} are proposed by Enc_apg_local given the current mu,
+       and weighted by p(x_new, z_new, beta_new | mu) / q(z_new, beta_new)
+    2. a few sweeps update mu from the cached sums plus the statistics of the new points,
+       and the {z, beta} of the new points with apg_update_local
+    3. the statistics of the new points are added to the cached sums
+the local variables of the earlier points are not revisited, so an update costs O(M) rather than O(N).
+the decoder must stay fixed while the sums are cached (evaluation only)
+==========
+"""
+stat_names = ('weighted_nss', 'weights', 'count', 'residual_sum', 'residual_sq_sum')
+
+def ess(log_w):
+    w = F.softmax(log_w, 0)
+    return 1. / (w**2).sum(0)
+
+def residual_stats(residual, z, K):
+    """
+    count : S * B * K * 1, sum of r_n and of r_n^2 over the points of each cluster : S * B * K * D
+    """
+    S, B, N, D = residual.shape
+    labels = labels_of(z)
+    count = residual.new_zeros((S, B, K)).scatter_add_(2, labels, residual.new_ones((S, B, N))).unsqueeze(-1)
+    index = labels.unsqueeze(-1).expand(S, B, N, D)
+    residual_sum = residual.new_zeros((S, B, K, D)).scatter_add_(2, index, residual)
+    residual_sq_sum = residual.new_zeros((S, B, K, D)).scatter_add_(2, index, residual**2)
+    return count, residual_sum, residual_sq_sum
+
+def loglik_from_residual_stats(count, residual_sum, residual_sq_sum, mu, recon_sigma):
+    """
+    sum over the points of log N(x_n; mu_{z_n} + offset(beta_n), recon_sigma), S * B
+    """
+    precision = 1. / recon_sigma**2
+    quadratic = residual_sq_sum - 2 * mu * residual_sum + count * (mu**2)
+    return (- count * (recon_sigma.log() + 0.5 * math.log(2 * math.pi)) - 0.5 * precision * quadratic).sum(-1).sum(-1)
+
+class OnlineDMM():
+    def __init__(self, models, K, resampler):
+        """
+        models : (enc_rws_mu, enc_apg_local, enc_apg_mu, dec) as returned by init_apg_models
+        """
+        (self.enc_rws_mu, self.enc_apg_local, self.enc_apg_mu, self.dec) = models
+        self.K = K
+        self.resampler = resampler
+        self.result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : False}
+        self.particles = None
+        self.log_w = None
+        self.num_blocks = 0
+
+    def block_stats(self, x, z, beta):
+        """
+        the pooled nss followed by the residual statistics of the points x with local variables {z, beta}
+        """
+        return self.enc_apg_mu.pooled_stats(x, z) + residual_stats(x - self.dec.offset(beta), z, self.K)
+
+    def total_stats(self, x_new, z_new, beta_new):
+        """
+        the cached sums plus the statistics of the new points
+        """
+        cached = self.particles.get(*stat_names)
+        return tuple(old + new for old, new in zip(cached, self.block_stats(x_new, z_new, beta_new)))
+
+    def log_prior_mu(self, mu):
+        return Normal(self.dec.prior_mu_mu, self.dec.prior_mu_sigma).log_prob(mu).sum(-1).sum(-1)
+
+    def update_mu(self, x_new, z_new, beta_new, mu_old, log_w_carry):
+        """
+        apg_update_mu with the encoder and the likelihood evaluated on the statistics of all the points
+        """
+        stats = self.total_stats(x_new, z_new, beta_new)
+        priors = (self.dec.prior_mu_mu, self.dec.prior_mu_sigma)
+        q_f = self.enc_apg_mu(None, None, None, K=self.K, priors=priors, sampled=True, stats=stats[:2])
+        mu = q_f['means'].value
+        log_q_f = q_f['means'].log_prob.sum(-1).sum(-1)
+        ll_f = loglik_from_residual_stats(*stats[2:], mu=mu, recon_sigma=self.dec.recon_sigma)
+        ## backward
+        q_b = self.enc_apg_mu(None, None, None, K=self.K, priors=priors, sampled=False, mu_old=mu_old, stats=stats[:2])
+        log_q_b = q_b['means'].log_prob.sum(-1).sum(-1)
+        ll_b = loglik_from_residual_stats(*stats[2:], mu=mu_old, recon_sigma=self.dec.recon_sigma)
+        log_w = log_w_carry + (ll_f + self.log_prior_mu(mu) - log_q_f) - (ll_b + self.log_prior_mu(mu_old) - log_q_b)
+        return log_w, mu
+
+    def extend_local(self, x_new, mu):
+        """
+        propose {z, beta} of the new points given mu and weight the particles by the incremental target
+        """
+        q = self.enc_apg_local(x_new, mu=mu, K=self.K, sampled=True)
+        z = q['states'].value
+        beta = q['angles'].value
+        p = self.dec(x_new, mu=mu, z=z, beta=beta)
+        log_p = p['likelihood'].log_prob.sum(-1).sum(-1) + p['states'].log_prob.sum(-1) + p['angles'].log_prob.sum(-1).sum(-1)
+        log_q = q['states'].log_prob.sum(-1) + q['angles'].log_prob.sum(-1).sum(-1)
+        return self.log_w + log_p - log_q, z, beta
+
+    @torch.no_grad()
+    def append(self, x_new, num_sweeps=1):
+        """
+        x_new : S * B * M * D, the new points of every instance, repeated over the S particles
+        the first call initializes the particles with the one-shot proposal on its points
+        return the ESS after the proposal of the new {z, beta} and after every update, (1 + 2 * num_sweeps) * B
+        """
+        S, B, M, D = x_new.shape
+        z_name, beta_name = 'z_%d' % self.num_blocks, 'beta_%d' % self.num_blocks
+        trace = {'loss_phi' : [], 'loss_theta' : [], 'ess' : [], 'E_mu' : [], 'E_z' : [], 'E_recon' : [], 'density' : []}
+        if self.particles is None:
+            log_w, mu, z, beta, trace = oneshot(self.enc_rws_mu, self.enc_apg_local, self.dec, x_new, self.K, trace, self.result_flags)
+            num_nss = self.enc_apg_mu.nss1[-1].out_features
+            shapes = [(S, B, self.K, num_nss), (S, B, self.K, 1), (S, B, self.K, 1), (S, B, self.K, D), (S, B, self.K, D)]
+            self.particles = ParticleState(self.resampler, mu=mu, **dict(zip(stat_names, [x_new.new_zeros(shape) for shape in shapes])))
+        else:
+            log_w, z, beta = self.extend_local(x_new, self.particles['mu'])
+        self.particles[z_name] = z
+        self.particles[beta_name] = beta
+        ess_trace = [ess(log_w)]
+        self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+        for m in range(num_sweeps):
+            mu, z, beta = self.particles.get('mu', z_name, beta_name)
+            log_w, self.particles['mu'] = self.update_mu(x_new, z, beta, mu, self.log_w)
+            ess_trace.append(ess(log_w))
+            self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+            mu, z, beta = self.particles.get('mu', z_name, beta_name)
+            log_w, self.particles[z_name], self.particles[beta_name], trace = apg_update_local(self.enc_apg_local, self.dec, x_new, mu, z, beta, self.K, self.log_w, trace, self.result_flags)
+            ess_trace.append(ess(log_w))
+            self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+        ## fold the new points into the cached sums
+        z, beta = self.particles.get(z_name, beta_name)
+        for stat_name, stat in zip(stat_names, self.total_stats(x_new, z, beta)):
+            self.particles[stat_name] = stat
+        self.num_blocks += 1
+        return torch.stack(ess_trace, 0)
+
+    def assignments(self):
+        """
+        z and beta of all the points appended so far, concatenated along N
+        """
+        z = self.particles.get(*['z_%d' % b for b in range(self.num_blocks)])
+        beta = self.particles.get(*['beta_%d' % b for b in range(self.num_blocks)])
+        return torch.cat(z, 2), torch.cat(beta, 2)
+
+    def globals(self):
+        """
+        mu : S * B * K * D
+        """
+        return self.particles['mu']
@@ -1,6 +1,7 @@
 import os
 import math
 import torch
+import multiprocessing as mp
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -61,6 +62,23 @@ class Sim_Rings():
             angle.append(angle_k)
         return np.concatenate(ob, 0), np.concatenate(state, 0), mu, np.concatenate(radi, 0)[:, None], np.concatenate(angle, 0)[:, None]
 
+    def sim_dmms(self, num_seqs, rng=np.random):
+        """
+        simulate num_seqs instances at once, the angles, shifts and noise of all the rings are drawn by single batched ops
+        return ob : num_seqs * N * D (float32), labels : num_seqs * N (uint8), mu : num_seqs * K * 2, angle : num_seqs * N
+        """
+        pts_edge = int(self.Nk / self.period)
+        assert pts_edge * self.period * self.K == self.N, "ERROR! N=%d can not be split into %d rings of %d circles." % (self.N, self.K, self.period)
+        angles = np.linspace(0, 2 * math.pi, pts_edge, endpoint=True)
+        pointwise_interval = angles[1] - angles[0]
+        rand_shift = rng.uniform(low=0.0, high=pointwise_interval, size=(num_seqs, self.K, self.period, 1))
+        angles = (angles + rand_shift).reshape(num_seqs, self.K, self.Nk)
+        mu = rng.normal(0, self.mu_std, (num_seqs, self.K, 2))
+        noise = rng.normal(0.0, self.noise_std, (num_seqs, self.K, self.Nk, 2))
+        pos = np.stack((np.cos(angles), np.sin(angles)), -1) * self.radi + noise + mu[:, :, None, :]
+        labels = np.repeat(np.arange(self.K, dtype=np.uint8), self.Nk)
+        return pos.reshape(num_seqs, self.N, 2).astype(np.float32), np.tile(labels, (num_seqs, 1)), mu, angles.reshape(num_seqs, self.N)
+
     def viz_data(self, num_seqs=20, bound=10, fs=6, colors=['#AA3377', '#EE7733', '#0077BB', '#009988', '#555555', '#999933']):
         for s in range(num_seqs):
             ob, state, mu, _, _ = self.sim_one_dmm()
@@ -77,12 +95,35 @@ class Sim_Rings():
     def sim_save_data(self, num_seqs, PATH):
         if not os.path.exists(PATH):
             os.makedirs(PATH)
-        OB = np.zeros((num_seqs, self.N, self.D))
-        for s in range(num_seqs):
-            ob, _, _, _, _ = self.sim_one_dmm()
-            OB[s] = ob
+        OB, _, _, _ = self.sim_dmms(num_seqs)
         print('saving to %s' % os.path.abspath(PATH))
         np.save(PATH + 'ob', OB)
+
+    def sim_save_shards(self, num_seqs, PATH, shard_size=10000, num_workers=4, seed=0):
+        """
+        simulate num_seqs instances in shards of shard_size, generated in parallel by num_workers processes,
+        shard i is saved as ob-%05d.npy (float32, shard_size * N * D) and labels-%05d.npy (uint8, shard_size * N)
+        """
+        if not os.path.exists(PATH):
+            os.makedirs(PATH)
+        jobs = [(self, i, min(shard_size, num_seqs - start), seed, PATH) for i, start in enumerate(range(0, num_seqs, shard_size))]
+        with mp.Pool(num_workers) as pool:
+            pool.map(sim_save_shard, jobs)
+        print('saved %d shards to %s' % (len(jobs), os.path.abspath(PATH)))
+
+def sim_save_shard(job):
+    simulator, shard, num_seqs, seed, PATH = job
+    rng = np.random.RandomState(seed * 100003 + shard)
+    ob, labels, _, _ = simulator.sim_dmms(num_seqs, rng=rng)
+    np.save(PATH + 'ob-%05d' % shard, ob)
+    np.save(PATH + 'labels-%05d' % shard, labels)
+
+def load_shards(PATH):
+    """
+    concatenate the observations of the shards of sim_save_shards, float32 as in sim_save_data
+    """
+    shards = sorted(f[3:-4] for f in os.listdir(PATH) if f.startswith('ob-') and f.endswith('.npy'))
+    return np.concatenate([np.load(PATH + 'ob-%s.npy' % shard) for shard in shards], 0)
         
         
 if __name__ == '__main__':
@@ -97,6 +138,13 @@ if __name__ == '__main__':
     parser.add_argument('--mu_std', default=3.0, help='standard deviation of the centers of rings')
     parser.add_argument('--noise_std', default=0.1, help='standard deviation of Gaussian noise')
     parser.add_argument('--radius', default=2.0, help='raidus of the ring')
+    parser.add_argument('--shard_size', default=None, type=int, help='if given, save float32 / uint8 shards of this many instances')
+    parser.add_argument('--num_workers', default=4, type=int, help='number of processes that generate the shards')
+    parser.add_argument('--seed', default=0, type=int)
     args = parser.parse_args()
     simulator = Sim_Rings(args.N, args.K, args.D, args.period, args.mu_std, args.noise_std, args.radius)
-    simulator.sim_save_data(args.num_instances, args.data_path)
\ No newline at end of file
+    if args.shard_size is not None:
+        simulator.sim_save_shards(args.num_instances, args.data_path, shard_size=args.shard_size, num_workers=args.num_workers, seed=args.seed)
+    else:
+        np.random.seed(args.seed)
+        simulator.sim_save_data(args.num_instances, args.data_path)
\ No newline at end of file
@@ -3,6 +3,7 @@ import torch
 import time
 from apgs.gmm.kls_gmm import kls_eta
 from apgs.gmm.models import Enc_rws_eta, Enc_apg_eta, Enc_apg_z, Generative
+from apgs.bucketing import BucketBatchSampler, pad_batch
 
 def train(objective, optimizer, models, data, assignments, num_epochs, sample_size, batch_size, CUDA, device, **kwargs):
     """
@@ -53,6 +54,52 @@ def train(objective, optimizer, models, data, assignments, num_epochs, sample_si
         log_file.close()
         print("Epoch=%d / %d (%ds),  " % (epoch+1, num_epochs, time_end - time_start))
         
+def train_ragged(objective, optimizer, models, data, assignments, num_epochs, sample_size, batch_size, CUDA, device, max_padding=0.1, **kwargs):
+    """
+    training function for apg samplers on instances of different sizes
+    data, assignments : lists of N_b * D and N_b * K tensors, batched by BucketBatchSampler and padded with masks
+    """
+    result_flags = {'loss_required' : True, 'ess_required' : True, 'mode_required' : False, 'density_required': True}
+    sampler = BucketBatchSampler([instance.shape[0] for instance in data], batch_size, max_padding=max_padding)
+    for epoch in range(num_epochs):
+        time_start = time.time()
+        metrics = {'ess': 0.0, 'density' : 0.0, 'inc_kl' : 0.0, 'exc_kl' : 0.0}
+        num_points, num_padded = 0, 0
+        for indices in sampler:
+            optimizer.zero_grad()
+            ## the same permutation of the points for the data and the assignments of an instance
+            perms = [torch.randperm(data[i].shape[0]) for i in indices]
+            x, mask = pad_batch([data[i][perm] for i, perm in zip(indices, perms)])
+            z_true, _ = pad_batch([assignments[i][perm] for i, perm in zip(indices, perms)])
+            x = x.repeat(sample_size, 1, 1, 1)
+            z_true = z_true.repeat(sample_size, 1, 1, 1)
+            mask = mask.repeat(sample_size, 1, 1)
+            num_points += mask[0].sum().item()
+            num_padded += mask[0].numel()
+            if CUDA:
+                x = x.cuda().to(device)
+                z_true = z_true.cuda().to(device)
+                mask = mask.cuda().to(device)
+            trace = objective(models, x, result_flags, mask=mask, **kwargs)
+            loss = trace['loss'].sum()
+            loss.backward()
+            optimizer.step()
+            metrics['ess'] += trace['ess'][-1].mean()
+            metrics['density'] += trace['density'][-1].mean()
+            if kwargs['num_sweeps'] > 1:
+                exc_kl, inc_kl = kls_eta(models, x, z_true, mask=mask)
+                metrics['inc_kl'] += inc_kl
+                metrics['exc_kl'] += exc_kl
+        save_apg_models(models, model_version)
+        metrics_print = ", ".join(['%s=%.4f' % (k, v / len(sampler)) for k, v in metrics.items()])
+        if not os.path.exists('results/'):
+            os.makedirs('results/')
+        log_file = open('results/log-' + model_version + '.txt', 'a+')
+        time_end = time.time()
+        print(metrics_print, file=log_file)
+        log_file.close()
+        print("Epoch=%d / %d (%ds), padding=%.1f%%" % (epoch+1, num_epochs, time_end - time_start, 100 * (1 - num_points / num_padded)))
+
 def shuffler(data, assignments):
     """
     shuffle the GMM datasets by both permuting the order of GMM instances (w.r.t. DIM1) and permuting the order of data points in each instance (w.r.t. DIM2)
@@ -65,15 +112,18 @@ def shuffler(data, assignments):
     concat_var = torch.gather(concat_var, 1, indices_DIM2.unsqueeze(-1).repeat(1, 1, DIM3))
     return concat_var[:,:,:2], concat_var[:,:,2:]
 
-def init_apg_models(K, D, num_hidden_z, CUDA, device, load_version=None, lr=None):
+def init_apg_models(K, D, num_hidden_z, CUDA, device, load_version=None, lr=None, integer_labels=False, chunk_size=None, num_candidates=None):
     """
     ==========
     initialization function for APG samplers
+    integer_labels : keep the cluster assignments z as integer labels instead of one-hot vectors
+    chunk_size : accumulate the statistics of the eta encoders over chunks of chunk_size points
+    num_candidates : let the z encoder score only the num_candidates nearest clusters of each point
     ==========
     """
-    enc_rws_eta = Enc_rws_eta(K, D)
-    enc_apg_z = Enc_apg_z(K, D, num_hidden_z)
-    enc_apg_eta = Enc_apg_eta(K, D)
+    enc_rws_eta = Enc_rws_eta(K, D, chunk_size=chunk_size)
+    enc_apg_z = Enc_apg_z(K, D, num_hidden_z, integer_labels=integer_labels, num_candidates=num_candidates)
+    enc_apg_eta = Enc_apg_eta(K, D, chunk_size=chunk_size)
     generative = Generative(K, D, CUDA, device)
     if CUDA:
         with torch.cuda.device(device):
@@ -172,7 +222,15 @@ if __name__ == '__main__':
     parser.add_argument('--budget', default=100, type=int)
     parser.add_argument('--num_sweeps', default=10, type=int)
     parser.add_argument('--lr', default=1e-4, type=float)
-    parser.add_argument('--resample_strategy', default='systematic', choices=['systematic', 'multinomial'])
+    parser.add_argument('--resample_strategy', default='systematic', choices=Resampler.strategies)
+    parser.add_argument('--ess_threshold', default=None, type=float, help='only resample instances whose ESS / sample size is below this threshold')
+    parser.add_argument('--fused_resampling', action='store_true', help='run the inverse cdf and the gathers of the resampler as TorchScript kernels')
+    parser.add_argument('--integer_labels', action='store_true', help='keep the cluster assignments as integer labels instead of one-hot vectors')
+    parser.add_argument('--num_candidates', default=None, type=int, help='score only this many nearest clusters per point in the z proposal, for large numbers of clusters')
+    parser.add_argument('--chunk_size', default=None, type=int, help='accumulate the statistics of the eta encoders over chunks of this many points')
+    parser.add_argument('--sharded', action='store_true', help='load the float32 / uint8 shards written by sim_gmm.py --shard_size')
+    parser.add_argument('--ragged', action='store_true', help='ob.npy and assignment.npy hold arrays of instances with different numbers of points')
+    parser.add_argument('--max_padding', default=0.1, type=float, help='bound on the padding of a batch of ragged instances, relative to its smallest instance')
     parser.add_argument('--block_strategy', default='decomposed', choices=['decomposed', 'joint'])
     parser.add_argument('--num_clusters', default=3, type=int)
     parser.add_argument('--data_dim', default=2, type=int)
@@ -182,10 +240,19 @@ if __name__ == '__main__':
     CUDA = torch.cuda.is_available()
     device = torch.device('cuda:%d' % args.device)
     
-    data = torch.from_numpy(np.load(args.data_dir + 'ob.npy')).float() 
-    assignments = torch.from_numpy(np.load(args.data_dir + 'assignment.npy')).float()
+    if args.sharded:
+        from apgs.gmm.sim_gmm import load_shards
+        data, assignments = load_shards(args.data_dir, args.num_clusters)
+        data, assignments = torch.from_numpy(data), torch.from_numpy(assignments)
+    elif args.ragged:
+        data = [torch.from_numpy(instance).float() for instance in np.load(args.data_dir + 'ob.npy', allow_pickle=True)]
+        assignments = [torch.from_numpy(instance).float() for instance in np.load(args.data_dir + 'assignment.npy', allow_pickle=True)]
+    else:
+        data = torch.from_numpy(np.load(args.data_dir + 'ob.npy')).float() 
+        assignments = torch.from_numpy(np.load(args.data_dir + 'assignment.npy')).float()
     print('Start training for gmm clustering task..')
     if args.num_sweeps == 1: ## rws method
+        assert not args.ragged, 'ERROR! --ragged is only supported by the apg samplers, set num_sweeps > 1.'
         model_version = 'rws-gmm-num_samples=%s' % (sample_size)
         print('version='+ model_version)
         models, optimizer = init_rws_models(args.num_clusters, args.data_dim, args.num_hidden, CUDA, device, load_version=None, lr=args.lr)
@@ -194,9 +261,12 @@ if __name__ == '__main__':
     elif args.num_sweeps > 1: ## apg sampler
         model_version = 'apg-gmm-block=%s-num_sweeps=%s-num_samples=%s' % (args.block_strategy, args.num_sweeps, sample_size)
         print('version=' + model_version)
-        models, optimizer = init_apg_models(args.num_clusters, args.data_dim, args.num_hidden, CUDA, device, load_version=None, lr=args.lr)
-        resampler = Resampler(args.resample_strategy, sample_size, CUDA, device)
-        train(apg_objective, optimizer, models, data, assignments, args.num_epochs, sample_size, args.batch_size, CUDA, device, num_sweeps=args.num_sweeps, block=args.block_strategy, resampler=resampler)
+        models, optimizer = init_apg_models(args.num_clusters, args.data_dim, args.num_hidden, CUDA, device, load_version=None, lr=args.lr, integer_labels=args.integer_labels, chunk_size=args.chunk_size, num_candidates=args.num_candidates)
+        resampler = Resampler(args.resample_strategy, sample_size, CUDA, device, ess_threshold=args.ess_threshold, fused=args.fused_resampling)
+        if args.ragged:
+            train_ragged(apg_objective, optimizer, models, data, assignments, args.num_epochs, sample_size, args.batch_size, CUDA, device, max_padding=args.max_padding, num_sweeps=args.num_sweeps, block=args.block_strategy, resampler=resampler)
+        else:
+            train(apg_objective, optimizer, models, data, assignments, args.num_epochs, sample_size, args.batch_size, CUDA, device, num_sweeps=args.num_sweeps, block=args.block_strategy, resampler=resampler)
         
     else:
         raise ValueError
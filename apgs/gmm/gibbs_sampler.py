@@ -0,0 +1,80 @@
+import math
+import torch
+from torch.distributions.gamma import Gamma
+from apgs.gmm.kls_gmm import posterior_eta, loglik_table
+
+class Gibbs():
+    """
+    conjugate Gibbs sampler of the GMM, alternating eta | z and z | eta for a number of sweeps in one call
+    ==========
+    z is kept as S * B * N integer labels and sampled by Gumbel-max from the posterior logits,
+    the random numbers are drawn into preallocated buffers and the log joint uses the log densities
+    in closed form, so no distribution object is built within a sweep
+    ==========
+    """
+    def __init__(self, generative, S, B, N, K, D, CUDA, device):
+        self.S, self.B, self.N, self.K, self.D = S, B, N, K, D
+        self.prior_alpha, self.prior_beta, self.prior_mu, self.prior_nu = generative.prior_ng
+        self.log_prior_pi = generative.prior_pi.log()
+        self.log_gamma_normalizer = self.prior_alpha * self.prior_beta.log() - torch.lgamma(self.prior_alpha) # K * D
+        self.uniforms = torch.empty((S, B, N, K))
+        self.normals = torch.empty((S, B, K, D))
+        if CUDA:
+            with torch.cuda.device(device):
+                self.uniforms = self.uniforms.cuda()
+                self.normals = self.normals.cuda()
+
+    def sweep(self, x, labels):
+        """
+        one Gibbs sweep, return the new tau, mu, labels and the loglik_table of (tau, mu)
+        """
+        post_alpha, post_beta, post_mu, post_nu = posterior_eta(x,
+                                                                z=labels,
+                                                                prior_alpha=self.prior_alpha,
+                                                                prior_beta=self.prior_beta,
+                                                                prior_mu=self.prior_mu,
+                                                                prior_nu=self.prior_nu)
+        tau = Gamma(post_alpha, post_beta, validate_args=False).sample()
+        mu = post_mu + self.normals.normal_() / (post_nu * tau).sqrt()
+        table = loglik_table(x, tau, mu) # S * B * N * K
+        ## log(-log(u)) is minus a standard Gumbel variable
+        neg_gumbels = self.uniforms.uniform_().clamp_(min=1e-20).log_().neg_().log_()
+        labels = (table + self.log_prior_pi - neg_gumbels).argmax(-1)
+        return tau, mu, labels, table
+
+    def log_joint(self, table, labels, tau, mu):
+        """
+        log p(x, z, tau, mu), S * B
+        """
+        ll = table.gather(-1, labels.unsqueeze(-1)).sum(-1).sum(-1)
+        log_prior_tau = (self.log_gamma_normalizer + (self.prior_alpha - 1) * tau.log() - self.prior_beta * tau).sum(-1).sum(-1)
+        precision_mu = self.prior_nu * tau
+        log_prior_mu = (0.5 * (precision_mu.log() - math.log(2 * math.pi)) - 0.5 * precision_mu * (mu - self.prior_mu)**2).sum(-1).sum(-1)
+        log_prior_z = self.log_prior_pi[labels].sum(-1)
+        return ll + log_prior_tau + log_prior_mu + log_prior_z
+
+    def sampling(self, x, labels, num_sweeps, burn_in=0, thinning=1, return_samples=False):
+        """
+        run num_sweeps sweeps from the labels S * B * N and keep the sweeps burn_in, burn_in + thinning, ...
+        return the log joints of the kept sweeps, num_kept * S * B,
+        and a dict of their tau, mu (num_kept * S * B * K * D) and labels (num_kept * S * B * N) if return_samples
+        """
+        num_kept = len(range(burn_in, num_sweeps, thinning))
+        densities = x.new_empty((num_kept, self.S, self.B))
+        samples = None
+        if return_samples:
+            samples = {'tau' : x.new_empty((num_kept, self.S, self.B, self.K, self.D)),
+                       'mu' : x.new_empty((num_kept, self.S, self.B, self.K, self.D)),
+                       'z' : torch.empty((num_kept, self.S, self.B, self.N), dtype=torch.long, device=x.device)}
+        i = 0
+        for m in range(num_sweeps):
+            tau, mu, labels, table = self.sweep(x, labels)
+            if m < burn_in or (m - burn_in) % thinning != 0:
+                continue
+            densities[i] = self.log_joint(table, labels, tau, mu)
+            if return_samples:
+                samples['tau'][i] = tau
+                samples['mu'][i] = mu
+                samples['z'][i] = labels
+            i += 1
+        return densities, samples
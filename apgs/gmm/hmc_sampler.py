@@ -4,11 +4,17 @@ from torch.distributions.normal import Normal
 from torch.distributions.gamma import Gamma
 from torch.distributions.uniform import Uniform
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
-from apgs.gmm.kls_gmm import posterior_z
+from apgs.gmm.kls_gmm import posterior_z, candidate_clusters, candidate_loglik, truncation_gap
 
 class HMC():
-    def __init__(self, S, B, N, K, D, hmc_num_steps, leapfrog_step_size, leapfrog_num_steps, CUDA, device):
+    def __init__(self, S, B, N, K, D, hmc_num_steps, leapfrog_step_size, leapfrog_num_steps, CUDA, device, num_candidates=None):
+        """
+        num_candidates : if given, the marginal over z of each point only sums over its num_candidates nearest clusters,
+        chosen once from the initial particles and fixed for the whole run. the chain then targets this truncated marginal,
+        an approximation of the exact one, and trace['truncation'] records their log gap at every step (see truncation_gap)
+        """
         self.S, self.B, self.N, self.K, self.D = S, B, N, K, D
+        self.num_candidates = num_candidates
         self.Sigma = torch.ones(self.D)
         self.mu = torch.zeros(self.D)
         self.accept_count = 0.0
@@ -32,37 +38,61 @@ class HMC():
         return self.gauss_dist.sample((self.S, self.B, self.K, )), self.gauss_dist.sample((self.S, self.B, self.K, ))
 
     def hmc_sampling(self, generative, x, log_tau, mu, trace):
+        candidates = None
+        if self.num_candidates is not None:
+            ## fixed for the run, candidates that moved with the state would not give a valid Metropolis-Hastings ratio
+            candidates = candidate_clusters(x, mu.detach(), self.num_candidates)
+            trace['truncation'] = []
         for m in range(self.hmc_num_steps):
-            log_tau, mu = self.metrioplis(generative,
-                                          x, 
-                                          log_tau=log_tau.detach(), 
-                                          mu=mu.detach(), 
-                                          step_size=self.leapfrog_step_size, 
-                                          num_steps=self.leapfrog_num_steps)
-            posterior_logits = posterior_z(x,
-                                           tau=log_tau.exp(),
-                                           mu=mu,
-                                           prior_pi=generative.prior_pi)
-            E_z = posterior_logits.exp().mean(0)
-            z = cat(logits=posterior_logits).sample()
-            log_joint = self.log_joint(generative, x, z=z, tau=log_tau.exp(), mu=mu)
+            log_tau, mu, table = self.metrioplis(generative,
+                                                 x, 
+                                                 log_tau=log_tau.detach(), 
+                                                 mu=mu.detach(), 
+                                                 step_size=self.leapfrog_step_size, 
+                                                 num_steps=self.leapfrog_num_steps,
+                                                 candidates=candidates)
+            if candidates is not None:
+                trace['truncation'].append(truncation_gap(x, log_tau.exp(), mu, generative.prior_pi, candidates).unsqueeze(0))
+                posterior_logits = posterior_z(x, tau=log_tau.exp(), mu=mu, prior_pi=generative.prior_pi, candidates=candidates)
+                index = torch.distributions.Categorical(logits=posterior_logits).sample().unsqueeze(-1)
+                z = F.one_hot(candidates.gather(-1, index).squeeze(-1), self.K).float()
+            else:
+                posterior_logits = posterior_z(x,
+                                               tau=log_tau.exp(),
+                                               mu=mu,
+                                               prior_pi=generative.prior_pi,
+                                               table=table)
+                E_z = posterior_logits.exp().mean(0)
+                z = cat(logits=posterior_logits).sample()
+            log_joint = self.log_joint(generative, x, z=z, tau=log_tau.exp(), mu=mu, table=table)
             trace['density'].append(log_joint.unsqueeze(0))
         return log_tau, mu, trace
 
-    def log_joint(self, generative, x, z, tau, mu):
-        ll = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
+    def log_joint(self, generative, x, z, tau, mu, table=None):
+        ll = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True, table=table)
         log_prior_tau = Gamma(generative.prior_alpha, generative.prior_beta).log_prob(tau).sum(-1).sum(-1)
         log_prior_mu = Normal(generative.prior_mu, 1. / (generative.prior_nu * tau).sqrt()).log_prob(mu).sum(-1).sum(-1)
         log_prior_z = cat(probs=generative.prior_pi).log_prob(z).sum(-1)
         return (ll + log_prior_tau + log_prior_mu + log_prior_z)
 
-    def metrioplis(self, generative, x, log_tau, mu, step_size, num_steps):
+    def metrioplis(self, generative, x, log_tau, mu, step_size, num_steps, candidates=None):
+        """
+        return the accepted positions and their loglik_table, which is selected from the tables
+        already computed for the two hamiltonians
+        candidates : if given, the fixed candidate clusters of the truncated target (no tables are computed)
+        """
         r_tau, r_mu = self.init_sample()
+        if candidates is not None:
+            table_orig, table_new = None, None
+        else:
+            table_orig = generative.loglik_table(x, log_tau.exp(), mu)
         ## compute hamiltonian given original position and momentum
-        H_orig = self.hamiltonian(generative, x, log_tau=log_tau, mu=mu, r_tau=r_tau, r_mu=r_mu)
-        new_log_tau, new_mu, new_r_tau, new_r_mu = self.leapfrog(generative, x, log_tau, mu, r_tau, r_mu, step_size, num_steps)
+        H_orig = self.hamiltonian(generative, x, log_tau=log_tau, mu=mu, r_tau=r_tau, r_mu=r_mu, table=table_orig, candidates=candidates)
+        new_log_tau, new_mu, new_r_tau, new_r_mu = self.leapfrog(generative, x, log_tau, mu, r_tau, r_mu, step_size, num_steps, candidates=candidates)
         ## compute hamiltonian given new proposals
-        H_new = self.hamiltonian(generative, x, log_tau=new_log_tau, mu=new_mu, r_tau=new_r_tau, r_mu=new_r_mu)
+        if candidates is None:
+            table_new = generative.loglik_table(x, new_log_tau.exp(), new_mu)
+        H_new = self.hamiltonian(generative, x, log_tau=new_log_tau, mu=new_mu, r_tau=new_r_tau, r_mu=new_r_mu, table=table_new, candidates=candidates)
         accept_ratio = (H_new - H_orig).exp()
         u_samples = self.uniformer.sample((self.S, self.B, )).squeeze(-1)
         accept_index = (u_samples < accept_ratio)
@@ -72,31 +102,34 @@ class HMC():
         filtered_log_tau = new_log_tau * accept_index_expand.float() + log_tau * (~accept_index_expand).float()
         filtered_mu = new_mu * accept_index_expand.float() + mu * (~accept_index_expand).float()
         self.accept_count = self.accept_count + accept_index_expand.float()
-        return filtered_log_tau.detach(), filtered_mu.detach()
+        if candidates is not None:
+            return filtered_log_tau.detach(), filtered_mu.detach(), None
+        filtered_table = torch.where(accept_index.unsqueeze(-1).unsqueeze(-1), table_new, table_orig)
+        return filtered_log_tau.detach(), filtered_mu.detach(), filtered_table.detach()
 
-    def leapfrog(self, generative, x, log_tau, mu, r_tau, r_mu, step_size, num_steps):
+    def leapfrog(self, generative, x, log_tau, mu, r_tau, r_mu, step_size, num_steps, candidates=None):
         for step in range(num_steps):
             log_tau.requires_grad, mu.requires_grad = True, True
-            log_p = self.log_marginal(generative, x, log_tau, mu)
+            log_p = self.log_marginal(generative, x, log_tau, mu, candidates=candidates)
             log_p.sum().backward(retain_graph=False)
             r_tau = (r_tau + 0.5 * step_size * log_tau.grad).detach()
             r_mu = (r_mu + 0.5 * step_size * mu.grad).detach()
             log_tau = (log_tau + step_size * r_tau).detach()
             mu = (mu + step_size * r_mu).detach()
             log_tau.requires_grad, mu.requires_grad = True, True
-            log_p = self.log_marginal(generative, x, log_tau, mu)
+            log_p = self.log_marginal(generative, x, log_tau, mu, candidates=candidates)
             log_p.sum().backward(retain_graph=False)
             r_tau = (r_tau + 0.5 * step_size * log_tau.grad).detach()
             r_mu = (r_mu + 0.5 * step_size * mu.grad).detach()
             log_tau, mu = log_tau.detach(), mu.detach()
         return log_tau, mu, r_tau, r_mu
 
-    def hamiltonian(self, generative, x, log_tau, mu, r_tau, r_mu):
+    def hamiltonian(self, generative, x, log_tau, mu, r_tau, r_mu, table=None, candidates=None):
         """
         compute the Hamiltonian given the position and momntum
         """
         Kp = self.kinetic_energy(r_tau=r_tau, r_mu=r_mu)
-        Uq = self.log_marginal(generative, x, log_tau=log_tau, mu=mu)
+        Uq = self.log_marginal(generative, x, log_tau=log_tau, mu=mu, table=table, candidates=candidates)
         assert Kp.shape == (self.S, self.B), "ERROR! Kp has unexpected shape."
         assert Uq.shape ==  (self.S, self.B), 'ERROR! Uq has unexpected shape.'
         return Kp + Uq
@@ -108,19 +141,22 @@ class HMC():
         """
         return - ((r_tau ** 2).sum(-1).sum(-1) + (r_mu ** 2).sum(-1).sum(-1)) * 0.5
 
-    def log_marginal(self, generative, x, log_tau, mu):
+    def log_marginal(self, generative, x, log_tau, mu, table=None, candidates=None):
         """
         compute log density log p(x_1:N, mu_1:N, tau_1:N)
         by marginalizing discrete varaibles :                                   
         = \sum_{n=1}^N [log(\sum_{k=1}^K N(x_n; \mu_k, \Sigma_k)) - log(K)]
           + \sum_{k=1}^K [log p(\mu_k) + log p(\Sigma_k)]
+        candidates : if given (S * B * N * c), the inner sum only runs over the candidate clusters of each point,
+        i.e. the truncated marginal, which differs from the exact one by truncation_gap
         """
         tau = log_tau.exp()
-        sigma = 1. / tau.sqrt()
         logprior_tau =(Gamma(generative.prior_alpha, generative.prior_beta).log_prob(tau) + log_tau).sum(-1).sum(-1)  # S * B
         logprior_mu = Normal(generative.prior_mu, 1. / (generative.prior_nu * tau).sqrt()).log_prob(mu).sum(-1).sum(-1) 
-        mu_expand = mu.unsqueeze(2).repeat(1, 1, self.N, 1, 1).permute(3, 0, 1, 2, 4)
-        sigma_expand = sigma.unsqueeze(2).repeat(1, 1, self.N, 1, 1).permute(3, 0, 1, 2, 4) #  K * S * B * N * D
-        ll = Normal(mu_expand, sigma_expand).log_prob(x).sum(-1).permute(1, 2, 3, 0) # S * B * N * K
-        log_density = torch.logsumexp(generative.prior_pi.log() + ll, dim=-1).sum(-1)
+        if candidates is not None:
+            ll = candidate_loglik(x, tau, mu, candidates) + generative.prior_pi.log()[candidates] # S * B * N * c
+            log_density = torch.logsumexp(ll, dim=-1).sum(-1)
+        else:
+            ll = generative.loglik_table(x, tau, mu) if table is None else table # S * B * N * K
+            log_density = torch.logsumexp(generative.prior_pi.log() + ll, dim=-1).sum(-1)
         return log_density + logprior_mu + logprior_tau
@@ -1,13 +1,14 @@
+import math
 import torch
 import torch.nn.functional as F
 from torch.distributions.normal import Normal
 
-def kls_eta(models, ob, z):
+def kls_eta(models, ob, z, mask=None):
     """
     compute the KL divergence KL(p(\eta | x, z)|| q(\eta | x, z))
     """
     (_, _, enc_apg_eta, generative) = models   
-    q_f_eta = enc_apg_eta(ob=ob, z=z, prior_ng=generative.prior_ng, sampled=True)
+    q_f_eta = enc_apg_eta(ob=ob, z=z, prior_ng=generative.prior_ng, sampled=True, mask=mask)
     mu = q_f_eta['means'].value
     tau = q_f_eta['precisions'].value
     ## KLs for mu and sigma based on Normal-Gamma prior
@@ -22,7 +23,8 @@ def kls_eta(models, ob, z):
                                                                                 prior_alpha=generative.prior_alpha,
                                                                                 prior_beta=generative.prior_beta,
                                                                                 prior_mu=generative.prior_mu,
-                                                                                prior_nu=generative.prior_nu)
+                                                                                prior_nu=generative.prior_nu,
+                                                                                mask=mask)
     kl_eta_ex, kl_eta_in = kls_NGs(q_alpha=q_alpha,
                                    q_beta=q_beta,
                                    q_mu=q_mu,
@@ -89,47 +91,117 @@ def nats_to_params(nat1, nat2, nat3, nat4):
     beta = - nat2 - (nu * (mu**2) / 2)
     return alpha, beta, mu, nu
 
-def data_to_stats(ob, z):
+def data_to_stats(ob, z, K=None, mask=None):
     """
     pointwise sufficient statstics
     stat1 : sum of I[z_n=k], S * B * K * 1
     stat2 : sum of I[z_n=k]*x_n, S * B * K * D
     stat3 : sum of I[z_n=k]*x_n^2, S * B * K * D
+    computed as batched matmuls z^T x and z^T x^2 over the N dim,
+    or by scatter_add if z holds S * B * N integer labels (then K is required)
+    mask : S * B * N, 1 for the real points and 0 for the padding, which then does not count
     """
+    if not z.dtype.is_floating_point:
+        S, B, N, D = ob.shape
+        labels = z.long()
+        weights = ob.new_ones((S, B, N)) if mask is None else mask.to(ob.dtype)
+        stat1 = ob.new_zeros((S, B, K)).scatter_add_(2, labels, weights).unsqueeze(-1)
+        index = labels.unsqueeze(-1).expand(S, B, N, D)
+        weighted_ob = ob * weights.unsqueeze(-1)
+        stat2 = ob.new_zeros((S, B, K, D)).scatter_add_(2, index, weighted_ob)
+        stat3 = ob.new_zeros((S, B, K, D)).scatter_add_(2, index, weighted_ob * ob)
+        return stat1, stat2, stat3
+    if mask is not None:
+        z = z * mask.unsqueeze(-1)
     stat1 = z.sum(2).unsqueeze(-1)
-    z_expand = z.unsqueeze(-1).repeat(1, 1, 1, 1, ob.shape[-1])
-    ob_expand = ob.unsqueeze(-1).repeat(1, 1, 1, 1, z.shape[-1]).transpose(-1, -2)
-    stat2 = (z_expand * ob_expand).sum(2)
-    stat3 = (z_expand * (ob_expand**2)).sum(2)
+    z_t = z.transpose(-1, -2) ## S * B * K * N
+    stat2 = torch.matmul(z_t, ob)
+    stat3 = torch.matmul(z_t, ob**2)
     return stat1, stat2, stat3
 
-def posterior_eta(ob, z, prior_alpha, prior_beta, prior_mu, prior_nu):
+def posterior_eta(ob, z, prior_alpha, prior_beta, prior_mu, prior_nu, mask=None):
     """
     conjugate postrior of eta, given the normal-gamma prior
+    z : assignments S * B * N * K, or integer labels S * B * N
     """
-    stat1, stat2, stat3 = data_to_stats(ob, z)
-    stat1_expand = stat1.repeat(1, 1, 1, ob.shape[-1]) ## S * B * K * D
-    stat1_nonzero = stat1_expand
-    stat1_nonzero[stat1_nonzero == 0.0] = 1.0
+    stat1, stat2, stat3 = data_to_stats(ob, z, K=prior_alpha.shape[-2], mask=mask)
+    return posterior_from_stats(stat1, stat2, stat3, prior_alpha, prior_beta, prior_mu, prior_nu)
+
+def posterior_from_stats(stat1, stat2, stat3, prior_alpha, prior_beta, prior_mu, prior_nu):
+    """
+    conjugate postrior of eta from the sufficient statistics of data_to_stats,
+    which are sums over N and can be accumulated chunk by chunk
+    """
+    ## stat1 : S * B * K * 1 broadcasts over D
+    stat1_nonzero = torch.where(stat1 == 0.0, torch.ones_like(stat1), stat1) ## only guards the divisions of empty clusters
     x_bar = stat2 / stat1_nonzero
-    post_alpha = prior_alpha + stat1_expand / 2
-    post_nu = prior_nu + stat1_expand
-    post_mu = (prior_mu * prior_nu + stat2) / (stat1_expand + prior_nu)
-    post_beta = prior_beta + (stat3 - (stat2 ** 2) / stat1_nonzero) / 2. + (stat1_expand * prior_nu / (stat1_expand + prior_nu)) * ((x_bar - prior_nu)**2) / 2.
+    post_alpha = prior_alpha + stat1 / 2
+    post_nu = prior_nu + stat1
+    post_mu = (prior_mu * prior_nu + stat2) / (stat1 + prior_nu)
+    post_beta = prior_beta + (stat3 - (stat2 ** 2) / stat1_nonzero) / 2. + (stat1 * prior_nu / (stat1 + prior_nu)) * ((x_bar - prior_nu)**2) / 2.
     return post_alpha, post_beta, post_mu, post_nu
 
-def posterior_z(ob, tau, mu, prior_pi):
+def loglik_from_stats(stat1, stat2, stat3, tau, mu):
+    """
+    log likelihood of the points summarized by data_to_stats, S * B,
+    i.e. the sum over k and d of stat1 * (log tau - log 2pi) / 2 - tau * (stat3 - 2 * mu * stat2 + stat1 * mu^2) / 2
+    """
+    return (0.5 * stat1 * (tau.log() - math.log(2 * math.pi)) - 0.5 * tau * (stat3 - 2 * mu * stat2 + stat1 * (mu**2))).sum(-1).sum(-1)
+
+def loglik_table(ob, tau, mu):
+    """
+    log N(x_n; mu_k, 1 / tau_k) summed over D, for every pair of data point and cluster
+    ob : S * B * N * D, tau, mu : S * B * K * D ===> S * B * N * K
+    tau * (x - mu)^2 is expanded into x^2 tau - 2 x mu tau + mu^2 tau, i.e. two matmuls and per-cluster terms
+    """
+    quadratic = torch.matmul(ob**2, tau.transpose(-1, -2)) - 2 * torch.matmul(ob, (mu * tau).transpose(-1, -2)) # S * B * N * K
+    log_normalizers = 0.5 * (tau.log() - (mu**2) * tau - math.log(2 * math.pi)).sum(-1) # S * B * K
+    return log_normalizers.unsqueeze(-2) - 0.5 * quadratic
+
+def candidate_clusters(ob, mu, num_candidates):
+    """
+    indices of the num_candidates clusters whose means are nearest to each point, S * B * N * c,
+    by a batched torch.cdist and topk, so that only these clusters need to be scored when K is large
+    """
+    S, B, N, D = ob.shape
+    dists = torch.cdist(ob.reshape(S*B, N, D), mu.reshape(S*B, -1, D))
+    return dists.topk(num_candidates, dim=-1, largest=False)[1].view(S, B, N, num_candidates)
+
+def candidate_loglik(ob, tau, mu, candidates):
+    """
+    log N(x_n; mu_k, 1 / tau_k) summed over D, for the candidate clusters k of each point
+    ob : S * B * N * D, tau, mu : S * B * K * D, candidates : S * B * N * c ===> S * B * N * c
+    """
+    S, B, N, c = candidates.shape
+    D = ob.shape[-1]
+    index = candidates.reshape(S, B, N*c, 1).expand(S, B, N*c, D)
+    mu_c = torch.gather(mu, 2, index).view(S, B, N, c, D)
+    tau_c = torch.gather(tau, 2, index).view(S, B, N, c, D)
+    return (0.5 * (tau_c.log() - math.log(2 * math.pi)) - 0.5 * tau_c * (ob.unsqueeze(-2) - mu_c)**2).sum(-1)
+
+def truncation_gap(ob, tau, mu, prior_pi, candidates):
+    """
+    sum over the points of the log posterior mass of their candidate clusters, S * B,
+    i.e. the log marginal p(x | eta) truncated to the candidates minus the exact one (<= 0).
+    it needs the full loglik_table, so it costs O(N * K) and is meant as a diagnostic
+    """
+    log_gammas = loglik_table(ob, tau, mu) + prior_pi.log() # S * B * N * K
+    return (torch.logsumexp(log_gammas.gather(-1, candidates), dim=-1) - torch.logsumexp(log_gammas, dim=-1)).sum(-1)
+
+def posterior_z(ob, tau, mu, prior_pi, table=None, candidates=None):
     """
     posterior of z, given the Gaussian likelihood and the uniform prior
+    table : if given, the loglik_table of (tau, mu)
+    candidates : if given (S * B * N * c, see candidate_clusters), return the posterior truncated to the candidate clusters,
+    i.e. S * B * N * c logits over the candidates, the mass of the other clusters is dropped
     """
-    N = ob.shape[-2]
-    K = mu.shape[-2]
-    sigma = 1. / tau.sqrt()
-    mu_expand = mu.unsqueeze(-2).repeat(1, 1, 1, N, 1) # S * B * K * N * D
-    sigma_expand = sigma.unsqueeze(-2).repeat(1, 1, 1, N, 1) # S * B * K * N * D
-    ob_expand = ob.unsqueeze(2).repeat(1, 1, K, 1, 1) #  S * B * K * N * D
-    log_gammas = Normal(mu_expand, sigma_expand).log_prob(ob_expand).sum(-1).transpose(-1, -2) + prior_pi.log() # S * B * N * K
-    post_logits = F.softmax(log_gammas, dim=-1).log()
+    if candidates is not None:
+        log_gammas = candidate_loglik(ob, tau, mu, candidates) + prior_pi.log()[candidates] # S * B * N * c
+        return F.log_softmax(log_gammas, dim=-1)
+    if table is None:
+        table = loglik_table(ob, tau, mu)
+    log_gammas = table + prior_pi.log() # S * B * N * K
+    post_logits = F.log_softmax(log_gammas, dim=-1)
     return post_logits
 
 ## some standard KL-divergence functions
@@ -1,17 +1,115 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions.normal import Normal
 from torch.distributions.gamma import Gamma
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
-from apgs.gmm.kls_gmm import posterior_eta
+from torch.distributions.categorical import Categorical
+from torch.distributions.distribution import Distribution
+from apgs.gmm.kls_gmm import posterior_from_stats, data_to_stats, loglik_table, candidate_clusters
+from apgs.chunking import chunked_sum
 import probtorch
 
+def sample_labels(probs):
+    """
+    Gumbel-max sampling of integer labels S * B * N from probabilities S * B * N * K,
+    stored as uint8 (int16 if K > 256) instead of one-hot float vectors
+    """
+    gumbels = - torch.log(- torch.log(torch.rand_like(probs).clamp(min=1e-20)))
+    labels = (probs.log() + gumbels).argmax(-1)
+    return labels.to(torch.uint8 if probs.shape[-1] <= 256 else torch.int16)
+
+def assignment_dist(z):
+    """
+    distribution class of the cluster assignments z: OneHotCategorical for one-hot vectors, Categorical for integer labels
+    """
+    return cat if z.dtype.is_floating_point else Categorical
+
+def labels_of(z):
+    """
+    integer labels of the cluster assignments z, S * B * N
+    """
+    return z.argmax(-1) if z.dtype.is_floating_point else z.long()
+
+class CandidateCategorical(Distribution):
+    """
+    proposal of the cluster assignments in the pruned mode of Enc_apg_z, kept sparse:
+    with probability 1 - tail_mass a point takes one of its c candidate clusters with the probabilities softmax(logits),
+    otherwise one of the other K - c clusters uniformly, so every cluster has probability at least tail_mass / (K - c).
+    sampling and log_prob cost O(N * c), only the probs property (for diagnostics) builds the dense S * B * N * K tensor
+    candidates : S * B * N * c, logits : S * B * N * c
+    one_hot : if True, sample one-hot vectors S * B * N * K instead of integer labels S * B * N
+    """
+    arg_constraints = {}
+
+    def __init__(self, candidates, logits, num_clusters, tail_mass, one_hot=False):
+        self.candidates = candidates
+        self.logits = F.log_softmax(logits, -1)
+        self.num_clusters = num_clusters
+        self.tail_mass = tail_mass
+        self.one_hot = one_hot
+        self.log_tail = math.log(tail_mass / (num_clusters - candidates.shape[-1]))
+        super(CandidateCategorical, self).__init__(batch_shape=candidates.shape[:-1], event_shape=(num_clusters,) if one_hot else (), validate_args=False)
+
+    def sample(self, sample_shape=torch.Size()):
+        assert len(sample_shape) == 0, "ERROR! CandidateCategorical only draws one sample per point."
+        with torch.no_grad():
+            head = self.candidates.gather(-1, Categorical(logits=self.logits).sample().unsqueeze(-1)).squeeze(-1)
+            ## the r-th non-candidate cluster: r is shifted past every candidate (in ascending order) that it reaches
+            num_others = self.num_clusters - self.candidates.shape[-1]
+            tail = (torch.rand(self.batch_shape, device=head.device) * num_others).long().clamp(max=num_others-1)
+            for candidate in self.candidates.sort(-1)[0].unbind(-1):
+                tail = tail + (tail >= candidate).long()
+            labels = torch.where(torch.rand(self.batch_shape, device=head.device) < self.tail_mass, tail, head)
+        if self.one_hot:
+            return F.one_hot(labels, self.num_clusters).float()
+        return labels.to(torch.uint8 if self.num_clusters <= 256 else torch.int16)
+
+    def in_tail(self, value):
+        """
+        S * B * N, True for the assignments outside the candidates, whose probability is tail_mass / (K - c)
+        """
+        return ~(self.candidates == labels_of(value).unsqueeze(-1)).any(-1)
+
+    def log_prob(self, value):
+        match = self.candidates == labels_of(value).unsqueeze(-1)
+        head = self.logits.gather(-1, match.long().argmax(-1, keepdim=True)).squeeze(-1) + math.log(1 - self.tail_mass)
+        return torch.where(match.any(-1), head, torch.full_like(head, self.log_tail))
+
+    @property
+    def probs(self):
+        probs = self.logits.new_full(self.batch_shape + (self.num_clusters,), self.tail_mass / (self.num_clusters - self.candidates.shape[-1]))
+        return probs.scatter(-1, self.candidates, (1 - self.tail_mass) * self.logits.exp())
+
+def masked(log_prob, mask):
+    """
+    log_prob : S * B * N pointwise log densities, with those of the padded points (mask = 0) set to 0
+    """
+    if mask is None:
+        return log_prob
+    return torch.where(mask > 0, log_prob, torch.zeros_like(log_prob))
+
+def ob_z_linear(linear, ob, z):
+    """
+    linear applied to torch.cat((ob, z), -1) without building the concatenation:
+    W_ob * ob + b, plus the z part as a lookup of the columns of W_z if z holds integer labels (S * B * N),
+    or as a dense product if z is one-hot / soft (S * B * N * K)
+    """
+    D = ob.shape[-1]
+    out = F.linear(ob, linear.weight[:, :D], linear.bias)
+    if z.dtype.is_floating_point:
+        return out + F.linear(z, linear.weight[:, D:])
+    return out + F.embedding(z.long(), linear.weight[:, D:].t())
+
 class Enc_rws_eta(nn.Module):
     """
     One-shot (i.e.RWS) encoder of {mean, covariance} i.e. \eta
     """
-    def __init__(self, K, D):
+    def __init__(self, K, D, chunk_size=None):
+        """
+        chunk_size : if given, the statistics are accumulated over chunks of chunk_size points along N
+        """
         super(self.__class__, self).__init__()
 
         self.gamma = nn.Sequential(
@@ -20,11 +118,22 @@ class Enc_rws_eta(nn.Module):
 
         self.ob = nn.Sequential(
             nn.Linear(D, D))
+        self.chunk_size = chunk_size
 
-    def forward(self, ob, prior_ng, sampled=True, tau_old=None, mu_old=None):
+    def stats(self, ob, mask=None):
+        return data_to_stats(self.ob(ob), self.gamma(ob), mask=mask)
+
+    def forward(self, ob, prior_ng, sampled=True, tau_old=None, mu_old=None, mask=None):
+        """
+        mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances
+        """
         q = probtorch.Trace()
         (prior_alpha, prior_beta, prior_mu, prior_nu) = prior_ng
-        q_alpha, q_beta, q_mu, q_nu = posterior_eta(self.ob(ob) , self.gamma(ob), prior_alpha, prior_beta, prior_mu, prior_nu)
+        if self.chunk_size is None:
+            stat1, stat2, stat3 = self.stats(ob, mask)
+        else:
+            stat1, stat2, stat3 = chunked_sum(self.stats, (ob,) if mask is None else (ob, mask), self.chunk_size)
+        q_alpha, q_beta, q_mu, q_nu = posterior_from_stats(stat1, stat2, stat3, prior_alpha, prior_beta, prior_mu, prior_nu)
         if sampled: ## used in forward transition kernel where we need to sample
             tau = Gamma(q_alpha, q_beta).sample()
             q.gamma(q_alpha,
@@ -51,19 +160,38 @@ class Enc_apg_eta(nn.Module):
     """
     Conditional proposal of {mean, covariance} i.e. \eta
     """
-    def __init__(self, K, D):
+    def __init__(self, K, D, chunk_size=None):
+        """
+        chunk_size : if given, the statistics are accumulated over chunks of chunk_size points along N
+        """
         super(self.__class__, self).__init__()
         self.gamma = nn.Sequential(
             nn.Linear(K+D, K),
             nn.Softmax(-1))
         self.ob = nn.Sequential(
             nn.Linear(K+D, D))
+        self.chunk_size = chunk_size
+
+    def stats(self, ob, z, mask=None):
+        ## the layers act on the concatenation of observations and cluster assignments
+        gamma = self.gamma[1](ob_z_linear(self.gamma[0], ob, z))
+        return data_to_stats(ob_z_linear(self.ob[0], ob, z), gamma, mask=mask)
 
-    def forward(self, ob, z, prior_ng, sampled=True, tau_old=None, mu_old=None):
+    def forward(self, ob, z, prior_ng, sampled=True, tau_old=None, mu_old=None, stats=None, mask=None):
+        """
+        z : one-hot cluster assignments S * B * N * K, or integer labels S * B * N
+        stats : if given, the (stat1, stat2, stat3) of self.stats summed over the points, then ob and z are not used
+        mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances
+        """
         q = probtorch.Trace()
         (prior_alpha, prior_beta, prior_mu, prior_nu) = prior_ng
-        ob_z = torch.cat((ob, z), -1) # concatenate observations and cluster asssignemnts
-        q_alpha, q_beta, q_mu, q_nu = posterior_eta(self.ob(ob_z) , self.gamma(ob_z), prior_alpha, prior_beta, prior_mu, prior_nu)
+        if stats is not None:
+            stat1, stat2, stat3 = stats
+        elif self.chunk_size is None:
+            stat1, stat2, stat3 = self.stats(ob, z, mask)
+        else:
+            stat1, stat2, stat3 = chunked_sum(self.stats, (ob, z) if mask is None else (ob, z, mask), self.chunk_size)
+        q_alpha, q_beta, q_mu, q_nu = posterior_from_stats(stat1, stat2, stat3, prior_alpha, prior_beta, prior_mu, prior_nu)
         
         if sampled == True:
             tau = Gamma(q_alpha, q_beta).sample()
@@ -92,28 +220,86 @@ class Enc_apg_z(nn.Module):
     """
     Conditional proposal of cluster assignments z
     """
-    def __init__(self, K, D, num_hidden):
+    def __init__(self, K, D, num_hidden, factorized=True, integer_labels=False, num_candidates=None, tail_mass=1e-3):
+        """
+        factorized : if True, evaluate the first layer of pi_log_prob per point and per cluster (see factorized_logits),
+        otherwise loop over the clusters on the concatenated inputs. Both use the same parameters.
+        integer_labels : if True, sample z as integer labels S * B * N instead of one-hot vectors S * B * N * K
+        num_candidates : if given and smaller than K, score only the num_candidates nearest clusters of each point
+        and propose z from a sparse CandidateCategorical (see candidate_logits)
+        tail_mass : the proposal probability shared by the other clusters in the pruned mode
+        """
         super(self.__class__, self).__init__()
         self.pi_log_prob = nn.Sequential(
             nn.Linear(3*D, num_hidden),
             nn.Tanh(),
             nn.Linear(num_hidden, 1))
+        self.factorized = factorized
+        self.integer_labels = integer_labels
+        self.num_candidates = num_candidates
+        self.tail_mass = tail_mass
+
+    def pruned(self, mu):
+        return self.num_candidates is not None and self.num_candidates < mu.shape[-2]
 
     def forward(self, ob, tau, mu, sampled=True, z_old=None):
         q = probtorch.Trace()
-        gamma_list = []
-        N = ob.shape[-2]
-        for k in range(mu.shape[-2]):
-            data_ck = torch.cat((ob, mu[:, :, k, :].unsqueeze(-2).repeat(1,1,N,1), tau[:, :, k, :].unsqueeze(-2).repeat(1, 1, N, 1)), -1) ## S * B * N * 3D
-            gamma_list.append(self.pi_log_prob(data_ck))
-        q_probs = F.softmax(torch.cat(gamma_list, -1), -1)
+        if self.pruned(mu):
+            candidates, logits = self.candidate_logits(ob, tau, mu)
+            params = {'candidates' : candidates, 'logits' : logits, 'num_clusters' : mu.shape[-2], 'tail_mass' : self.tail_mass, 'one_hot' : not self.integer_labels}
+            z = CandidateCategorical(**params).sample() if sampled == True else z_old
+            _ = q.variable(CandidateCategorical, value=z, name='states', **params)
+            return q
+        if self.factorized:
+            logits = self.factorized_logits(ob, tau, mu)
+        else:
+            gamma_list = []
+            N = ob.shape[-2]
+            for k in range(mu.shape[-2]):
+                data_ck = torch.cat((ob, mu[:, :, k, :].unsqueeze(-2).repeat(1,1,N,1), tau[:, :, k, :].unsqueeze(-2).repeat(1, 1, N, 1)), -1) ## S * B * N * 3D
+                gamma_list.append(self.pi_log_prob(data_ck))
+            logits = torch.cat(gamma_list, -1)
+        q_probs = F.softmax(logits, -1)
         if sampled == True:
-            z = cat(q_probs).sample()
-            _ = q.variable(cat, probs=q_probs, value=z, name='states')
+            z = sample_labels(q_probs) if self.integer_labels else cat(q_probs).sample()
+            _ = q.variable(assignment_dist(z), probs=q_probs, value=z, name='states')
         else:
-            _ = q.variable(cat, probs=q_probs, value=z_old, name='states')
+            _ = q.variable(assignment_dist(z_old), probs=q_probs, value=z_old, name='states')
         return q
-    
+
+    def factorized_logits(self, ob, tau, mu):
+        """
+        the first layer on cat(x_n, mu_k, tau_k) equals W_x x_n + (W_mu mu_k + W_tau tau_k) + b,
+        so the point term (S * B * N * H) and the cluster term (S * B * K * H) are computed once
+        and broadcast-added into the S * B * N * K * H hidden units
+        return S * B * N * K logits
+        """
+        D = ob.shape[-1]
+        first_layer, activation, last_layer = self.pi_log_prob
+        hidden_ob = F.linear(ob, first_layer.weight[:, :D], first_layer.bias)
+        hidden_eta = F.linear(torch.cat((mu, tau), -1), first_layer.weight[:, D:])
+        hidden = activation(hidden_ob.unsqueeze(-2) + hidden_eta.unsqueeze(-3))
+        return last_layer(hidden).squeeze(-1)
+
+    def candidate_logits(self, ob, tau, mu):
+        """
+        the network scores only the c = num_candidates nearest clusters of each point, S * B * N * c * H hidden units,
+        its softmax over them gets 1 - tail_mass, while the other K - c clusters share tail_mass uniformly (CandidateCategorical).
+        every z keeps a nonzero proposal probability, bounded below by tail_mass / (K - c),
+        so the importance weights stay unbiased when a point belongs to a pruned cluster
+        return the candidates and their logits, both S * B * N * c
+        """
+        S, B, N, D = ob.shape
+        candidates = candidate_clusters(ob, mu, self.num_candidates)
+        c = candidates.shape[-1]
+        first_layer, activation, last_layer = self.pi_log_prob
+        hidden_ob = F.linear(ob, first_layer.weight[:, :D], first_layer.bias) # S * B * N * H
+        hidden_eta = F.linear(torch.cat((mu, tau), -1), first_layer.weight[:, D:]) # S * B * K * H
+        H = hidden_eta.shape[-1]
+        hidden_eta = torch.gather(hidden_eta, 2, candidates.reshape(S, B, N*c, 1).expand(S, B, N*c, H)).view(S, B, N, c, H)
+        logits = last_layer(activation(hidden_ob.unsqueeze(-2) + hidden_eta)).squeeze(-1) # S * B * N * c
+        return candidates, logits
+
 class Generative():
     """
     The generative model of GMM
@@ -166,20 +352,33 @@ class Generative():
 
     def z_prior(self, q):
         p = probtorch.Trace()
-        _ = p.variable(cat, probs=self.prior_pi, value=q['states'], name='states')
+        _ = p.variable(assignment_dist(q['states'].value), probs=self.prior_pi, value=q['states'], name='states')
         return p
 
-    def log_prob(self, ob, z , tau, mu, aggregate=False):
+    def loglik_table(self, ob, tau, mu):
+        """
+        S * B * N * K log densities of every data point under every cluster,
+        compute it once per (tau, mu) and pass it as table to log_prob / posterior_z to reuse it
+        """
+        return loglik_table(ob, tau, mu)
+
+    def log_prob(self, ob, z , tau, mu, aggregate=False, table=None, mask=None):
         """
         aggregate = False : return S * B * N
         aggregate = True : return S * B * K
+        table : if given, the loglik_table of (tau, mu), the likelihoods are then looked up instead of recomputed
+        mask : S * B * N, the padded points get likelihood 0
         """
-        sigma = 1. / tau.sqrt()
-        labels = z.argmax(-1)
-        labels_flat = labels.unsqueeze(-1).repeat(1, 1, 1, ob.shape[-1])
-        mu_expand = torch.gather(mu, 2, labels_flat)
-        sigma_expand = torch.gather(sigma, 2, labels_flat)
-        ll = Normal(mu_expand, sigma_expand).log_prob(ob).sum(-1) # S * B * N
+        labels = labels_of(z)
+        if table is not None:
+            ll = table.gather(-1, labels.unsqueeze(-1)).squeeze(-1) # S * B * N
+        else:
+            sigma = 1. / tau.sqrt()
+            labels_flat = labels.unsqueeze(-1).repeat(1, 1, 1, ob.shape[-1])
+            mu_expand = torch.gather(mu, 2, labels_flat)
+            sigma_expand = torch.gather(sigma, 2, labels_flat)
+            ll = Normal(mu_expand, sigma_expand).log_prob(ob).sum(-1) # S * B * N
+        ll = masked(ll, mask)
         if aggregate:
             ll = ll.sum(-1) # S * B
         return ll
@@ -5,8 +5,11 @@ from torch.distributions.gamma import Gamma
 from torch.distributions.uniform import Uniform
 from torch.distributions.one_hot_categorical import OneHotCategorical as cat
 from apgs.gmm.kls_gmm import kls_eta, posterior_eta, posterior_z
+from apgs.gmm.models import labels_of, masked
+from apgs.gmm.gibbs_sampler import Gibbs
+from apgs.resampler import ParticleState
 
-def apg_objective(models, x, result_flags, num_sweeps, block, resampler):
+def apg_objective(models, x, result_flags, num_sweeps, block, resampler, mask=None):
     """
     Amortized Population Gibbs objective in GMM problem
     ==========
@@ -23,21 +26,26 @@ def apg_objective(models, x, result_flags, num_sweeps, block, resampler):
     mu: S * B * K * D, cluster means, as global variables
     eta := {tau, mu} global block
     z : S * B * N * K, cluster assignments, as local variables
+    mask : S * B * N, 1 for the real points and 0 for the padding of ragged instances (None if all instances have N points)
     ==========
     """
     trace = {'loss' : [], 'ess' : [], 'E_tau' : [], 'E_mu' : [], 'E_z' : [], 'density' : []} ## a dictionary that tracks things needed during the sweeping
     (enc_rws_eta, enc_apg_z, enc_apg_eta, generative) = models
-    log_w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_apg_z, generative, x, trace, result_flags)
-    tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w)
+    log_w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_apg_z, generative, x, trace, result_flags, mask=mask)
+    particles = ParticleState(resampler, tau=tau, mu=mu, z=z)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
         if block == 'decomposed':
-            log_w_eta, tau, mu, trace = apg_update_eta(enc_apg_eta, generative, x, z, tau, mu, trace, result_flags)       
-            tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w_eta)
-            log_w_z, z, trace = apg_update_z(enc_apg_z, generative, x, tau, mu, z, trace, result_flags)
-            tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w_z)
+            tau, mu, z = particles.get('tau', 'mu', 'z')
+            log_w_eta, particles['tau'], particles['mu'], trace = apg_update_eta(enc_apg_eta, generative, x, z, tau, mu, log_w, trace, result_flags, mask=mask)
+            log_w = resample_variables(resampler, particles, log_weights=log_w_eta)
+            tau, mu, z = particles.get('tau', 'mu', 'z')
+            log_w_z, particles['z'], trace = apg_update_z(enc_apg_z, generative, x, tau, mu, z, log_w, trace, result_flags, mask=mask)
+            log_w = resample_variables(resampler, particles, log_weights=log_w_z)
         elif block == 'joint':
-            log_w, tau, mu, z, trace = apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z, tau, mu, trace, result_flags)
-            tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w)
+            tau, mu, z = particles.get('tau', 'mu', 'z')
+            log_w, particles['tau'], particles['mu'], particles['z'], trace = apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z, tau, mu, log_w, trace, result_flags, mask=mask)
+            log_w = resample_variables(resampler, particles, log_weights=log_w)
         else:
             raise ValueError
     if result_flags['loss_required']:
@@ -50,15 +58,17 @@ def apg_objective(models, x, result_flags, num_sweeps, block, resampler):
         trace['E_z'] = torch.cat(trace['E_z'], 0)  # (num_sweeps) * B * N * K
     if result_flags['density_required']:
         trace['density'] = torch.cat(trace['density'], 0)  # (num_sweeps) * S * B
+    if 'tail' in trace:
+        trace['tail'] = torch.cat(trace['tail'], 0) # (num_sweeps) * B
     return trace
 
-def rws_objective(models, x, result_flags):
+def rws_objective(models, x, result_flags, mask=None):
     """
     The objective of RWS method
     """
     trace = {'loss' : [], 'ess' : [], 'E_tau' : [], 'E_mu' : [], 'E_z' : [], 'density' : []} 
     (enc_rws_eta, enc_rws_z, generative) = models
-    w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags)
+    w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags, mask=mask)
     if result_flags['loss_required']:
         trace['loss'] = torch.cat(trace['loss'], 0)
     if result_flags['ess_required']:
@@ -71,11 +81,11 @@ def rws_objective(models, x, result_flags):
         trace['density'] = torch.cat(trace['density'], 0) 
     return trace
 
-def oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags):
+def oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags, mask=None):
     """
     One-shot for eta and z, like a normal RWS
     """
-    q_eta = enc_rws_eta(x, prior_ng=generative.prior_ng, sampled=True)
+    q_eta = enc_rws_eta(x, prior_ng=generative.prior_ng, sampled=True, mask=mask)
     p_eta = generative.eta_prior(q=q_eta)
     log_q_eta = q_eta['means'].log_prob.sum(-1).sum(-1) + q_eta['precisions'].log_prob.sum(-1).sum(-1)
     log_p_eta = p_eta['means'].log_prob.sum(-1).sum(-1) + p_eta['precisions'].log_prob.sum(-1).sum(-1)
@@ -83,10 +93,10 @@ def oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags):
     mu = q_eta['means'].value
     q_z = enc_rws_z(x, tau=tau, mu=mu, sampled=True)
     p_z = generative.z_prior(q=q_z)
-    log_q_z = q_z['states'].log_prob.sum(-1)
-    log_p_z = p_z['states'].log_prob.sum(-1) 
+    log_q_z = masked(q_z['states'].log_prob, mask).sum(-1)
+    log_p_z = masked(p_z['states'].log_prob, mask).sum(-1)
     z = q_z['states'].value 
-    ll = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
+    ll = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True, mask=mask)
     log_p = ll + log_p_eta + log_p_z
     log_q =  log_q_eta + log_q_z
     log_w = (log_p - log_q).detach()
@@ -109,11 +119,12 @@ def oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags):
         trace['density'].append(log_joint.unsqueeze(0)) 
     return log_w, tau, mu, z, trace
 
-def apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z_old, tau_old, mu_old, trace, result_flags):
+def apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z_old, tau_old, mu_old, log_w_carry, trace, result_flags, mask=None):
     """
     Jointly update all the variables
+    log_w_carry : S * B log weights carried over from instances that were not resampled
     """
-    q_f_eta = enc_apg_eta(x, z=z_old, prior_ng=generative.prior_ng, sampled=True) 
+    q_f_eta = enc_apg_eta(x, z=z_old, prior_ng=generative.prior_ng, sampled=True, mask=mask)
     p_f_eta = generative.eta_prior(q=q_f_eta)
     log_q_f_eta = q_f_eta['means'].log_prob.sum(-1).sum(-1) + q_f_eta['precisions'].log_prob.sum(-1).sum(-1)
     log_p_f_eta = p_f_eta['means'].log_prob.sum(-1).sum(-1) + p_f_eta['precisions'].log_prob.sum(-1).sum(-1)
@@ -121,23 +132,23 @@ def apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z_old, tau_old, mu_o
     mu = q_f_eta['means'].value
     q_f_z = enc_apg_z(x, tau=tau, mu=mu, sampled=True)
     p_f_z = generative.z_prior(q=q_f_z)
-    log_q_f_z = q_f_z['states'].log_prob.sum(-1)
-    log_p_f_z = p_f_z['states'].log_prob.sum(-1)
+    log_q_f_z = masked(q_f_z['states'].log_prob, mask).sum(-1)
+    log_p_f_z = masked(p_f_z['states'].log_prob, mask).sum(-1)
     z = q_f_z['states'].value
-    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
+    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True, mask=mask)
     log_w_f = ll_f + log_p_f_eta - log_q_f_eta - log_q_f_z + log_p_f_z
     ## backward
     q_b_z = enc_apg_z(x, tau=tau, mu=mu, sampled=False, z_old=z_old)
     p_b_z = generative.z_prior(q=q_b_z)
-    log_q_b_z = q_b_z['states'].log_prob.sum(-1)
-    log_p_b_z = p_b_z['states'].log_prob.sum(-1)
-    q_b_eta = enc_apg_eta(x, z=z_old, prior_ng=generative.prior_ng, sampled=False, tau_old=tau_old, mu_old=mu_old)
+    log_q_b_z = masked(q_b_z['states'].log_prob, mask).sum(-1)
+    log_p_b_z = masked(p_b_z['states'].log_prob, mask).sum(-1)
+    q_b_eta = enc_apg_eta(x, z=z_old, prior_ng=generative.prior_ng, sampled=False, tau_old=tau_old, mu_old=mu_old, mask=mask)
     p_b_eta = generative.eta_prior(q=q_b_eta)
     log_q_b_eta = q_b_eta['means'].log_prob.sum(-1).sum(-1) + q_b_eta['precisions'].log_prob.sum(-1).sum(-1)
     log_p_b_eta = p_b_eta['means'].log_prob.sum(-1).sum(-1) + p_b_eta['precisions'].log_prob.sum(-1).sum(-1)
-    ll_b = generative.log_prob(x, z=z_old, tau=tau_old, mu=mu_old, aggregate=True)
+    ll_b = generative.log_prob(x, z=z_old, tau=tau_old, mu=mu_old, aggregate=True, mask=mask)
     log_w_b = ll_b + log_p_b_eta - log_q_b_eta + log_p_b_z - log_q_b_z
-    log_w = (log_w_f - log_w_b).detach()
+    log_w = (log_w_carry + log_w_f - log_w_b).detach()
     w = F.softmax(log_w, 0).detach()
     if result_flags['loss_required']:
         loss = (w * (- log_q_f_eta - log_q_f_z)).sum(0).mean()
@@ -158,26 +169,27 @@ def apg_update_joint(enc_apg_z, enc_apg_eta, generative, x, z_old, tau_old, mu_o
     return log_w, tau, mu, z, trace
 
 
-def apg_update_eta(enc_apg_eta, generative, x, z, tau_old, mu_old, trace, result_flags):
+def apg_update_eta(enc_apg_eta, generative, x, z, tau_old, mu_old, log_w_carry, trace, result_flags, mask=None):
     """
     Given local variable z, update global variables eta := {mu, tau}.
+    log_w_carry : S * B log weights carried over from instances that were not resampled
     """
-    q_f = enc_apg_eta(x, z=z, prior_ng=generative.prior_ng, sampled=True) ## forward kernel
+    q_f = enc_apg_eta(x, z=z, prior_ng=generative.prior_ng, sampled=True, mask=mask) ## forward kernel
     p_f = generative.eta_prior(q=q_f)
     log_q_f = q_f['means'].log_prob.sum(-1).sum(-1) + q_f['precisions'].log_prob.sum(-1).sum(-1)
     log_p_f = p_f['means'].log_prob.sum(-1).sum(-1) + p_f['precisions'].log_prob.sum(-1).sum(-1)
     tau = q_f['precisions'].value
     mu = q_f['means'].value
-    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
+    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True, mask=mask)
     log_w_f = ll_f + log_p_f - log_q_f
     ## backward
-    q_b = enc_apg_eta(x, z=z, prior_ng=generative.prior_ng, sampled=False, tau_old=tau_old, mu_old=mu_old)
+    q_b = enc_apg_eta(x, z=z, prior_ng=generative.prior_ng, sampled=False, tau_old=tau_old, mu_old=mu_old, mask=mask)
     p_b = generative.eta_prior(q=q_b)
     log_q_b = q_b['means'].log_prob.sum(-1).sum(-1) + q_b['precisions'].log_prob.sum(-1).sum(-1)
     log_p_b = p_b['means'].log_prob.sum(-1).sum(-1) + p_b['precisions'].log_prob.sum(-1).sum(-1)
-    ll_b = generative.log_prob(x, z=z, tau=tau_old, mu=mu_old, aggregate=True)
+    ll_b = generative.log_prob(x, z=z, tau=tau_old, mu=mu_old, aggregate=True, mask=mask)
     log_w_b = ll_b + log_p_b - log_q_b
-    log_w = (log_w_f - log_w_b).detach()
+    log_w = (log_w_carry + log_w_f - log_w_b).detach()
     w = F.softmax(log_w, 0).detach()
     if result_flags['loss_required']:
         loss = (w * (- log_q_f)).sum(0).mean()
@@ -194,28 +206,32 @@ def apg_update_eta(enc_apg_eta, generative, x, z, tau_old, mu_old, trace, result
         trace['density'].append(log_p_f.unsqueeze(0)) # 1-by-B-length vector
     return log_w, tau, mu, trace
 
-def apg_update_z(enc_apg_z, generative, x, tau, mu, z_old, trace, result_flags):
+def apg_update_z(enc_apg_z, generative, x, tau, mu, z_old, log_w_carry, trace, result_flags, mask=None):
     """
     Given the current samples of global variable (eta = mu + tau),
     update local variable state i.e. z
+    log_w_carry : S * B log weights carried over from instances that were not resampled
+    the likelihood is evaluated only at the sampled and the old labels, O(N * D) per sweep.
+    in the pruned mode of enc_apg_z, trace['tail'] records the mean number of points per instance
+    whose forward or backward assignment was scored with the tail bound tail_mass / (K - c)
     """
     q_f = enc_apg_z(x, tau=tau, mu=mu, sampled=True)
     p_f = generative.z_prior(q=q_f)
-    log_q_f = q_f['states'].log_prob
-    log_p_f = p_f['states'].log_prob
+    log_q_f = masked(q_f['states'].log_prob, mask)
+    log_p_f = masked(p_f['states'].log_prob, mask)
     z = q_f['states'].value
-    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=False)
+    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=False, mask=mask)
     log_w_f = ll_f + log_p_f - log_q_f
     ## backward
     q_b = enc_apg_z(x, tau=tau, mu=mu, sampled=False, z_old=z_old)
     p_b = generative.z_prior(q=q_b)
-    log_q_b = q_b['states'].log_prob
-    log_p_b = p_b['states'].log_prob
-    ll_b = generative.log_prob(x, z=z_old, tau=tau, mu=mu, aggregate=False)
+    log_q_b = masked(q_b['states'].log_prob, mask)
+    log_p_b = masked(p_b['states'].log_prob, mask)
+    ll_b = generative.log_prob(x, z=z_old, tau=tau, mu=mu, aggregate=False, mask=mask)
     log_w_b = ll_b + log_p_b - log_q_b
     log_w_local = (log_w_f - log_w_b).detach()
-    w_local = F.softmax(log_w_local, 0).detach()
-    log_w = log_w_local.sum(-1)
+    w_local = F.softmax(log_w_local + log_w_carry.unsqueeze(-1), 0).detach()
+    log_w = log_w_carry + log_w_local.sum(-1)
     if result_flags['loss_required']:
         loss = (w_local * (- log_q_f)).sum(0).sum(-1).mean()
         trace['loss'][-1] = trace['loss'][-1] + loss.unsqueeze(0)
@@ -224,55 +240,41 @@ def apg_update_z(enc_apg_z, generative, x, tau, mu, z_old, trace, result_flags):
         trace['E_z'].append(E_z.unsqueeze(0))
     if result_flags['density_required']:
         trace['density'][-1] = trace['density'][-1] + (ll_f + log_p_f).sum(-1).unsqueeze(0)
+    if enc_apg_z.pruned(mu):
+        in_tail = q_f['states'].dist.in_tail(z).float() + q_b['states'].dist.in_tail(z_old).float()
+        tail = masked(in_tail, mask).sum(-1)
+        trace.setdefault('tail', []).append(tail.mean(0).unsqueeze(0)) # 1-by-B tensor
     return log_w, z, trace
 
-def resample_variables(resampler, tau, mu, z, log_weights):
-    ancestral_index = resampler.sample_ancestral_index(log_weights)
-    tau = resampler.resample_4dims(var=tau, ancestral_index=ancestral_index)
-    mu = resampler.resample_4dims(var=mu, ancestral_index=ancestral_index)
-    z = resampler.resample_4dims(var=z, ancestral_index=ancestral_index)
-    return tau, mu, z
+def resample_variables(resampler, particles, log_weights):
+    """
+    select ancestors and record them in the particle state, the variables are gathered when they are next read
+    """
+    ancestral_index, log_w_carry = resampler.select_ancestors(log_weights)
+    if ancestral_index is not None:
+        particles.resample(ancestral_index)
+    return log_w_carry
 
 
-def gibbs_objective(models, x, result_flags, num_sweeps):
+def gibbs_objective(models, x, result_flags, num_sweeps, burn_in=0, thinning=1, return_samples=False):
     """
-    The Gibbs sampler objective 
+    The Gibbs sampler objective, the chains start from the one-shot proposal
+    trace['density'] : the log joint of the one-shot samples followed by those of the kept sweeps
+    (every sweep by default, i.e. (num_sweeps) * S * B), see Gibbs.sampling for burn_in and thinning
+    trace['samples'] : tau, mu and z of the kept sweeps, if return_samples
     """
     trace = {'density' : []} 
     (enc_rws_eta, enc_rws_z, _, generative) = models
     _, tau, mu, z, trace = oneshot(enc_rws_eta, enc_rws_z, generative, x, trace, result_flags)
-    for m in range(num_sweeps-1):
-        tau, mu, z, trace = gibbs_sweep(generative, x, z, trace)
+    S, B, N, D = x.shape
+    gibbs = Gibbs(generative, S, B, N, generative.K, D, x.is_cuda, x.device)
+    densities, samples = gibbs.sampling(x, labels_of(z), num_sweeps-1, burn_in=burn_in, thinning=thinning, return_samples=return_samples)
     if result_flags['density_required']:
-        trace['density'] = torch.cat(trace['density'], 0)  # (num_sweeps) * S * B
+        trace['density'] = torch.cat(trace['density'] + [densities], 0)
+    if return_samples:
+        trace['samples'] = samples
     return trace
 
-def gibbs_sweep(generative, x, z, trace):
-    """
-    Gibbs updates
-    """
-    post_alpha, post_beta, post_mu, post_nu = posterior_eta(x,
-                                                            z=z,
-                                                            prior_alpha=generative.prior_alpha,
-                                                            prior_beta=generative.prior_beta,
-                                                            prior_mu=generative.prior_mu,
-                                                            prior_nu=generative.prior_nu)
-
-    E_tau = (post_alpha / post_beta).mean(0)
-    E_mu = post_mu.mean(0)
-    tau = Gamma(post_alpha, post_beta).sample()
-    mu = Normal(post_mu, 1. / (post_nu * tau).sqrt()).sample()
-    posterior_logits = posterior_z(x, tau, mu, generative.prior_pi)
-    E_z = posterior_logits.exp().mean(0)
-    z = cat(logits=posterior_logits).sample()
-    ll = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
-    log_prior_tau = Gamma(generative.prior_alpha, generative.prior_beta).log_prob(tau).sum(-1).sum(-1)
-    log_prior_mu = Normal(generative.prior_mu, 1. / (generative.prior_nu * tau).sqrt()).log_prob(mu).sum(-1).sum(-1)
-    log_prior_z = cat(probs=generative.prior_pi).log_prob(z).sum(-1)
-    log_joint = ll + log_prior_tau + log_prior_mu + log_prior_z
-    trace['density'].append(log_joint.unsqueeze(0)) # 1-by-B-length vector
-    return tau, mu, z, trace
-
 def hmc_objective(models, x, result_flags, hmc_sampler):
     """
     HMC + marginalization over discrete variables in GMM problem
@@ -286,25 +288,30 @@ def hmc_objective(models, x, result_flags, hmc_sampler):
                                                   mu=mu,
                                                   trace=trace)
     trace['density'] = torch.cat(trace['density'], 0)
+    if 'truncation' in trace:
+        trace['truncation'] = torch.cat(trace['truncation'], 0)
     return log_tau.exp(), mu, trace
 
-def bpg_objective(models, x, result_flags, num_sweeps, resampler):
+def bpg_objective(models, x, result_flags, num_sweeps, resampler, mask=None):
     """
     bpg objective
     """
     trace = {'density' : []} ## a dictionary that tracks things needed during the sweeping
     (enc_rws_eta, enc_apg_z, enc_apg_eta, generative) = models
-    log_w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_apg_z, generative, x, trace, result_flags)
-    tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w)
+    log_w, tau, mu, z, trace = oneshot(enc_rws_eta, enc_apg_z, generative, x, trace, result_flags, mask=mask)
+    particles = ParticleState(resampler, tau=tau, mu=mu, z=z)
+    log_w = resample_variables(resampler, particles, log_weights=log_w)
     for m in range(num_sweeps-1):
-        log_w_eta, tau, mu, trace = bpg_update_eta(generative, x, z, tau, mu, trace)
-        tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w_eta)
-        log_w_z, z, trace = apg_update_z(enc_apg_z, generative, x, tau, mu, z, trace, result_flags)
-        tau, mu, z = resample_variables(resampler, tau, mu, z, log_weights=log_w_z)
+        tau, mu, z = particles.get('tau', 'mu', 'z')
+        log_w_eta, particles['tau'], particles['mu'], trace = bpg_update_eta(generative, x, z, tau, mu, log_w, trace, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_eta)
+        tau, mu, z = particles.get('tau', 'mu', 'z')
+        log_w_z, particles['z'], trace = apg_update_z(enc_apg_z, generative, x, tau, mu, z, log_w, trace, result_flags, mask=mask)
+        log_w = resample_variables(resampler, particles, log_weights=log_w_z)
     trace['density'] = torch.cat(trace['density'], 0)  # (num_sweeps) * S * B
     return trace
 
-def bpg_update_eta(generative, x, z, tau_old, mu_old, trace):
+def bpg_update_eta(generative, x, z, tau_old, mu_old, log_w_carry, trace, mask=None):
     """
     Given local variable z, update global variables eta := {mu, tau}.
     """
@@ -313,8 +320,8 @@ def bpg_update_eta(generative, x, z, tau_old, mu_old, trace):
     log_p_f = q_f['means'].log_prob.sum(-1).sum(-1) + q_f['precisions'].log_prob.sum(-1).sum(-1)
     tau = q_f['precisions'].value
     mu = q_f['means'].value
-    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True)
-    ll_b = generative.log_prob(x, z=z, tau=tau_old, mu=mu_old, aggregate=True)
-    log_w = (ll_f - ll_b).detach()
+    ll_f = generative.log_prob(x, z=z, tau=tau, mu=mu, aggregate=True, mask=mask)
+    ll_b = generative.log_prob(x, z=z, tau=tau_old, mu=mu_old, aggregate=True, mask=mask)
+    log_w = (log_w_carry + ll_f - ll_b).detach()
     trace['density'].append(log_p_f.unsqueeze(0)) # 1-by-B-length vector
     return log_w, tau, mu, trace
\ No newline at end of file
@@ -0,0 +1,133 @@
+import torch
+import torch.nn.functional as F
+from apgs.gmm.kls_gmm import data_to_stats, loglik_from_stats
+from apgs.gmm.objectives import oneshot, apg_update_z, resample_variables
+from apgs.resampler import ParticleState
+
+"""
+Online APG inference in GMM, for instances whose points arrive over time
+==========
+the particles keep, besides tau and mu, the sums over the points seen so far of
+    enc_stats : the statistics pooled by Enc_apg_eta (Enc_apg_eta.stats)
+    data_stats : the sufficient statistics of the likelihood (data_to_stats)
+both are additive over the points, so when M new points arrive:
+    1. their z are proposed by Enc_apg_z given the current eta, and weighted by p(x_new, z_new | eta) / q(z_new)
+       as an extension of the target from N to N + M points
+    2. a few sweeps update eta from the cached sums plus the statistics of the new points,
+       and the z of the new points with apg_update_z
+    3. the statistics of the new points are added to the cached sums
+the assignments of the earlier points are not revisited, so an update costs O(M) rather than O(N).
+the z of every block of points is kept as its own particle variable z_0, z_1, ...,
+read lazily through the ParticleState, so the earlier blocks are not gathered at every resampling
+==========
+"""
+stat_names = ('enc_stat1', 'enc_stat2', 'enc_stat3', 'data_stat1', 'data_stat2', 'data_stat3')
+
+def ess(log_w):
+    w = F.softmax(log_w, 0)
+    return 1. / (w**2).sum(0)
+
+class OnlineGMM():
+    def __init__(self, models, resampler):
+        """
+        models : (enc_rws_eta, enc_apg_z, enc_apg_eta, generative) as returned by init_apg_models
+        """
+        (self.enc_rws_eta, self.enc_apg_z, self.enc_apg_eta, self.generative) = models
+        self.resampler = resampler
+        self.result_flags = {'loss_required' : False, 'ess_required' : False, 'mode_required' : False, 'density_required' : False}
+        self.particles = None
+        self.log_w = None
+        self.num_blocks = 0
+
+    def block_stats(self, x, z):
+        """
+        the enc_stats followed by the data_stats of the points x with assignments z
+        """
+        return self.enc_apg_eta.stats(x, z) + data_to_stats(x, z, K=self.generative.K)
+
+    def total_stats(self, x_new, z_new):
+        """
+        the cached sums plus the statistics of the new points
+        """
+        cached = self.particles.get(*stat_names)
+        return tuple(old + new for old, new in zip(cached, self.block_stats(x_new, z_new)))
+
+    def update_eta(self, x_new, z_new, tau_old, mu_old, log_w_carry):
+        """
+        apg_update_eta with the encoder and the likelihood evaluated on the statistics of all the points
+        """
+        stats = self.total_stats(x_new, z_new)
+        q_f = self.enc_apg_eta(None, None, prior_ng=self.generative.prior_ng, sampled=True, stats=stats[:3])
+        p_f = self.generative.eta_prior(q=q_f)
+        log_q_f = q_f['means'].log_prob.sum(-1).sum(-1) + q_f['precisions'].log_prob.sum(-1).sum(-1)
+        log_p_f = p_f['means'].log_prob.sum(-1).sum(-1) + p_f['precisions'].log_prob.sum(-1).sum(-1)
+        tau = q_f['precisions'].value
+        mu = q_f['means'].value
+        ll_f = loglik_from_stats(*stats[3:], tau=tau, mu=mu)
+        ## backward
+        q_b = self.enc_apg_eta(None, None, prior_ng=self.generative.prior_ng, sampled=False, tau_old=tau_old, mu_old=mu_old, stats=stats[:3])
+        p_b = self.generative.eta_prior(q=q_b)
+        log_q_b = q_b['means'].log_prob.sum(-1).sum(-1) + q_b['precisions'].log_prob.sum(-1).sum(-1)
+        log_p_b = p_b['means'].log_prob.sum(-1).sum(-1) + p_b['precisions'].log_prob.sum(-1).sum(-1)
+        ll_b = loglik_from_stats(*stats[3:], tau=tau_old, mu=mu_old)
+        log_w = log_w_carry + (ll_f + log_p_f - log_q_f) - (ll_b + log_p_b - log_q_b)
+        return log_w, tau, mu
+
+    def extend_z(self, x_new, tau, mu):
+        """
+        propose the z of the new points given eta and weight the particles by the incremental target
+        """
+        q = self.enc_apg_z(x_new, tau=tau, mu=mu, sampled=True)
+        p = self.generative.z_prior(q=q)
+        z = q['states'].value
+        ll = self.generative.log_prob(x_new, z=z, tau=tau, mu=mu, aggregate=True)
+        log_w = self.log_w + ll + p['states'].log_prob.sum(-1) - q['states'].log_prob.sum(-1)
+        return log_w, z
+
+    @torch.no_grad()
+    def append(self, x_new, num_sweeps=1):
+        """
+        x_new : S * B * M * D, the new points of every instance, repeated over the S particles
+        the first call initializes the particles with the one-shot proposal on its points
+        return the ESS after the proposal of the new z and after every update, (1 + 2 * num_sweeps) * B
+        """
+        S, B, M, D = x_new.shape
+        name = 'z_%d' % self.num_blocks
+        trace = {'loss' : [], 'ess' : [], 'E_tau' : [], 'E_mu' : [], 'E_z' : [], 'density' : []}
+        if self.particles is None:
+            log_w, tau, mu, z, trace = oneshot(self.enc_rws_eta, self.enc_apg_z, self.generative, x_new, trace, self.result_flags)
+            K = self.generative.K
+            cached = [x_new.new_zeros(shape) for shape in [(S, B, K, 1), (S, B, K, D), (S, B, K, D)] * 2]
+            self.particles = ParticleState(self.resampler, tau=tau, mu=mu, **dict(zip(stat_names, cached)))
+        else:
+            tau, mu = self.particles.get('tau', 'mu')
+            log_w, z = self.extend_z(x_new, tau, mu)
+        self.particles[name] = z
+        ess_trace = [ess(log_w)]
+        self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+        for m in range(num_sweeps):
+            tau, mu, z = self.particles.get('tau', 'mu', name)
+            log_w, self.particles['tau'], self.particles['mu'] = self.update_eta(x_new, z, tau, mu, self.log_w)
+            ess_trace.append(ess(log_w))
+            self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+            tau, mu, z = self.particles.get('tau', 'mu', name)
+            log_w, self.particles[name], trace = apg_update_z(self.enc_apg_z, self.generative, x_new, tau, mu, z, self.log_w, trace, self.result_flags)
+            ess_trace.append(ess(log_w))
+            self.log_w = resample_variables(self.resampler, self.particles, log_weights=log_w)
+        ## fold the new points into the cached sums
+        for stat_name, stat in zip(stat_names, self.total_stats(x_new, self.particles[name])):
+            self.particles[stat_name] = stat
+        self.num_blocks += 1
+        return torch.stack(ess_trace, 0)
+
+    def assignments(self):
+        """
+        z of all the points appended so far, concatenated along N
+        """
+        return torch.cat(self.particles.get(*['z_%d' % b for b in range(self.num_blocks)]), 2)
+
+    def globals(self):
+        """
+        tau, mu : S * B * K * D
+        """
+        return self.particles.get('tau', 'mu')
@@ -1,5 +1,6 @@
 import os
 import torch
+import multiprocessing as mp
 import numpy as np
 import matplotlib.pyplot as plt
 from apgs.gmm.evaluation import plot_cov_ellipse
@@ -37,6 +38,19 @@ class Sim_GMM():
         ob = Normal(mean[labels], sigma[labels]).sample()
         return ob.data.numpy(), precision.data.numpy(), mean.data.numpy(), assignment.data.numpy()
 
+    def sim_gmms(self, num_seqs):
+        """
+        simulate num_seqs instances at once, all the parameters and points are drawn by single batched ops
+        return ob : num_seqs * N * D (float32), labels : num_seqs * N (uint8), precision, mean : num_seqs * K * D
+        """
+        precision = Gamma(torch.ones((num_seqs, self.K, self.D)) * self.alpha, torch.ones((num_seqs, self.K, self.D)) * self.beta).sample()
+        sigma_of_mean = 1. / (precision * self.nu).sqrt()
+        mean = Normal(torch.ones((num_seqs, self.K, self.D)) * self.mu, sigma_of_mean).sample()
+        labels = torch.randint(self.K, (num_seqs, self.N)) ## uniform mixture weights
+        index = labels.unsqueeze(-1).expand(num_seqs, self.N, self.D)
+        ob = torch.gather(mean, 1, index) + torch.randn((num_seqs, self.N, self.D)) / torch.gather(precision, 1, index).sqrt()
+        return ob.float().numpy(), labels.to(torch.uint8).numpy(), precision.numpy(), mean.numpy()
+
     def viz_data(self, num_seqs=20, bound=15, fs=6, colors=['#AA3377', '#EE7733', '#0077BB', '#009988', '#555555', '#999933']):
         for s in range(num_seqs):
             ob, precision, mean, assignment = self.sim_one_gmm()
@@ -55,18 +69,41 @@ class Sim_GMM():
     def sim_save_data(self, num_seqs, PATH):
         if not os.path.exists(PATH):
             os.makedirs(PATH)
-        OB = np.zeros((num_seqs, self.N, self.D))
-        ASSIGNMENT = np.zeros((num_seqs, self.N, self.K))
-        # MEAN = np.zeros((num_seqs, self.K, self.D))
-        # SIGMA = np.zeros((num_seqs, self.K, self.D))
-        for s in range(num_seqs):
-            ob, precision, mean, assignment = self.sim_one_gmm()
-            OB[s] = ob
-            ASSIGNMENT[s] = assignment
+        OB, LABELS, _, _ = self.sim_gmms(num_seqs)
+        ASSIGNMENT = np.eye(self.K, dtype=np.float32)[LABELS]
         print('saving to %s' % os.path.abspath(PATH))
         np.save(PATH + 'ob', OB)
         np.save(PATH + 'assignment', ASSIGNMENT)
 
+    def sim_save_shards(self, num_seqs, PATH, shard_size=10000, num_workers=4, seed=0):
+        """
+        simulate num_seqs instances in shards of shard_size, generated in parallel by num_workers processes,
+        shard i is saved as ob-%05d.npy (float32, shard_size * N * D) and labels-%05d.npy (uint8, shard_size * N)
+        """
+        if not os.path.exists(PATH):
+            os.makedirs(PATH)
+        jobs = [(self, i, min(shard_size, num_seqs - start), seed, PATH) for i, start in enumerate(range(0, num_seqs, shard_size))]
+        with mp.Pool(num_workers) as pool:
+            pool.map(sim_save_shard, jobs)
+        print('saved %d shards to %s' % (len(jobs), os.path.abspath(PATH)))
+
+def sim_save_shard(job):
+    simulator, shard, num_seqs, seed, PATH = job
+    torch.set_num_threads(1) ## one thread per worker, the workers already fill the cores
+    torch.manual_seed(seed * 100003 + shard)
+    ob, labels, _, _ = simulator.sim_gmms(num_seqs)
+    np.save(PATH + 'ob-%05d' % shard, ob)
+    np.save(PATH + 'labels-%05d' % shard, labels)
+
+def load_shards(PATH, K):
+    """
+    concatenate the shards of sim_save_shards, return ob (float32) and one-hot assignments (float32) as in sim_save_data
+    """
+    shards = sorted(f[3:-4] for f in os.listdir(PATH) if f.startswith('ob-') and f.endswith('.npy'))
+    ob = np.concatenate([np.load(PATH + 'ob-%s.npy' % shard) for shard in shards], 0)
+    labels = np.concatenate([np.load(PATH + 'labels-%s.npy' % shard) for shard in shards], 0)
+    return ob, np.eye(K, dtype=np.float32)[labels]
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser('GMM_DATA')
@@ -79,6 +116,13 @@ if __name__ == '__main__':
     parser.add_argument('--beta', default=2.0, help='beta parameter of the normal-gamma prior')
     parser.add_argument('--mu', default=0.0, help='mu parameter of the normal-gamma prior')
     parser.add_argument('--nu', default=0.1, help='nu/lambda parameter of the normal-gamma prior')
+    parser.add_argument('--shard_size', default=None, type=int, help='if given, save float32 / uint8 shards of this many instances')
+    parser.add_argument('--num_workers', default=4, type=int, help='number of processes that generate the shards')
+    parser.add_argument('--seed', default=0, type=int)
     args = parser.parse_args()
     simulator = Sim_GMM(args.N, args.K, args.D, args.alpha, args.beta, args.mu, args.nu)
-    simulator.sim_save_data(args.num_instances, args.data_path)
+    if args.shard_size is not None:
+        simulator.sim_save_shards(args.num_instances, args.data_path, shard_size=args.shard_size, num_workers=args.num_workers, seed=args.seed)
+    else:
+        torch.manual_seed(args.seed)
+        simulator.sim_save_data(args.num_instances, args.data_path)
@@ -1,54 +1,305 @@
 import torch
-from torch.distributions.categorical import Categorical
 from torch.distributions.uniform import Uniform
 import torch.nn.functional as F
+from typing import List
+
+
+def ancestral_index_kernel(log_weights, positions):
+    # type: (Tensor, Tensor) -> Tensor
+    """
+    log_weights : S * B, positions : B * S in [0, 1) ===> S * B ancestral indices
+    inverse cdf on the unnormalized weights with the positions scaled by the total,
+    which saves the softmax and the normalization of the cumsums
+    """
+    sample_dim = log_weights.shape[0]
+    cumsums = torch.cumsum(torch.exp(log_weights - log_weights.max(0, keepdim=True)[0]), 0).t().contiguous() ## B * S
+    ancestral_index = torch.searchsorted(cumsums, positions * cumsums[:, -1:]).clamp(max=sample_dim-1)
+    return ancestral_index.t()
+
+def gather_kernel(variables, ancestral_index):
+    # type: (List[Tensor], Tensor) -> List[Tensor]
+    """
+    variables : S * B * ... tensors ===> the variables resampled by the S * B ancestral indices
+    """
+    sample_dim, batch_dim = ancestral_index.shape[0], ancestral_index.shape[1]
+    flat_index = (ancestral_index * batch_dim + torch.arange(batch_dim, device=ancestral_index.device)).reshape(-1)
+    resampled = []
+    for var in variables:
+        resampled.append(var.reshape(sample_dim * batch_dim, -1).index_select(0, flat_index).view(var.shape))
+    return resampled
+
+compiled_kernels = dict()
+
+def compile_kernel(kernel):
+    """
+    script the kernel once per process, fall back to the eager function if TorchScript fails on it
+    """
+    if kernel not in compiled_kernels:
+        try:
+            compiled_kernels[kernel] = torch.jit.script(kernel)
+        except Exception as e:
+            print('WARNING! could not script %s, falling back to eager mode: %s' % (kernel.__name__, e))
+            compiled_kernels[kernel] = kernel
+    return compiled_kernels[kernel]
 
 
 class Resampler():
-    def __init__(self, strategy, sample_size, CUDA, device):
+    strategies = ('systematic', 'multinomial', 'stratified', 'residual', 'ssp')
+    position_strategies = ('systematic', 'multinomial', 'stratified') ## the ones that resample by inverse cdf
+    composable = True ## whether ancestral indices can be composed before gathering, see ParticleState
+
+    def __init__(self, strategy, sample_size, CUDA, device, double_buffer=False, ess_threshold=None, fused=False):
+        """
+        strategy : one of Resampler.strategies, where ssp is the Srinivasan sampling process
+        ess_threshold : if given, select_ancestors() only resamples the instances whose ESS / S
+        falls below this fraction, the other instances keep their particles and log weights.
+        double_buffer : if True, resample() writes into two preallocated buffers per variable
+        that are used in turn, so an output stays valid until the next-but-one call.
+        Only safe when no autograd graph holds on to the resampled variables (e.g. evaluation).
+        fused : if True, the inverse cdf of the position based strategies and the gathers in resample()
+        run as TorchScript kernels (eager fallback if scripting fails), see resampler_benchmark.compare_fused.
+        """
         super(Resampler, self).__init__()
         self.strategy = strategy
-        assert self.strategy == 'systematic' or 'multinomial', "ERROR! specify resampling strategy as either systematic or multinomial."
-        if self.strategy == 'systematic':
-            if CUDA:
-                self.uniformer = Uniform(low=torch.Tensor([0.0]).cuda().to(device), high=torch.Tensor([1.0]).cuda().to(device))
-                self.spacing = torch.arange(sample_size).float().cuda().to(device)
-            else:
-                self.uniformer = Uniform(low=torch.Tensor([0.0]), high=torch.Tensor([1.0]))
-                self.spacing = torch.arange(sample_size).float()
+        assert self.strategy in self.strategies, "ERROR! specify resampling strategy as one of %s." % ', '.join(self.strategies)
+        if CUDA:
+            self.uniformer = Uniform(low=torch.Tensor([0.0]).cuda().to(device), high=torch.Tensor([1.0]).cuda().to(device))
+            self.spacing = torch.arange(sample_size).float().cuda().to(device)
+        else:
+            self.uniformer = Uniform(low=torch.Tensor([0.0]), high=torch.Tensor([1.0]))
+            self.spacing = torch.arange(sample_size).float()
         self.S = sample_size
         self.CUDA = CUDA
+        self.ess_threshold = ess_threshold
+        self.double_buffer = double_buffer
+        self.buffers = dict()
+        self.fused = fused
+        if self.fused:
+            self.ancestral_index_kernel = compile_kernel(ancestral_index_kernel)
+            self.gather_kernel = compile_kernel(gather_kernel)
 
     def sample_ancestral_index(self, log_weights):
         """
         sample ancestral indices
         """
         sample_dim, batch_dim = log_weights.shape
-        if self.strategy == 'systematic':
-            positions = (self.uniformer.sample((batch_dim,)) + self.spacing) / self.S
-            # weights = log_weights.exp()
-            normalized_weights = F.softmax(log_weights, 0)
-            cumsums = torch.cumsum(normalized_weights.transpose(0, 1), dim=1)
-            (normalizers, _) = torch.max(input=cumsums, dim=1, keepdim=True)
-            normalized_cumsums = cumsums / normalizers ## B * S
-
-            ancestral_index = torch.searchsorted(normalized_cumsums, positions)
-            assert ancestral_index.shape == (batch_dim, sample_dim), "ERROR! systematic resampling resulted unexpected index shape."
-            ancestral_index = ancestral_index.transpose(0, 1)
-
-        elif self.strategy == 'multinomial':
-            normalized_weights = F.softmax(log_weights, 0)
-            ancestral_index = Categorical(normalized_weights.transpose(0, 1)).sample((sample_dim, ))
+        if self.fused and self.strategy in self.position_strategies:
+            return self.ancestral_index_kernel(log_weights, self.sample_positions(batch_dim, log_weights.device))
+        normalized_weights = F.softmax(log_weights, 0).transpose(0, 1) ## B * S
+        if self.strategy in self.position_strategies:
+            ancestral_index = self.inverse_cdf(normalized_weights, self.sample_positions(batch_dim, log_weights.device))
+        elif self.strategy == 'residual':
+            ancestral_index = self.offspring_to_index(self.residual_offspring(normalized_weights))
         else:
-            print("ERROR! unexpected resampling strategy.")
-        return ancestral_index
+            ancestral_index = self.offspring_to_index(self.ssp_offspring(normalized_weights))
+        assert ancestral_index.shape == (batch_dim, sample_dim), "ERROR! %s resampling resulted unexpected index shape." % self.strategy
+        return ancestral_index.transpose(0, 1)
+
+    def sample_positions(self, batch_dim, device):
+        """
+        B * S positions in [0, 1) at which the inverse cdf is evaluated
+        """
+        if self.strategy == 'systematic':
+            return (self.uniformer.sample((batch_dim,)) + self.spacing) / self.S
+        elif self.strategy == 'stratified':
+            return (torch.rand(batch_dim, self.S, device=device) + self.spacing) / self.S
+        return torch.rand(batch_dim, self.S, device=device)
+
+    def inverse_cdf(self, normalized_weights, positions):
+        """
+        normalized_weights : B * S, positions : B * S uniform positions in [0, 1)
+        return the B * S indices whose cumulative weights first reach each position
+        """
+        cumsums = torch.cumsum(normalized_weights, dim=1)
+        normalized_cumsums = cumsums / cumsums[:, -1:]
+        return torch.searchsorted(normalized_cumsums, positions).clamp(max=normalized_weights.shape[1]-1)
+
+    def offspring_to_index(self, offspring):
+        """
+        offspring : B * S number of copies of each particle, each row sums to S
+        return B * S ancestral indices, with the copies of a particle in consecutive slots
+        """
+        batch_dim, sample_dim = offspring.shape
+        return torch.searchsorted(torch.cumsum(offspring, dim=1), self.spacing.repeat(batch_dim, 1), right=True).clamp(max=sample_dim-1)
+
+    def residual_offspring(self, normalized_weights):
+        """
+        keep floor(S * w) copies of each particle deterministically,
+        and draw the remaining copies multinomially from the residual weights
+        """
+        batch_dim, sample_dim = normalized_weights.shape
+        scaled_weights = normalized_weights * sample_dim
+        offspring = scaled_weights.floor()
+        num_residuals = sample_dim - offspring.sum(1, keepdim=True) ## B * 1
+        positions = torch.rand(batch_dim, sample_dim, device=normalized_weights.device)
+        draws = self.inverse_cdf(scaled_weights - offspring, positions)
+        return offspring.scatter_add(1, draws, (self.spacing < num_residuals).float())
+
+    def ssp_offspring(self, normalized_weights):
+        """
+        Srinivasan sampling process: the fractional parts of S * w are paired up in log2(S) rounds,
+        in each pair one fraction is rounded to 0 or 1 while the expectation of both is kept
+        """
+        batch_dim, sample_dim = normalized_weights.shape
+        scaled_weights = normalized_weights * sample_dim
+        offspring = scaled_weights.floor()
+        ## one extra column of zeros that pads the odd rounds
+        fractions = torch.cat((scaled_weights - offspring, torch.zeros_like(offspring[:, :1])), 1)
+        carriers = torch.arange(sample_dim, device=normalized_weights.device).repeat(batch_dim, 1)
+        while carriers.shape[1] > 1:
+            if carriers.shape[1] % 2 == 1:
+                carriers = torch.cat((carriers, torch.full_like(carriers[:, :1], sample_dim)), 1)
+            left, right = carriers[:, 0::2], carriers[:, 1::2]
+            a, b = fractions.gather(1, left), fractions.gather(1, right)
+            total = a + b
+            u = torch.rand_like(total)
+            below = total < 1
+            left_takes = u * total < a ## with probability a / (a + b), if a + b < 1
+            left_fills = u * (2 - total) < 1 - b ## with probability (1 - b) / (2 - a - b), if a + b >= 1
+            ones, zeros = torch.ones_like(total), torch.zeros_like(total)
+            new_a = torch.where(below, torch.where(left_takes, total, zeros), torch.where(left_fills, ones, total - 1))
+            new_b = torch.where(below, torch.where(left_takes, zeros, total), torch.where(left_fills, total - 1, ones))
+            fractions = fractions.scatter(1, left, new_a).scatter(1, right, new_b)
+            carriers = torch.where(torch.where(below, left_takes, ~left_fills), left, right)
+        offspring = offspring + fractions[:, :sample_dim].round()
+        ## the fractions only sum to an integer up to rounding errors, give the difference to the heaviest particle
+        deficit = sample_dim - offspring.sum(1, keepdim=True)
+        return offspring.scatter_add(1, normalized_weights.argmax(1, keepdim=True), deficit)
+
+    def select_ancestors(self, log_weights):
+        """
+        sample ancestral indices, either for every instance or, when ess_threshold is set,
+        only for the instances whose weights have degenerated.
+        return the S * B ancestral indices (None if no instance is resampled)
+        and the S * B log weights carried into the next block (zero for resampled instances)
+        """
+        if self.ess_threshold is None:
+            return self.sample_ancestral_index(log_weights), torch.zeros_like(log_weights)
+        normalized_weights = F.softmax(log_weights, 0)
+        ess = 1. / (normalized_weights ** 2).sum(0) ## B
+        degenerated = ess < self.ess_threshold * self.S
+        if not degenerated.any():
+            return None, log_weights
+        sample_dim, batch_dim = log_weights.shape
+        ancestral_index = torch.arange(sample_dim, device=log_weights.device).unsqueeze(-1).repeat(1, batch_dim)
+        ancestral_index[:, degenerated] = self.sample_ancestral_index(log_weights[:, degenerated])
+        return ancestral_index, log_weights.masked_fill(degenerated, 0.0)
+
+    def flat_index(self, ancestral_index):
+        """
+        turn the S * B ancestral indices into row indices of variables viewed as (S*B) * -1,
+        i.e. row (s, b) is taken from row (ancestral_index[s, b], b)
+        """
+        sample_dim, batch_dim = ancestral_index.shape
+        offsets = torch.arange(batch_dim, device=ancestral_index.device)
+        return (ancestral_index * batch_dim + offsets).reshape(-1) ## ancestral_index is usually a transposed view
+
+    def resample(self, state, ancestral_index):
+        """
+        resample all the variables in state along the sample dim with one shared index computation
+        state : a dict or a tuple of tensors, each of shape S * B * ... with any number of trailing dims
+        return the resampled variables in the same container type
+        """
+        if self.fused and not self.double_buffer:
+            if isinstance(state, dict):
+                return dict(zip(state.keys(), self.gather_kernel(list(state.values()), ancestral_index)))
+            return tuple(self.gather_kernel(list(state), ancestral_index))
+        flat_index = self.flat_index(ancestral_index)
+        if isinstance(state, dict):
+            return {key : self.index_rows(key, var, flat_index) for key, var in state.items()}
+        return tuple(self.index_rows(key, var, flat_index) for key, var in enumerate(state))
+
+    def index_rows(self, key, var, flat_index):
+        flat_var = var.reshape(flat_index.shape[0], -1)
+        if not self.double_buffer:
+            return flat_var.index_select(0, flat_index).view(var.shape)
+        buffer_key = (key, flat_var.shape, flat_var.dtype, flat_var.device)
+        if buffer_key not in self.buffers:
+            self.buffers[buffer_key] = [torch.empty_like(flat_var), torch.empty_like(flat_var), 0]
+        buffers = self.buffers[buffer_key]
+        out = buffers[buffers[2]]
+        buffers[2] = 1 - buffers[2]
+        if out.data_ptr() == flat_var.data_ptr(): ## never gather a variable into its own storage
+            return flat_var.index_select(0, flat_index).view(var.shape)
+        torch.index_select(flat_var, 0, flat_index, out=out)
+        return out.view(var.shape)
+
+    def resample_path(self, path, ancestral_indices):
+        """
+        reconstruct resampled trajectories from back-pointers with a single gather
+        path : list of T tensors of shape S * B * ..., the value proposed at each step
+        ancestral_indices : list of T S * B ancestral indices used after each step, None if that step was not resampled
+        return S * B * T * ..., the trajectory that each final particle descends from
+        """
+        sample_dim, batch_dim = path[0].shape[:2]
+        T = len(path)
+        ## trace back from the final particles, lineage[t] is the slot at step t of each final particle
+        lineage = torch.arange(sample_dim, device=path[0].device).unsqueeze(-1).repeat(1, batch_dim)
+        lineages = [None] * T
+        for t in reversed(range(T)):
+            if ancestral_indices[t] is not None:
+                lineage = torch.gather(ancestral_indices[t], 0, lineage)
+            lineages[t] = lineage
+        lineages = torch.stack(lineages, 2) ## S * B * T
+        offsets = torch.arange(batch_dim * T, device=lineages.device).view(batch_dim, T)
+        flat_index = (lineages * (batch_dim * T) + offsets).view(-1)
+        trajectories = torch.stack(path, 2) ## S * B * T * ...
+        return trajectories.reshape(flat_index.shape[0], -1).index_select(0, flat_index).view(trajectories.shape)
 
     def resample_4dims(self, var, ancestral_index):
-        sample_dim, batch_dim, dim3, dim4 = var.shape
-        gather_index = ancestral_index.unsqueeze(-1).unsqueeze(-1).repeat(1, 1, dim3, dim4)
-        return torch.gather(var, 0, gather_index)
+        return var.reshape(-1, var.shape[2] * var.shape[3]).index_select(0, self.flat_index(ancestral_index)).view(var.shape)
 
     def resample_5dims(self, var, ancestral_index):
-        sample_dim, batch_dim, dim3, dim4, dim5 = var.shape
-        gather_index = ancestral_index.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1).repeat(1, 1, dim3, dim4, dim5)
-        return torch.gather(var, 0, gather_index)
+        return var.reshape(-1, var.shape[2] * var.shape[3] * var.shape[4]).index_select(0, self.flat_index(ancestral_index)).view(var.shape)
+
+
+class ParticleState():
+    """
+    particle state with lazy ancestry tracking:
+    resample() only composes the ancestral indices, and a variable is gathered when it is read,
+    so a chain of resamplings costs one gather per variable and unread variables are never copied
+    """
+    def __init__(self, resampler, **variables):
+        self.resampler = resampler
+        self.values = dict(variables)
+        self.ancestors = dict() ## pending S * B ancestral index of each variable that has not been gathered yet
+
+    def __getitem__(self, name):
+        return self.get(name)[0]
+
+    def __setitem__(self, name, value):
+        self.values[name] = value
+        self.ancestors.pop(name, None)
+
+    def get(self, *names):
+        """
+        read variables, the ones that share a pending ancestral index are gathered together
+        """
+        groups = dict()
+        for name in names:
+            if name in self.ancestors:
+                groups.setdefault(id(self.ancestors[name]), []).append(name)
+        for group in groups.values():
+            resampled = self.resampler.resample({name : self.values[name] for name in group}, self.ancestors[group[0]])
+            for name in group:
+                self.values[name] = resampled[name]
+                del self.ancestors[name]
+        return tuple(self.values[name] for name in names)
+
+    def resample(self, ancestral_index):
+        """
+        a variable with pending index idx1 now has pending index idx1[idx2], where idx2 is ancestral_index.
+        resamplers whose indices cannot be composed locally (e.g. DistributedResampler) gather right away
+        """
+        if not self.resampler.composable:
+            self.values = self.resampler.resample(self.values, ancestral_index)
+            return
+        composed = dict()
+        for name in self.values:
+            if name in self.ancestors:
+                pending = self.ancestors[name]
+                if id(pending) not in composed: ## keep pending alive so that its id is not reused in this loop
+                    composed[id(pending)] = (pending, torch.gather(pending, 0, ancestral_index))
+                self.ancestors[name] = composed[id(pending)][1]
+            else:
+                self.ancestors[name] = ancestral_index
@@ -0,0 +1,211 @@
+import time
+import json
+import torch
+import torch.nn.functional as F
+from apgs.resampler import Resampler
+
+"""
+Benchmarks of the resampling strategies in apgs/resampler.py
+==========
+for each strategy, report
+    wall time of one call of sample_ancestral_index
+    variance of the offspring counts around their expectation S * w, averaged over particles and instances
+lower offspring variance means less noise added by resampling for the same number of particles
+and, for the fused TorchScript kernels, their wall time against the eager ops and their agreement with them
+==========
+benchmark_grid times sample_ancestral_index and the gathers over a grid of S, B and the latent shapes
+of the three tasks, reports ops/sec and memory, and can save a JSON baseline or compare against one
+==========
+"""
+## trailing dims of the particle variables of each task, with the dataset sizes of the simulators
+latent_shapes = {'gmm_eta' : (3, 2), ## tau, mu : K * D
+                 'gmm_z' : (60, 3), ## z : N * K
+                 'dmm_beta' : (200, 1), ## beta : N * 1
+                 'bmnist_z_where' : (10, 3, 2)} ## z_where : T * K * 2, i.e. 5-D variables
+def offspring_counts(ancestral_index):
+    """
+    ancestral_index : S * B ===> number of copies of each particle, S * B
+    """
+    return torch.zeros_like(ancestral_index, dtype=torch.float).scatter_add_(0, ancestral_index, torch.ones_like(ancestral_index, dtype=torch.float))
+
+def compare_strategies(sample_size, batch_size, num_repeats, CUDA, device, strategies=Resampler.strategies, log_weight_scale=2.0):
+    """
+    run every strategy num_repeats times on the same random log weights
+    """
+    log_weights = torch.randn(sample_size, batch_size) * log_weight_scale
+    if CUDA:
+        log_weights = log_weights.cuda().to(device)
+    expected_counts = torch.softmax(log_weights, 0) * sample_size
+    metrics = dict()
+    for strategy in strategies:
+        resampler = Resampler(strategy, sample_size, CUDA, device)
+        resampler.sample_ancestral_index(log_weights) ## warm up
+        squared_errors = 0.0
+        elapsed = 0.0
+        for r in range(num_repeats):
+            if CUDA:
+                torch.cuda.synchronize()
+            time_start = time.time()
+            ancestral_index = resampler.sample_ancestral_index(log_weights)
+            if CUDA:
+                torch.cuda.synchronize()
+            elapsed += time.time() - time_start
+            counts = offspring_counts(ancestral_index)
+            assert (counts.sum(0) == sample_size).all(), "ERROR! %s resampling did not keep the number of particles." % strategy
+            squared_errors = squared_errors + (counts - expected_counts) ** 2
+        metrics[strategy] = {'time_ms' : elapsed / num_repeats * 1e3,
+                             'offspring_variance' : (squared_errors / num_repeats).mean().item()}
+        print('strategy=%s, time=%.3fms, offspring variance=%.4f' % (strategy, metrics[strategy]['time_ms'], metrics[strategy]['offspring_variance']))
+    return metrics
+
+def compare_fused(sample_size, batch_size, num_repeats, CUDA, device, latent_shape=(10, 2), log_weight_scale=2.0, tolerance=1e-3):
+    """
+    check the fused kernels against the eager implementation and time both on index sampling plus gather.
+    the fused inverse cdf works on unnormalized cumsums, so an index may differ from the eager one
+    when a position falls within rounding error of a cumulative weight: the fraction of such indices
+    must stay below tolerance, and the fused gather must match the eager gather exactly
+    """
+    log_weights = torch.randn(sample_size, batch_size) * log_weight_scale
+    var = torch.randn((sample_size, batch_size) + tuple(latent_shape))
+    if CUDA:
+        log_weights = log_weights.cuda().to(device)
+        var = var.cuda().to(device)
+    metrics = dict()
+    for strategy in Resampler.position_strategies:
+        eager = Resampler(strategy, sample_size, CUDA, device)
+        fused = Resampler(strategy, sample_size, CUDA, device, fused=True)
+        positions = eager.sample_positions(batch_size, log_weights.device)
+        eager_index = eager.inverse_cdf(F.softmax(log_weights, 0).transpose(0, 1), positions).transpose(0, 1)
+        fused_index = fused.ancestral_index_kernel(log_weights, positions)
+        mismatch = (eager_index != fused_index).float().mean().item()
+        assert mismatch <= tolerance, "ERROR! fused %s resampling disagrees with the eager one on %.4f of the indices." % (strategy, mismatch)
+        assert torch.equal(fused.resample((var,), fused_index)[0], eager.resample((var,), fused_index)[0]), "ERROR! fused gather disagrees with the eager one."
+        metrics[strategy] = {'index_mismatch' : mismatch}
+        for name, resampler in [('eager', eager), ('fused', fused)]:
+            resampler.resample((var,), resampler.sample_ancestral_index(log_weights)) ## warm up, the first scripted calls also optimize the graph
+            resampler.resample((var,), resampler.sample_ancestral_index(log_weights))
+            if CUDA:
+                torch.cuda.synchronize()
+            time_start = time.time()
+            for r in range(num_repeats):
+                resampler.resample((var,), resampler.sample_ancestral_index(log_weights))
+            if CUDA:
+                torch.cuda.synchronize()
+            metrics[strategy]['%s_time_ms' % name] = (time.time() - time_start) / num_repeats * 1e3
+        print('strategy=%s, eager=%.3fms, fused=%.3fms, index mismatch=%.5f' % (strategy, metrics[strategy]['eager_time_ms'], metrics[strategy]['fused_time_ms'], mismatch))
+    return metrics
+
+def measure(fn, num_repeats, CUDA):
+    """
+    average wall time of fn and the memory it needs: the peak allocated memory on cuda,
+    the total memory allocated by its ops on cpu (recorded by the profiler, an upper bound of the peak)
+    """
+    fn() ## warm up
+    if CUDA:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    time_start = time.time()
+    for r in range(num_repeats):
+        fn()
+    if CUDA:
+        torch.cuda.synchronize()
+    elapsed = (time.time() - time_start) / num_repeats
+    if CUDA:
+        memory = torch.cuda.max_memory_allocated() - baseline
+    else:
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            fn()
+        memory = sum(max(event.self_cpu_memory_usage, 0) for event in prof.function_events)
+    return elapsed, memory
+
+def benchmark_grid(sample_sizes, batch_sizes, shapes, strategies, num_repeats, CUDA, device, max_elements=int(2e8), log_weight_scale=2.0):
+    """
+    time sample_ancestral_index once per (strategy, S, B) and the gather of a variable of each latent shape,
+    combinations whose variable has more than max_elements entries are skipped
+    return a dict keyed by 'strategy/S/B/shape'
+    """
+    metrics = dict()
+    for sample_size in sample_sizes:
+        for batch_size in batch_sizes:
+            log_weights = torch.randn(sample_size, batch_size) * log_weight_scale
+            if CUDA:
+                log_weights = log_weights.cuda().to(device)
+            for strategy in strategies:
+                resampler = Resampler(strategy, sample_size, CUDA, device)
+                index_time, index_memory = measure(lambda: resampler.sample_ancestral_index(log_weights), num_repeats, CUDA)
+                ancestral_index = resampler.sample_ancestral_index(log_weights)
+                for shape_name in shapes:
+                    shape = latent_shapes[shape_name]
+                    num_elements = sample_size * batch_size
+                    for d in shape:
+                        num_elements *= d
+                    if num_elements > max_elements:
+                        continue
+                    var = torch.randn((sample_size, batch_size) + shape, device=log_weights.device)
+                    gather_time, gather_memory = measure(lambda: resampler.resample((var,), ancestral_index), num_repeats, CUDA)
+                    key = '%s/%d/%d/%s' % (strategy, sample_size, batch_size, shape_name)
+                    metrics[key] = {'index_ops_per_sec' : 1. / index_time,
+                                    'index_memory_mb' : index_memory / 2**20,
+                                    'gather_ops_per_sec' : 1. / gather_time,
+                                    'gather_memory_mb' : gather_memory / 2**20}
+                    print('%s: index %.1f ops/sec (%.2fMB), gather %.1f ops/sec (%.2fMB)' % (key, metrics[key]['index_ops_per_sec'], metrics[key]['index_memory_mb'], metrics[key]['gather_ops_per_sec'], metrics[key]['gather_memory_mb']))
+                    del var
+    return metrics
+
+def save_baseline(metrics, path):
+    with open(path, 'w') as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+
+def compare_baseline(metrics, path, tolerance=0.2):
+    """
+    report the entries whose throughput dropped, or memory grew, by more than tolerance relative to the baseline
+    return the list of regressed entries
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for key, values in metrics.items():
+        if key not in baseline:
+            continue
+        for name, value in values.items():
+            old = baseline[key][name]
+            if 'ops_per_sec' in name:
+                regressed = value < old * (1 - tolerance)
+            else:
+                regressed = value > old * (1 + tolerance) and value - old > 0.1 ## ignore changes below 0.1MB
+            if regressed:
+                regressions.append((key, name, old, value))
+                print('REGRESSION %s %s: %.2f ===> %.2f' % (key, name, old, value))
+    print('%d / %d entries compared, %d regressions' % (len([k for k in metrics if k in baseline]), len(metrics), len(regressions)))
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('Resampler benchmarks')
+    parser.add_argument('--device', default=0, type=int)
+    parser.add_argument('--sample_size', default=100, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--num_repeats', default=100, type=int)
+    parser.add_argument('--log_weight_scale', default=2.0, type=float, help='standard deviation of the random log weights')
+    parser.add_argument('--grid', action='store_true', help='run benchmark_grid instead of the single-setting comparisons')
+    parser.add_argument('--sample_sizes', default=[10, 100, 1000, 10000], type=int, nargs='+')
+    parser.add_argument('--batch_sizes', default=[1, 10, 100, 1000], type=int, nargs='+')
+    parser.add_argument('--shapes', default=list(latent_shapes.keys()), nargs='+', choices=list(latent_shapes.keys()))
+    parser.add_argument('--strategies', default=list(Resampler.strategies), nargs='+', choices=Resampler.strategies)
+    parser.add_argument('--max_elements', default=int(2e8), type=int, help='skip the variables larger than this')
+    parser.add_argument('--save_baseline', default=None, help='write the grid metrics to this JSON file')
+    parser.add_argument('--compare_baseline', default=None, help='compare the grid metrics against this JSON file')
+    parser.add_argument('--tolerance', default=0.2, type=float)
+    args = parser.parse_args()
+    CUDA = torch.cuda.is_available()
+    device = torch.device('cuda:%d' % args.device)
+    if args.grid:
+        metrics = benchmark_grid(args.sample_sizes, args.batch_sizes, args.shapes, args.strategies, args.num_repeats, CUDA, device, max_elements=args.max_elements, log_weight_scale=args.log_weight_scale)
+        if args.compare_baseline is not None:
+            compare_baseline(metrics, args.compare_baseline, tolerance=args.tolerance)
+        if args.save_baseline is not None:
+            save_baseline(metrics, args.save_baseline)
+    else:
+        compare_strategies(args.sample_size, args.batch_size, args.num_repeats, CUDA, device, log_weight_scale=args.log_weight_scale)
+        compare_fused(args.sample_size, args.batch_size, args.num_repeats, CUDA, device, log_weight_scale=args.log_weight_scale)